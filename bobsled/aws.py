@@ -0,0 +1,62 @@
+"""
+Async access to AWS APIs.
+
+boto3 is synchronous, so calls are run on a bounded thread pool instead of on the
+event loop.  Each worker thread keeps its own long-lived boto3 session & clients,
+since sessions aren't thread safe and clients are expensive to build.
+"""
+import os
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from .metrics import AWS_CALL_SECONDS
+
+MAX_WORKERS = int(os.environ.get("BOBSLED_AWS_MAX_WORKERS", "10"))
+
+_executor = None
+_local = threading.local()
+
+
+def get_client(service):
+    """
+    get the calling thread's client for 'service', creating it on first use
+    """
+    if not hasattr(_local, "clients"):
+        _local.session = boto3.session.Session()
+        _local.clients = {}
+    if service not in _local.clients:
+        _local.clients[service] = _local.session.client(service)
+    return _local.clients[service]
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=MAX_WORKERS, thread_name_prefix="bobsled-aws"
+        )
+    return _executor
+
+
+async def run(func, *args, **kwargs):
+    """
+    run a blocking function on the AWS worker pool
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(func, *args, **kwargs)
+    )
+
+
+def _call(service, method, kwargs):
+    return getattr(get_client(service), method)(**kwargs)
+
+
+async def call(service, method, **kwargs):
+    """
+    call a boto3 client method, e.g. await call("ecs", "describe_tasks", tasks=[...])
+    """
+    with AWS_CALL_SECONDS.labels(service, method).time():
+        return await run(_call, service, method, kwargs)
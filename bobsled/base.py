@@ -1,9 +1,22 @@
 import attr
+import asyncio
 import enum
 import uuid
 import datetime
 import typing
 from .exceptions import AlreadyRunning
+from .metrics import (
+    CALLBACK_SECONDS,
+    RUNNER_SECONDS,
+    RUNS_FINISHED,
+    RUNS_STARTED,
+    timed,
+)
+from .stats import TaskStats
+from .tracing import traced_methods
+
+# how many of a task's latest runs its stats are started from when it has none
+STATS_HISTORY_RUNS = 1000
 
 
 class Status(enum.Enum):
@@ -62,6 +75,11 @@ class Run:
     run_info: typing.Dict[str, any] = {}
     uuid: str = attr.Factory(lambda: uuid.uuid4().hex)
 
+    @property
+    def queued(self):
+        """waiting for a concurrency slot, nothing has been started yet"""
+        return bool(self.run_info.get("queued"))
+
 
 @attr.s(auto_attribs=True)
 class User:
@@ -70,14 +88,45 @@ class User:
     permissions: typing.List[str] = []
 
 
+# watch runs for as long as the process does
+@traced_methods(exclude=("watch",))
 class RunService:
+    # set to a ConcurrencyLimits to queue runs instead of always starting them
+    limits = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # run services implement most of their methods themselves
+        traced_methods(exclude=("watch",))(cls)
+
+    @timed(RUNNER_SECONDS, "run_task")
     async def run_task(self, task):
         running = await self.get_runs(
             status=[Status.Pending, Status.Running], task_name=task.name
         )
         if running:
             raise AlreadyRunning()
-        run_info = self.start_task(task)
+
+        if self.limits:
+            # every run waits its turn, admit_queued starts it right away if it fits
+            now = datetime.datetime.utcnow().isoformat()
+            run = Run(
+                task.name,
+                Status.Pending,
+                start=now,
+                run_info={"queued": True, "queued_at": now, "timeout_at": ""},
+            )
+            await self.storage.add_run(run)
+            await self.admit_queued()
+            return await self.storage.get_run(run.uuid)
+
+        run = Run(task.name, self.STARTING_STATUS, run_info={})
+        await self._start_run(run, task)
+        await self.storage.add_run(run)
+        return run
+
+    async def _start_run(self, run, task):
+        run_info = await self.start_task(task)
         now = datetime.datetime.utcnow()
         timeout_at = ""
         if task.timeout_minutes:
@@ -85,15 +134,123 @@ class RunService:
                 now + datetime.timedelta(minutes=task.timeout_minutes)
             ).isoformat()
         run_info["timeout_at"] = timeout_at
+        if run.queued:
+            queued_at = datetime.datetime.fromisoformat(run.run_info["queued_at"])
+            run_info["queued"] = False
+            run_info["wait_seconds"] = (now - queued_at).total_seconds()
+        run.run_info.update(run_info)
+        run.status = self.STARTING_STATUS
+        run.start = now.isoformat()
+        RUNS_STARTED.inc()
 
-        run = Run(
-            task.name, self.STARTING_STATUS, start=now.isoformat(), run_info=run_info
-        )
-        await self.storage.add_run(run)
-        return run
+    async def get_queued_runs(self):
+        """
+        runs waiting for a concurrency slot, in the order they'll be admitted
+        """
+        runs = await self.storage.get_runs(status=Status.Pending)
+        queued = [run for run in runs if run.queued]
+        queued.sort(key=lambda r: r.run_info["queued_at"])
+        return queued
 
-    async def _save_and_followup(self, run):
+    async def admit_queued(self):
+        """
+        start queued runs, oldest first, for as long as the limits allow
+
+        a run that doesn't fit is skipped rather than blocking the smaller runs
+        behind it, until it has waited limits.queue_skip_seconds, returns the runs
+        that were started
+        """
+        if not self.limits:
+            return []
+
+        admitted = []
+        failed = []
+        # beat and web both admit, the storage lock keeps them from starting the
+        # same run twice or both filling the last slot
+        async with self.storage.admission_lock():
+            queued = await self.get_queued_runs()
+            if not queued:
+                return []
+            tasks = {task.name: task for task in await self.storage.get_tasks()}
+            active = [
+                tasks[run.task]
+                for run in await self.storage.get_runs(
+                    status=[Status.Pending, Status.Running]
+                )
+                if not run.queued and run.task in tasks
+            ]
+
+            now = datetime.datetime.utcnow()
+            for run in queued:
+                task = tasks.get(run.task)
+                if not task:
+                    # removed from the config while it waited
+                    run.status = Status.Missing
+                    run.end = now.isoformat()
+                    await self._finish(run)
+                    continue
+                if not self.limits.allows(task, active):
+                    queued_at = datetime.datetime.fromisoformat(
+                        run.run_info["queued_at"]
+                    )
+                    waited = (now - queued_at).total_seconds()
+                    if waited >= self.limits.queue_skip_seconds:
+                        # waited long enough, nothing behind it starts until it does
+                        break
+                    continue
+                try:
+                    await self._start_run(run, task)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # don't let one task that can't start hold up the queue, or the
+                    # followup of the run that finished and made room for it
+                    print(f"failed to start queued run {run.uuid}: {e!r}")
+                    run.status = Status.Error
+                    run.end = datetime.datetime.utcnow().isoformat()
+                    await self.storage.append_logs(run, f"failed to start: {e!r}\n")
+                    await self._finish(run)
+                    failed.append(run)
+                    continue
+                await self.storage.save_run(run)
+                active.append(task)
+                admitted.append(run)
+
+        for run in failed:
+            if self.callbacks:
+                run.logs = await self.storage.get_logs(run.uuid)
+            await self._run_callbacks("on_error", run)
+        return admitted
+
+    async def get_queue_stats(self):
+        queued = await self.get_queued_runs()
+        longest_wait = 0
+        if queued:
+            oldest = datetime.datetime.fromisoformat(queued[0].run_info["queued_at"])
+            longest_wait = (datetime.datetime.utcnow() - oldest).total_seconds()
+        return {"depth": len(queued), "longest_wait_seconds": longest_wait}
+
+    async def _finish(self, run):
+        """
+        save a run that has just become terminal
+
+        every terminal save goes through here, so stats and metrics see every run
+        however it ended
+        """
         await self.storage.save_run(run)
+        RUNS_FINISHED.labels(run.status.name).inc()
+        await self._record_stats(run)
+
+    async def _save_and_followup(self, run):
+        if run.status.is_terminal():
+            await self._finish(run)
+            # a slot just opened up
+            await self.admit_queued()
+        else:
+            await self.storage.save_run(run)
+        if run.status.is_terminal() and self.callbacks:
+            # run may only hold the most recent logs, callbacks get all of them
+            run.logs = await self.storage.get_logs(run.uuid)
         if run.status == Status.Success:
             # start other jobs and do on success callback
             try:
@@ -107,30 +264,84 @@ class RunService:
                 # isn't registered
                 print("missing task", e)
 
-            for callback in self.callbacks:
-                await callback.on_success(run, self.storage)
+            await self._run_callbacks("on_success", run)
 
         elif run.status == Status.Error:
-            for callback in self.callbacks:
-                await callback.on_error(run, self.storage)
+            await self._run_callbacks("on_error", run)
+
+    async def _run_callbacks(self, event, run):
+        for callback in self.callbacks:
+            with CALLBACK_SECONDS.labels(type(callback).__name__, event).time():
+                await getattr(callback, event)(run, self.storage)
+
+    async def _record_stats(self, run):
+        async def record(stats):
+            if stats is None:
+                stats = await self._stats_from_history(run)
+            return stats if stats.record(run) else None
+
+        return await self.storage.update_task_stats(run.task, record)
+
+    async def _stats_from_history(self, run):
+        """
+        stats for a task that has none yet, e.g. one that ran before stats were kept,
+        from its latest runs so that a failure streak doesn't start over at zero
+        """
+        stats = TaskStats(run.task)
+        history = await self.storage.get_runs(
+            task_name=run.task, latest=STATS_HISTORY_RUNS
+        )
+        for past in history:
+            if past.uuid != run.uuid and past.status.is_terminal():
+                stats.record(past)
+        return stats
+
+    async def get_task_stats(self, task_names=None):
+        return await self.storage.get_task_stats(task_names)
 
     async def get_runs(
-        self, *, status=None, task_name=None, latest=None, update_status=False
+        self,
+        *,
+        status=None,
+        task_name=None,
+        latest=None,
+        before=None,
+        update_status=False,
     ):
         runs = await self.storage.get_runs(
-            status=status, task_name=task_name, latest=latest
+            status=status, task_name=task_name, latest=latest, before=before
         )
         if update_status:
-            for run in runs:
-                await self.update_status(run.uuid)
-        # sort runs old to new
-        runs.sort(key=lambda r: r.start, reverse=True)
+            await self.update_statuses([run.uuid for run in runs])
+        # storage returns runs old to new, in the order its cursor pages through
+        runs.reverse()
         return runs
 
+    async def get_latest_runs_per_task(self, n, task_names=None):
+        return await self.storage.get_latest_runs_per_task(n, task_names)
+
+    async def update_statuses(self, run_ids, update_logs=False):
+        """
+        update many runs at once, run services that can check on several runs in a
+        single call should override this
+        """
+        return await asyncio.gather(
+            *[self.update_status(run_id, update_logs=update_logs) for run_id in run_ids]
+        )
+
+    async def watch(self):
+        """
+        follow status changes as they happen, run services that can be notified when
+        a run finishes should override this, otherwise runs are only polled
+        """
+        pass
+
     async def stop_run(self, run_id):
         run = await self.storage.get_run(run_id)
         if not run.status.is_terminal():
-            self.stop(run)
+            # a queued run has nothing to stop, it just leaves the queue
+            if not run.queued:
+                await self.stop(run)
             run.status = Status.UserKilled
             run.end = datetime.datetime.utcnow().isoformat()
-            await self.storage.save_run(run)
+            await self._save_and_followup(run)
@@ -1,92 +1,199 @@
 import os
+import time
+import traceback
 import asyncio
 import datetime
+import heapq
+import functools
 import zmq
 from .base import Status
 from .core import bobsled
+from .cron import parse_cron
 from .exceptions import AlreadyRunning
+from .utils import run_forever
+from . import metrics
+from .metrics import (
+    ACTIVE_RUNS,
+    BEAT_LOOP_SECONDS,
+    BEAT_SCHEDULED_TASKS,
+    BEAT_TASK_STARTS,
+)
 
 
-def parse_cron_segment(segment, star_equals):
-    if segment == "*":
-        return star_equals
-    elif "," in segment:
-        return sorted([int(n) for n in segment.split(",")])
-    elif "-" in segment:
-        start, end = segment.split("-")
-        return list(range(int(start), int(end) + 1))
-    elif segment.startswith("*/"):
-        n = int(segment[2:])
-        return list(range(0, 24, n))
-    elif segment.isdigit():
-        return [int(segment)]
-    else:
-        raise ValueError(segment)
+def next_cron(cronstr, after=None):
+    return parse_cron(cronstr).next_fire(after)
+
+
+def next_run_for_task(task, after=None):
+    """
+    earliest time that any of the task's triggers fires after 'after'
+    """
+    next_runs = [next_cron(trigger.cron, after) for trigger in task.triggers]
+    next_runs = [next_run for next_run in next_runs if next_run]
+    return min(next_runs) if next_runs else None
+
+
+class Scheduler:
+    """
+    min-heap of (next run, task name) for every enabled task with a trigger
+
+    Entries are popped as they come due and pushed back with their following run
+    time, so each wakeup only touches the tasks that are actually due.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.tasks = {}
+        self.next_runs = {}
+        self.wakeup = asyncio.Event()
+
+    def set_tasks(self, tasks, now=None):
+        """
+        rebuild the schedule, runs that are already due but not yet started are kept
+        """
+        if not now:
+            now = datetime.datetime.utcnow()
+        due = {name: next_run for next_run, name in self.heap if next_run <= now}
+        self.tasks = {task.name: task for task in tasks if task.enabled}
+        self.next_runs = {}
+        for task in self.tasks.values():
+            next_run = due.get(task.name) or next_run_for_task(task, now)
+            if next_run:
+                self.next_runs[task.name] = next_run
+        self.heap = [(next_run, name) for name, next_run in self.next_runs.items()]
+        heapq.heapify(self.heap)
+        self.wakeup.set()
+
+    def next_deadline(self):
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now=None):
+        """
+        remove & return names of all tasks due at 'now', rescheduling each
+        """
+        if not now:
+            now = datetime.datetime.utcnow()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            next_run, name = heapq.heappop(self.heap)
+            due.append(name)
+            # a late wakeup shouldn't cause a burst of catch-up runs
+            next_run = next_run_for_task(self.tasks[name], max(next_run, now))
+            if next_run:
+                self.next_runs[name] = next_run
+                heapq.heappush(self.heap, (next_run, name))
+            else:
+                self.next_runs.pop(name, None)
+        return due
+
+    async def wait(self):
+        """
+        sleep until the next deadline, or until the schedule changes
+        """
+        self.wakeup.clear()
+        deadline = self.next_deadline()
+        timeout = None
+        if deadline:
+            timeout = max((deadline - datetime.datetime.utcnow()).total_seconds(), 0)
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
 
-def next_cron(cronstr, after=None):
-    minute, hour, day, month, dow = cronstr.split()
-
-    days = parse_cron_segment(day, list(range(1, 32)))
-    minutes = parse_cron_segment(minute, list(range(60)))
-    hours = parse_cron_segment(hour, list(range(24)))
-    if dow != "?":
-        dow = parse_cron_segment(dow, list(range(7)))
-
-    # scheduling things that don't run every month not currently supported
-    assert month == "*"
-
-    if not after:
-        after = datetime.datetime.utcnow()
-    next_time = None
-
-    for month in range(1, 13):
-        for day in days:
-            for hour in hours:
-                for minute in minutes:
-                    try:
-                        next_time = after.replace(
-                            month=month,
-                            day=day,
-                            hour=hour,
-                            minute=minute,
-                            second=0,
-                            microsecond=0,
-                        )
-                        # skip wrong days of the week
-                        if dow != "?" and next_time.weekday() not in dow:
-                            continue
-                    except ValueError:
-                        # if we made an invalid time due to month rollover, skip it
-                        continue
-                    if next_time > after:
-                        return next_time
-
-    # no next time this month, set to the first time but the next month
-    if after.month == 12:
-        month = 1
-        year = after.year + 1
-        next_time = next_time.replace(
-            day=days[0], hour=hours[0], minute=minutes[0], month=month, year=year,
+# TODO: make these configurable
+LOG_FILE = "/tmp/bobsled-beat.log"
+UPDATE_CONFIG_MINS = 120
+POLL_SECONDS = 60
+ARCHIVE_MINS = 60
+
+
+async def start_task(scheduler, task_name, _log):
+    next_run = scheduler.next_runs.get(task_name)
+    try:
+        task = await bobsled.storage.get_task(task_name)
+        run = await bobsled.run.run_task(task)
+        msg = f"started {task_name}: {run}.  next run at {next_run}"
+        BEAT_TASK_STARTS.labels("started").inc()
+    except AlreadyRunning:
+        msg = f"{task_name}: already running.  next run at {next_run}"
+        BEAT_TASK_STARTS.labels("already_running").inc()
+    except Exception:
+        # one task failing to start shouldn't hold up the others that are due
+        msg = f"{task_name}: failed to start.  next run at {next_run}\n"
+        msg += traceback.format_exc()
+        BEAT_TASK_STARTS.labels("failed").inc()
+    _log(msg)
+
+
+async def schedule_runs(scheduler, _log):
+    while True:
+        with BEAT_LOOP_SECONDS.labels("schedule").time():
+            due = scheduler.pop_due()
+            if due:
+                await asyncio.gather(
+                    *[start_task(scheduler, task_name, _log) for task_name in due]
+                )
+            BEAT_SCHEDULED_TASKS.set(len(scheduler.next_runs))
+        await scheduler.wait()
+
+
+async def poll_statuses(_log):
+    while True:
+        start = time.perf_counter()
+        pending = await bobsled.run.get_runs(status=Status.Pending)
+        running = await bobsled.run.get_runs(status=Status.Running)
+        utcnow = datetime.datetime.utcnow()
+
+        queued = [run for run in pending if run.queued]
+        ACTIVE_RUNS.labels("pending").set(len(pending) - len(queued))
+        ACTIVE_RUNS.labels("running").set(len(running))
+        ACTIVE_RUNS.labels("queued").set(len(queued))
+        _log(
+            f"{utcnow}: pending={len(pending) - len(queued)} running={len(running)} "
+            f"queued={len(queued)}"
         )
-        return next_time
 
+        # batched updates for all running tasks, logs are fetched as they're viewed
+        # and when the run finishes, so a watching run service has nothing to poll
+        await bobsled.run.update_statuses(
+            [run.uuid for run in running + pending if not run.queued]
+        )
+        # catch slots freed by runs that finished elsewhere (e.g. stopped via web)
+        for run in await bobsled.run.admit_queued():
+            _log(f"started queued {run.task}: {run}")
+        BEAT_LOOP_SECONDS.labels("poll").observe(time.perf_counter() - start)
 
-def next_run_for_task(task):
-    for trigger in task.triggers:
-        return next_cron(trigger.cron)
+        await asyncio.sleep(POLL_SECONDS)
 
 
-# TODO: make these configurable
-LOG_FILE = "/tmp/bobsled-beat.log"
-UPDATE_CONFIG_MINS = 120
+async def refresh_config(scheduler, _log):
+    while True:
+        await asyncio.sleep(UPDATE_CONFIG_MINS * 60)
+        _log("updating config...")
+        with BEAT_LOOP_SECONDS.labels("refresh_config").time():
+            tasks = await bobsled.refresh_config()
+            scheduler.set_tasks(tasks)
+        next_task_update = datetime.datetime.utcnow() + datetime.timedelta(
+            minutes=UPDATE_CONFIG_MINS
+        )
+        _log(f"updated tasks, will run again at {next_task_update}")
+
+
+async def archive_runs(_log):
+    if not bobsled.retention.enabled:
+        return
+    while True:
+        with BEAT_LOOP_SECONDS.labels("archive").time():
+            tasks = await bobsled.storage.get_tasks()
+            archived, deleted = await bobsled.retention.archive_expired(tasks)
+        if archived or deleted:
+            _log(f"archived {archived} runs, deleted {deleted} runs")
+        await asyncio.sleep(ARCHIVE_MINS * 60)
 
 
 async def run_service():
     await bobsled.initialize()
-    next_task_update = datetime.datetime.utcnow() + datetime.timedelta(
-        minutes=UPDATE_CONFIG_MINS
-    )
 
     port = os.environ.get("BOBSLED_BEAT_PORT", "1988")
 
@@ -98,50 +205,28 @@ async def run_service():
         socket.send_string(msg)
         print(msg)
 
-    next_run_list = {}
-    for task in await bobsled.storage.get_tasks():
-        if not task.enabled:
-            continue
-        next_run = next_run_for_task(task)
-        if next_run:
-            next_run_list[task.name] = next_run
-            _log(f"{task.name} next run at {next_run}")
-
-    while True:
-        pending = await bobsled.run.get_runs(status=Status.Pending)
-        running = await bobsled.run.get_runs(status=Status.Running)
-        utcnow = datetime.datetime.utcnow()
-
-        _log(f"{utcnow}: pending={len(pending)} running={len(running)}")
-
-        if utcnow > next_task_update:
-            _log("updating config...")
-            await bobsled.refresh_config()
-            next_task_update = utcnow + datetime.timedelta(minutes=UPDATE_CONFIG_MINS)
-            _log(f"updated tasks, will run again at {next_task_update}")
-
-        # parallel updates from all running tasks
-        await asyncio.gather(
-            *[
-                bobsled.run.update_status(run.uuid, update_logs=True)
-                for run in running + pending
-            ]
-        )
-
-        # TODO: could improve by basing next run time on last run instead of using utcnow
-        for task_name, next_run in next_run_list.items():
-            if next_run <= utcnow:
-                # update next run time
-                next_run_list[task_name] = next_run_for_task(task)
-                try:
-                    task = await bobsled.storage.get_task(task_name)
-                    run = await bobsled.run.run_task(task)
-                    msg = f"started {task_name}: {run}.  next run at {next_run_list[task_name]}"
-                except AlreadyRunning:
-                    msg = f"{task_name}: already running.  next run at {next_run_list[task_name]}"
-                _log(msg)
-
-        await asyncio.sleep(60)
+    metrics_port = os.environ.get("BOBSLED_BEAT_METRICS_PORT")
+    if metrics_port:
+        await metrics.serve(int(metrics_port))
+        _log(f"serving metrics on port {metrics_port}")
+
+    scheduler = Scheduler()
+    scheduler.set_tasks(await bobsled.storage.get_tasks())
+    for task_name, next_run in scheduler.next_runs.items():
+        _log(f"{task_name} next run at {next_run}")
+
+    # each loop runs on its own timer so a slow poll never delays a start, and one
+    # that fails is restarted without taking the others down
+    loops = {
+        "schedule_runs": functools.partial(schedule_runs, scheduler, _log),
+        "poll_statuses": functools.partial(poll_statuses, _log),
+        "refresh_config": functools.partial(refresh_config, scheduler, _log),
+        "archive_runs": functools.partial(archive_runs, _log),
+        "watch": bobsled.run.watch,
+    }
+    await asyncio.gather(
+        *[run_forever(name, loop, _log) for name, loop in loops.items()]
+    )
 
 
 if __name__ == "__main__":
@@ -1,5 +1,4 @@
 import github3
-from ..base import Status
 
 
 class GithubIssueCallback:
@@ -28,17 +27,16 @@ class GithubIssueCallback:
 
     async def on_error(self, latest_run, storage):
         task = await storage.get_task(name=latest_run.task)
-        latest_runs = await storage.get_runs(task_name=latest_run.task, latest=5)
-        count = 0
-        for r in latest_runs:
-            if r.status == Status.Error:
-                count += 1
-            else:
-                break
+        # stats are recorded before callbacks run, so they include latest_run
+        stats = (await storage.get_task_stats([latest_run.task])).get(latest_run.task)
+        if not stats:
+            return
+        count = stats.failure_streak
 
         # if the number of failures is > threshold, and threshold is nonzero
         if count >= task.error_threshold > 0:
-            self.make_issue(latest_run, count, r)
+            first_failure = await storage.get_run(stats.first_failure) or latest_run
+            self.make_issue(latest_run, count, first_failure)
 
     def get_existing_issue(self, task_name):
         existing_issues = self.repo_obj.issues(labels=self.tags[0], state="open")
@@ -2,13 +2,18 @@ import os
 import asyncio
 from bobsled import storages, runners, callbacks
 from bobsled.environment import EnvironmentProvider
+from bobsled.limits import ConcurrencyLimits
+from bobsled.retention import RunRetention
 from bobsled.tasks import TaskProvider
 from bobsled.utils import get_env_config, load_args
 
 
 class Bobsled:
     def __init__(self):
-        self.settings = {"secret_key": os.environ.get("BOBSLED_SECRET_KEY", None)}
+        self.settings = {
+            "secret_key": os.environ.get("BOBSLED_SECRET_KEY", None),
+            "metrics_token": os.environ.get("BOBSLED_METRICS_TOKEN", None),
+        }
         if self.settings["secret_key"] is None:
             raise ValueError("must set 'secret_key' setting")
 
@@ -26,6 +31,8 @@ class Bobsled:
             CallbackCls = callbacks.GithubIssueCallback
             callback_classes.append(CallbackCls(**load_args(CallbackCls)))
 
+        limits = ConcurrencyLimits(**load_args(ConcurrencyLimits))
+
         self.storage = StorageCls(**storage_args)
         self.env = EnvironmentProvider(**env_args)
         self.tasks = TaskProvider(storage=self.storage, **task_args)
@@ -33,8 +40,10 @@ class Bobsled:
             storage=self.storage,
             environment=self.env,
             callbacks=callback_classes,
+            limits=limits if limits.enabled else None,
             **run_args,
         )
+        self.retention = RunRetention(storage=self.storage, **load_args(RunRetention))
 
     async def initialize(self):
         await self.storage.connect()
@@ -43,12 +52,12 @@ class Bobsled:
         if not tasks:
             await self.refresh_config()
         else:
-            self.run.initialize(tasks)
+            await self.run.initialize(tasks)
 
     async def refresh_config(self):
         await asyncio.gather(self.tasks.update_tasks(), self.env.update_environments())
         tasks = await self.storage.get_tasks()
-        self.run.initialize(tasks)
+        await self.run.initialize(tasks)
         return tasks
 
 
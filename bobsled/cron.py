@@ -0,0 +1,203 @@
+"""
+Cron schedules compiled to bitsets.
+
+Each of the five fields (minute, hour, day of month, month, day of week) is parsed
+once into an integer with bit N set if N is an allowed value, so finding the next
+fire time is a handful of bit scans rather than a search over candidate times.
+
+Supported syntax per field: *, ?, N, A-B, lists (A,B,C), and steps (*/N, A-B/N, A/N).
+Months & days of the week can also be given by name (JAN-DEC, MON-SUN).
+
+Days of the week follow Python's datetime.weekday(): 0 is Monday and 6 is Sunday.
+When both day of month and day of week are restricted a time must match both.
+"""
+import calendar
+import datetime
+import functools
+
+MONTH_NAMES = {
+    name: number
+    for number, name in enumerate(
+        "JAN FEB MAR APR MAY JUN JUL AUG SEP OCT NOV DEC".split(), 1
+    )
+}
+DOW_NAMES = {
+    name: number for number, name in enumerate("MON TUE WED THU FRI SAT SUN".split())
+}
+
+ALIASES = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 6",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+
+# (low, high, names) for minute, hour, day, month, day of week
+FIELDS = [
+    (0, 59, {}),
+    (0, 23, {}),
+    (1, 31, {}),
+    (1, 12, MONTH_NAMES),
+    (0, 6, DOW_NAMES),
+]
+
+# an impossible schedule (e.g. Feb 29th on a Monday, 2100) gives up after this long
+MAX_YEARS = 400
+
+# _WEEKLY[n] has every 7th day of the month set, starting with day n
+_WEEKLY = [sum(1 << d for d in range(n, 32, 7)) if n else 0 for n in range(8)]
+_ALL_DOW = (1 << 7) - 1
+
+
+def _next_bit(mask, n):
+    """smallest set bit in mask that is >= n, or -1"""
+    mask >>= n
+    if not mask:
+        return -1
+    return n + (mask & -mask).bit_length() - 1
+
+
+def _parse_value(value, names):
+    value = value.upper()
+    if value in names:
+        return names[value]
+    if not value.isdigit():
+        raise ValueError(value)
+    return int(value)
+
+
+def parse_field(segment, low, high, names=None):
+    """
+    parse one cron field into a bitset of allowed values
+    """
+    names = names or {}
+    mask = 0
+    for part in segment.split(","):
+        step = None
+        if "/" in part:
+            part, step = part.split("/", 1)
+            if not step.isdigit() or int(step) < 1:
+                raise ValueError(f"invalid step in {segment}")
+            step = int(step)
+
+        if part in ("*", "?"):
+            start, end = low, high
+        elif "-" in part:
+            start, end = part.split("-", 1)
+            start, end = _parse_value(start, names), _parse_value(end, names)
+        else:
+            start = _parse_value(part, names)
+            # A/N means every Nth value starting at A
+            end = high if step else start
+
+        if not low <= start <= end <= high:
+            raise ValueError(f"{segment} out of range {low}-{high}")
+        for n in range(start, end + 1, step or 1):
+            mask |= 1 << n
+    return mask
+
+
+class CronSchedule:
+    def __init__(self, cronstr):
+        self.cronstr = cronstr
+        fields = ALIASES.get(cronstr.strip().lower(), cronstr).split()
+        if len(fields) != 5:
+            raise ValueError(f"cron string must have five fields: {cronstr}")
+        (
+            self.minutes,
+            self.hours,
+            self.days,
+            self.months,
+            self.days_of_week,
+        ) = (parse_field(segment, *field) for segment, field in zip(fields, FIELDS))
+
+        # reject days that can never happen, e.g. 0 0 31 2 *
+        if not any(
+            self.days & ((1 << (calendar.monthrange(2000, month)[1] + 1)) - 1)
+            for month in range(1, 13)
+            if self.months & (1 << month)
+        ):
+            raise ValueError(f"{cronstr} never fires")
+
+    def __repr__(self):
+        return f"CronSchedule({self.cronstr!r})"
+
+    def _days_in_month(self, year, month):
+        first_weekday, num_days = calendar.monthrange(year, month)
+        days = self.days & ((1 << (num_days + 1)) - 1)
+        if self.days_of_week != _ALL_DOW:
+            dow_days = 0
+            for weekday in range(7):
+                if self.days_of_week & (1 << weekday):
+                    dow_days |= _WEEKLY[(weekday - first_weekday) % 7 + 1]
+            days &= dow_days
+        return days
+
+    def next_fire(self, after=None):
+        """
+        the first time strictly after 'after' (default: now) that the schedule fires
+        """
+        if not after:
+            after = datetime.datetime.utcnow()
+        start = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        year, month, day, hour, minute = (
+            start.year,
+            start.month,
+            start.day,
+            start.hour,
+            start.minute,
+        )
+
+        # each time a field runs out of values, carry into the next larger field
+        # and reset the smaller ones, an out of range value just carries again
+        while year < start.year + MAX_YEARS:
+            next_month = _next_bit(self.months, month)
+            if next_month == -1:
+                year, month, day, hour, minute = year + 1, 1, 1, 0, 0
+                continue
+            if next_month != month:
+                month, day, hour, minute = next_month, 1, 0, 0
+
+            next_day = _next_bit(self._days_in_month(year, month), day)
+            if next_day == -1:
+                month, day, hour, minute = month + 1, 1, 0, 0
+                continue
+            if next_day != day:
+                day, hour, minute = next_day, 0, 0
+
+            next_hour = _next_bit(self.hours, hour)
+            if next_hour == -1:
+                day, hour, minute = day + 1, 0, 0
+                continue
+            if next_hour != hour:
+                hour, minute = next_hour, 0
+
+            next_minute = _next_bit(self.minutes, minute)
+            if next_minute == -1:
+                hour, minute = hour + 1, 0
+                continue
+
+            return datetime.datetime(
+                year, month, day, hour, next_minute, tzinfo=after.tzinfo
+            )
+        return None
+
+    def fire_times(self, start, end):
+        """
+        iterate over every fire time after start, up to and including end
+        """
+        fire_time = self.next_fire(start)
+        while fire_time is not None and fire_time <= end:
+            yield fire_time
+            fire_time = self.next_fire(fire_time)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_cron(cronstr):
+    """
+    compile a cron string, schedules are cached since many tasks share a few crons
+    """
+    return CronSchedule(cronstr)
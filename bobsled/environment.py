@@ -1,6 +1,10 @@
-import boto3
+import re
+import time
+import asyncio
+from . import aws
 from .base import Environment
-from .utils import load_github_or_local_yaml
+from .tracing import traced_methods
+from .utils import YamlLoader
 
 """
 Format of environment file:
@@ -14,12 +18,108 @@ Format of environment file:
 """
 
 
-def paramstore_loader(varname):
-    ssm = boto3.client("ssm")
-    resp = ssm.get_parameter(Name=varname, WithDecryption=True)
-    return resp["Parameter"]["Value"]
+# the text being masked can contain secrets
+@traced_methods(hide_args=True)
+class SecretMasker:
+    """
+    Replaces secret values with placeholders in a single pass over the text.
 
+    Secrets are combined into one regex, longest first so that a secret which contains
+    another secret is masked as a whole.
+    """
 
+    def __init__(self, replacements):
+        self.replacements = replacements
+        secrets = sorted(replacements, key=len, reverse=True)
+        if secrets:
+            self.pattern = re.compile("|".join(re.escape(s) for s in secrets))
+            self.max_length = len(secrets[0])
+        else:
+            self.pattern = None
+            self.max_length = 0
+
+    def _replace(self, match):
+        return self.replacements[match.group(0)]
+
+    def mask(self, text):
+        if not self.pattern:
+            return text
+        return self.pattern.sub(self._replace, text)
+
+    def mask_prefix(self, text):
+        """
+        mask as much of text as can be masked without knowing what follows it
+
+        returns (masked, consumed), text[consumed:] could be the start of a secret and
+        should be passed in again once more text is available
+        """
+        if not self.pattern:
+            return text, len(text)
+        # any secret starting before this point lies entirely within text
+        safe = len(text) - self.max_length + 1
+        pieces = []
+        pos = 0
+        for match in self.pattern.finditer(text):
+            if match.start() >= safe:
+                break
+            pieces.append(text[pos:match.start()])
+            pieces.append(self._replace(match))
+            pos = match.end()
+        consumed = max(pos, safe)
+        pieces.append(text[pos:consumed])
+        return "".join(pieces), consumed
+
+
+class StreamMasker:
+    """
+    Masks text that arrives in chunks, holding back the tail of each chunk until it
+    is known not to be the start of a secret.
+    """
+
+    def __init__(self, masker):
+        self.masker = masker
+        self.pending = ""
+
+    def feed(self, chunk):
+        text = self.pending + chunk
+        masked, consumed = self.masker.mask_prefix(text)
+        self.pending = text[consumed:]
+        return masked
+
+    def flush(self):
+        text, self.pending = self.pending, ""
+        return self.masker.mask(text)
+
+
+# get_parameters accepts at most 10 names per call
+PARAMSTORE_BATCH_SIZE = 10
+
+
+async def load_parameters(names):
+    """
+    fetch (decrypted) values for the given Parameter Store names, batches are
+    requested concurrently
+    """
+    batches = [
+        names[i:i + PARAMSTORE_BATCH_SIZE]
+        for i in range(0, len(names), PARAMSTORE_BATCH_SIZE)
+    ]
+    responses = await asyncio.gather(
+        *[
+            aws.call("ssm", "get_parameters", Names=batch, WithDecryption=True)
+            for batch in batches
+        ]
+    )
+    values = {}
+    for resp in responses:
+        if resp["InvalidParameters"]:
+            raise ValueError(f"missing parameters: {resp['InvalidParameters']}")
+        for param in resp["Parameters"]:
+            values[param["Name"]] = param["Value"]
+    return values
+
+
+@traced_methods(hide_args=True)
 class EnvironmentProvider:
     def __init__(
         self,
@@ -28,6 +128,7 @@ class EnvironmentProvider:
         BOBSLED_CONFIG_GITHUB_USER=None,
         BOBSLED_CONFIG_GITHUB_REPO=None,
         BOBSLED_GITHUB_API_KEY=None,
+        BOBSLED_PARAMSTORE_TTL_SECONDS="900",
     ):
         self.filename = BOBSLED_ENVIRONMENT_FILENAME
         self.dirname = BOBSLED_ENVIRONMENT_DIRNAME
@@ -35,6 +136,12 @@ class EnvironmentProvider:
         self.github_repo = BOBSLED_CONFIG_GITHUB_REPO
         self.github_api_key = BOBSLED_GITHUB_API_KEY
         self.environments = {}
+        self.masker = SecretMasker({})
+        self.paramstore_ttl = int(BOBSLED_PARAMSTORE_TTL_SECONDS)
+        # paramstore name => (value, monotonic time it expires)
+        self.paramstore_cache = {}
+        self._loader = None
+        self._data = {}
 
         if not self.filename and not self.dirname:
             raise EnvironmentError(
@@ -42,14 +149,24 @@ class EnvironmentProvider:
             )
 
     def mask_variables(self, string):
-        for env_name in self.get_environment_names():
-            env = self.get_environment(env_name)
+        return self.masker.mask(string)
+
+    def mask_stream(self):
+        """
+        get a StreamMasker for masking output that is read a chunk at a time
+        """
+        return StreamMasker(self.masker)
+
+    def _build_masker(self):
+        replacements = {}
+        for env_name, env in self.environments.items():
             for var, value in env.values.items():
-                if var not in env.unmasked:
-                    string = string.replace(
-                        str(value), f"**{env_name.upper()}/{var.upper()}**"
+                value = str(value)
+                if var not in env.unmasked and value:
+                    replacements.setdefault(
+                        value, f"**{env_name.upper()}/{var.upper()}**"
                     )
-        return string
+        return SecretMasker(replacements)
 
     def get_environment_names(self):
         return list(self.environments.keys())
@@ -57,14 +174,57 @@ class EnvironmentProvider:
     def get_environment(self, name):
         return self.environments[name]
 
-    async def update_environments(self):
-        data = load_github_or_local_yaml(
+    async def _load_paramstore(self, names):
+        """
+        get values for paramstore names, only fetching those not cached or expired
+        """
+        now = time.monotonic()
+        expired = sorted(
+            name
+            for name in set(names)
+            if name not in self.paramstore_cache or self.paramstore_cache[name][1] < now
+        )
+        if expired:
+            fetched = await load_parameters(expired)
+            expires = time.monotonic() + self.paramstore_ttl
+            for name, value in fetched.items():
+                self.paramstore_cache[name] = (value, expires)
+        return {name: self.paramstore_cache[name][0] for name in names}
+
+    @property
+    def loader(self):
+        # rebuilt if the source is changed after creation
+        if not self._loader or (self._loader.filename, self._loader.dirname) != (
             self.filename,
             self.dirname,
-            self.github_user,
-            self.github_repo,
-            self.github_api_key,
-        )
+        ):
+            self._loader = YamlLoader(
+                self.filename,
+                self.dirname,
+                self.github_user,
+                self.github_repo,
+                self.github_api_key,
+            )
+        return self._loader
+
+    async def update_environments(self):
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, self.loader.load)
+        if data is None:
+            # unchanged config, but paramstore values may still have expired
+            data = self._data
+        self._data = data
+
+        names = [
+            env_var["paramstore"]
+            for envdef in data.values()
+            for env_var in envdef
+            if "string" not in env_var and "paramstore" in env_var
+        ]
+        # values no longer in the config are dropped, rather than kept until expired
+        for name in set(self.paramstore_cache) - set(names):
+            del self.paramstore_cache[name]
+        paramstore = await self._load_paramstore(names)
 
         for name, envdef in data.items():
             values = {}
@@ -73,9 +233,7 @@ class EnvironmentProvider:
                 if "string" in env_var:
                     values[env_var["variable"]] = env_var["string"]
                 elif "paramstore" in env_var:
-                    values[env_var["variable"]] = paramstore_loader(
-                        env_var["paramstore"]
-                    )
+                    values[env_var["variable"]] = paramstore[env_var["paramstore"]]
                 else:
                     raise ValueError(
                         f"{name}.{env_var['variable']} must include 'string' or 'paramstore'"
@@ -83,3 +241,8 @@ class EnvironmentProvider:
                 if not env_var.get("masked", True):
                     unmasked.append(env_var["variable"])
             self.environments[name] = Environment(name, values, unmasked)
+        # a removed environment shouldn't resolve, or have its values masked
+        for name in set(self.environments) - set(data):
+            del self.environments[name]
+
+        self.masker = self._build_masker()
@@ -0,0 +1,73 @@
+class ConcurrencyLimits:
+    """
+    Caps on how many runs can be active at once.
+
+    Any of these can be left unset:
+        BOBSLED_MAX_RUNS: total number of active runs
+        BOBSLED_TAG_LIMITS: per-tag caps, e.g. "scraper=20,heavy=2"
+        BOBSLED_CPU_BUDGET: sum of Task.cpu across active runs
+        BOBSLED_MEMORY_BUDGET: sum of Task.memory across active runs
+
+    A task that needs more cpu or memory than the entire budget is still allowed to
+    run, but only when nothing else is active.
+
+    Queued runs that don't fit are passed over by smaller runs behind them for at
+    most BOBSLED_QUEUE_SKIP_SECONDS (default 600), after that the queue waits for
+    them so they can't be starved.
+    """
+
+    def __init__(
+        self,
+        BOBSLED_MAX_RUNS=None,
+        BOBSLED_TAG_LIMITS=None,
+        BOBSLED_CPU_BUDGET=None,
+        BOBSLED_MEMORY_BUDGET=None,
+        BOBSLED_QUEUE_SKIP_SECONDS=None,
+    ):
+        self.max_runs = _optional_int(BOBSLED_MAX_RUNS)
+        self.cpu_budget = _optional_int(BOBSLED_CPU_BUDGET)
+        self.memory_budget = _optional_int(BOBSLED_MEMORY_BUDGET)
+        self.queue_skip_seconds = _optional_int(BOBSLED_QUEUE_SKIP_SECONDS)
+        if self.queue_skip_seconds is None:
+            self.queue_skip_seconds = 600
+        self.tag_limits = {}
+        if BOBSLED_TAG_LIMITS:
+            for pair in BOBSLED_TAG_LIMITS.split(","):
+                tag, limit = pair.split("=")
+                self.tag_limits[tag.strip()] = int(limit)
+
+    @property
+    def enabled(self):
+        return bool(
+            self.max_runs is not None
+            or self.tag_limits
+            or self.cpu_budget is not None
+            or self.memory_budget is not None
+        )
+
+    def allows(self, task, active_tasks):
+        """
+        whether task can start while the tasks in active_tasks are running
+        """
+        if self.max_runs is not None and len(active_tasks) >= self.max_runs:
+            return False
+        for tag in task.tags:
+            limit = self.tag_limits.get(tag)
+            if limit is not None:
+                if sum(1 for t in active_tasks if tag in t.tags) >= limit:
+                    return False
+        if active_tasks:
+            if self.cpu_budget is not None:
+                if sum(t.cpu for t in active_tasks) + task.cpu > self.cpu_budget:
+                    return False
+            if self.memory_budget is not None:
+                if (
+                    sum(t.memory for t in active_tasks) + task.memory
+                    > self.memory_budget
+                ):
+                    return False
+        return True
+
+
+def _optional_int(value):
+    return int(value) if value else None
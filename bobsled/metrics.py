@@ -0,0 +1,316 @@
+"""
+Counters, gauges and histograms, rendered in the Prometheus text format.
+
+Metrics are updated from the event loop, so nothing is locked.  Each combination
+of label values gets its own child, created on first use and kept in a dict, so an
+update is a dict lookup plus an addition (a bisect too for histograms).
+"""
+import asyncio
+import bisect
+import functools
+import inspect
+import math
+import time
+
+# in seconds, from a fast storage query to a slow ECS call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+# seconds a scraper has to send its request
+SCRAPE_READ_TIMEOUT = 10
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # per bucket, made cumulative when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Metric:
+    type = None
+    child_class = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._default = self._children[()] = self._new_child()
+
+    def _new_child(self):
+        return self.child_class()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _samples(self):
+        for values, child in sorted(self._children.items()):
+            yield "", _format_labels(self.labelnames, values), child.value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {_escape(self.documentation)}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type = "counter"
+    child_class = _CounterChild
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    type = "gauge"
+    child_class = _GaugeChild
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def _samples(self):
+        for values, child in sorted(self._children.items()):
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                total += count
+                le = 'le="' + _format_value(float(bound)) + '"'
+                yield "_bucket", _format_labels(self.labelnames, values, le), total
+            labels = _format_labels(self.labelnames, values)
+            yield "_sum", labels, child.sum
+            yield "_count", labels, total
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"{metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        return "".join(metric.render() + "\n" for metric in self.metrics.values())
+
+
+def timed(histogram, *labelvalues):
+    """
+    decorator that observes how long each call of a coroutine function takes
+    """
+
+    def decorator(func):
+        child = histogram.labels(*labelvalues)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+def timed_methods(histogram, *labelvalues):
+    """
+    class decorator that times every public coroutine method, the method name is
+    the last label
+    """
+
+    def decorator(cls):
+        for name, func in list(vars(cls).items()):
+            if not name.startswith("_") and inspect.iscoroutinefunction(func):
+                setattr(cls, name, timed(histogram, *labelvalues, name)(func))
+        return cls
+
+    return decorator
+
+
+async def _read_request(reader):
+    request = await reader.readline()
+    # skip the headers, nothing in them matters
+    while (await reader.readline()).strip():
+        pass
+    return request
+
+
+async def _handle_scrape(reader, writer):
+    try:
+        # a client that never finishes its request doesn't hold the connection open
+        request = await asyncio.wait_for(_read_request(reader), SCRAPE_READ_TIMEOUT)
+        parts = request.split()
+        if len(parts) > 1 and parts[0] == b"GET" and parts[1] == b"/metrics":
+            status, content_type, body = "200 OK", CONTENT_TYPE, REGISTRY.render()
+        else:
+            status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+        body = body.encode()
+        writer.write(
+            f"HTTP/1.0 {status}\r\nContent-Type: {content_type}; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # timeouts, disconnects, lines too long, none of which the server should see
+        print(f"metrics scrape failed: {e!r}")
+    finally:
+        writer.close()
+
+
+async def serve(port, host="0.0.0.0"):
+    """
+    serve GET /metrics for processes without a web server of their own
+    """
+    return await asyncio.start_server(_handle_scrape, host, port)
+
+
+REGISTRY = Registry()
+
+BEAT_LOOP_SECONDS = REGISTRY.histogram(
+    "bobsled_beat_loop_seconds",
+    "Time taken by each pass of a beat loop.",
+    ["loop"],
+)
+BEAT_TASK_STARTS = REGISTRY.counter(
+    "bobsled_beat_task_starts_total",
+    "Scheduled task starts, by whether a run was started.",
+    ["result"],
+)
+BEAT_SCHEDULED_TASKS = REGISTRY.gauge(
+    "bobsled_beat_scheduled_tasks", "Tasks with an upcoming scheduled run."
+)
+ACTIVE_RUNS = REGISTRY.gauge(
+    "bobsled_active_runs", "Unfinished runs as of the last status poll.", ["state"]
+)
+RUNNER_SECONDS = REGISTRY.histogram(
+    "bobsled_runner_seconds", "Time taken by run service operations.", ["operation"]
+)
+RUNS_STARTED = REGISTRY.counter("bobsled_runs_started_total", "Runs started.")
+RUNS_FINISHED = REGISTRY.counter(
+    "bobsled_runs_finished_total", "Runs finished, by status.", ["status"]
+)
+AWS_CALL_SECONDS = REGISTRY.histogram(
+    "bobsled_aws_call_seconds", "Time taken by AWS API calls.", ["service", "method"]
+)
+DOCKER_CALL_SECONDS = REGISTRY.histogram(
+    "bobsled_docker_call_seconds", "Time taken by Docker API calls.", ["method"]
+)
+STORAGE_SECONDS = REGISTRY.histogram(
+    "bobsled_storage_seconds",
+    "Time taken by storage methods.",
+    ["storage", "method"],
+)
+CALLBACK_SECONDS = REGISTRY.histogram(
+    "bobsled_callback_seconds",
+    "Time taken by run callbacks.",
+    ["callback", "event"],
+)
@@ -0,0 +1,141 @@
+"""
+In-process fan out of messages to many subscribers.
+
+Every subscriber gets its own bounded queue, so one slow websocket can't hold up
+the others or grow without bound: when its queue is full the oldest message is
+dropped to make room for the newest.
+"""
+import asyncio
+import collections
+import contextlib
+import traceback
+
+# marks the end of a topic, subscribers stop iterating when they see it
+_CLOSED = object()
+
+
+class Subscription:
+    def __init__(self, maxsize):
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+        self.state = None
+
+    def put(self, message):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.get()
+        if message is _CLOSED:
+            raise StopAsyncIteration
+        return message
+
+
+class Topic:
+    """
+    messages published to a topic go to every current subscriber, the last
+    'history' messages are also replayed to anyone who subscribes later
+    """
+
+    def __init__(self, maxsize=10, history=1):
+        self.maxsize = maxsize
+        self.subscribers = set()
+        self.history = collections.deque(maxlen=history)
+        self.closed = False
+
+    def subscribe(self):
+        subscription = Subscription(self.maxsize)
+        for message in self.history:
+            subscription.put(message)
+        if self.closed:
+            subscription.put(_CLOSED)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
+
+    def publish(self, message):
+        self.history.append(message)
+        for subscription in self.subscribers:
+            subscription.put(message)
+
+    def close(self):
+        self.closed = True
+        for subscription in self.subscribers:
+            subscription.put(_CLOSED)
+
+
+class PollingPublisher:
+    """
+    one poller per key, shared by everyone subscribed to that key
+
+    poll(key, state) is awaited every 'interval' seconds while there are subscribers
+    and returns (message, done).  A message of None isn't published.  Once done is
+    true that message is the last one, the topic is closed and the poller exits.
+    The poller is also stopped as soon as its last subscriber leaves.  A poll that
+    fails is logged and tried again after the interval.
+
+    state is a dict that lives as long as the poller, so a poll can publish only
+    what changed since the last one.  Subscribers see the same dict as
+    subscription.state, e.g. to catch up before reading the updates.
+    """
+
+    def __init__(self, poll, interval=1, maxsize=10, history=1):
+        self.poll = poll
+        self.interval = interval
+        self.maxsize = maxsize
+        self.history = history
+        self.topics = {}
+        self.pollers = {}
+        self.states = {}
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self, key):
+        if key not in self.topics:
+            topic = self.topics[key] = Topic(self.maxsize, self.history)
+            state = self.states[key] = {}
+            self.pollers[key] = asyncio.ensure_future(
+                self._run_poller(key, topic, state)
+            )
+        topic = self.topics[key]
+        subscription = topic.subscribe()
+        subscription.state = self.states[key]
+        try:
+            yield subscription
+        finally:
+            topic.unsubscribe(subscription)
+            if not topic.subscribers and self.topics.get(key) is topic:
+                self.pollers.pop(key).cancel()
+                del self.topics[key]
+                del self.states[key]
+
+    async def _run_poller(self, key, topic, state):
+        try:
+            while True:
+                try:
+                    message, done = await self.poll(key, state)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    print(f"poll of {key} failed\n{traceback.format_exc()}")
+                    message, done = None, False
+                if message is not None:
+                    topic.publish(message)
+                if done:
+                    break
+                await asyncio.sleep(self.interval)
+        finally:
+            topic.close()
+            if self.topics.get(key) is topic:
+                del self.topics[key]
+                del self.pollers[key]
+                del self.states[key]
@@ -0,0 +1,277 @@
+"""
+Retention of old runs.
+
+Each task has a RetentionPolicy: how many days to keep the logs of its runs and
+how many days to keep the runs themselves.  When a finished run's logs expire it
+is written, logs and all, to a gzip'd JSON lines file in the archive directory and
+its logs are deleted from storage.  When the run itself expires it is deleted from
+storage too.  Archived runs can be read back with get_archived_run.
+"""
+import asyncio
+import datetime
+import gzip
+import json
+import os
+import uuid
+import attr
+from .base import Run, Status, Task
+
+# runs per archive file, also how many runs are read from storage at a time
+ARCHIVE_BATCH_SIZE = 500
+INDEX_FILENAME = "index.jsonl"
+
+
+def _optional_int(value):
+    return int(value) if value else None
+
+
+def _longest(a, b):
+    # None means forever
+    if a is None or b is None:
+        return None
+    return max(a, b)
+
+
+@attr.s(auto_attribs=True)
+class RetentionPolicy:
+    logs_days: int = None
+    runs_days: int = None
+
+    @classmethod
+    def parse(cls, value):
+        """
+        parse 'logs_days:runs_days', either can be left blank to keep forever
+        """
+        logs_days, _, runs_days = value.partition(":")
+        return cls(_optional_int(logs_days), _optional_int(runs_days))
+
+    @property
+    def archive_days(self):
+        """runs are archived as soon as either their logs or the run expires"""
+        days = [d for d in (self.logs_days, self.runs_days) if d is not None]
+        return min(days) if days else None
+
+    def merge(self, other):
+        """the longer retention of each part of two policies"""
+        return RetentionPolicy(
+            _longest(self.logs_days, other.logs_days),
+            _longest(self.runs_days, other.runs_days),
+        )
+
+
+def _parse_policies(value):
+    policies = {}
+    if value:
+        for pair in value.split(","):
+            name, policy = pair.split("=")
+            policies[name.strip()] = RetentionPolicy.parse(policy.strip())
+    return policies
+
+
+def _run_to_json(run, logs):
+    data = attr.asdict(run)
+    data["status"] = run.status.name
+    data["logs"] = logs
+    return data
+
+
+def _json_to_run(data):
+    data["status"] = Status[data["status"]]
+    return Run(**data)
+
+
+class _ArchiveFile:
+    """
+    an archive file being written, it is only added to the index once complete
+    """
+
+    def __init__(self, dirname):
+        os.makedirs(dirname, exist_ok=True)
+        self.dirname = dirname
+        now = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        self.name = f"runs-{now}-{uuid.uuid4().hex[:8]}.jsonl.gz"
+        self.path = os.path.join(dirname, self.name)
+        self.file = gzip.open(self.path + ".tmp", "wt")
+        self.runs = []
+
+    def write(self, run, logs):
+        self.file.write(json.dumps(_run_to_json(run, logs)) + "\n")
+        self.runs.append(run)
+
+    def close(self):
+        self.file.close()
+        os.rename(self.path + ".tmp", self.path)
+        with open(os.path.join(self.dirname, INDEX_FILENAME), "a") as index:
+            for run in self.runs:
+                entry = {
+                    "uuid": run.uuid,
+                    "task": run.task,
+                    "start": run.start,
+                    "file": self.name,
+                }
+                index.write(json.dumps(entry) + "\n")
+
+
+class RunArchive:
+    """
+    a directory of gzip'd JSON lines files with one archived run per line, and an
+    index (also JSON lines) of which file each run is in
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self._index = {}
+        self._index_version = None
+
+    def open(self):
+        return _ArchiveFile(self.dirname)
+
+    def _load_index(self):
+        path = os.path.join(self.dirname, INDEX_FILENAME)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return {}
+        # the index is only appended to, so it only needs reading when it grows
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version != self._index_version:
+            index = {}
+            with open(path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    index[entry["uuid"]] = entry["file"]
+            self._index, self._index_version = index, version
+        return self._index
+
+    def get(self, run_id):
+        filename = self._load_index().get(run_id)
+        if not filename:
+            return None
+        # cheap check before parsing, lines can hold an entire log
+        marker = json.dumps({"uuid": run_id})[1:-1]
+        with gzip.open(os.path.join(self.dirname, filename), "rt") as f:
+            for line in f:
+                if marker in line:
+                    data = json.loads(line)
+                    if data["uuid"] == run_id:
+                        return _json_to_run(data)
+        return None
+
+
+class RunRetention:
+    """
+    How long runs are kept in storage, retention is off unless an archive directory
+    is set.
+
+        BOBSLED_ARCHIVE_DIR: where expired runs are archived to
+        BOBSLED_RETENTION: default policy as logs_days:runs_days, e.g. "30:365"
+        BOBSLED_TAG_RETENTION: per-tag policies, e.g. "scraper=7:90,nightly=30:"
+        BOBSLED_TASK_RETENTION: per-task policies, e.g. "hello-world=1:7"
+
+    Leaving out either number keeps that forever.  A task's own policy takes
+    precedence, next are those of its tags (the longest of each if several match).
+    """
+
+    def __init__(
+        self,
+        storage,
+        BOBSLED_ARCHIVE_DIR=None,
+        BOBSLED_RETENTION=None,
+        BOBSLED_TAG_RETENTION=None,
+        BOBSLED_TASK_RETENTION=None,
+    ):
+        self.storage = storage
+        self.archive = RunArchive(BOBSLED_ARCHIVE_DIR) if BOBSLED_ARCHIVE_DIR else None
+        self.default_policy = RetentionPolicy.parse(BOBSLED_RETENTION or "")
+        self.tag_policies = _parse_policies(BOBSLED_TAG_RETENTION)
+        self.task_policies = _parse_policies(BOBSLED_TASK_RETENTION)
+
+    @property
+    def enabled(self):
+        return self.archive is not None
+
+    def policy_for(self, task):
+        if task.name in self.task_policies:
+            return self.task_policies[task.name]
+        policy = None
+        for tag in task.tags:
+            tag_policy = self.tag_policies.get(tag)
+            if tag_policy:
+                policy = policy.merge(tag_policy) if policy else tag_policy
+        return policy or self.default_policy
+
+    async def archive_expired(self, tasks, now=None):
+        """
+        archive runs that are past their policy & delete those past keeping at all
+
+        Runs of tasks no longer in tasks are covered too, by the policy for their
+        name or the default policy.
+
+        Returns (number archived, number deleted).
+        """
+        if not self.enabled:
+            return 0, 0
+        configured = {task.name for task in tasks}
+        removed = [
+            Task(name, "")
+            for name in await self.storage.get_run_task_names()
+            if name not in configured
+        ]
+        if not now:
+            now = datetime.datetime.utcnow()
+        loop = asyncio.get_running_loop()
+        archive_file = None
+        archived = 0
+        deletions = []
+
+        async def flush():
+            nonlocal archive_file, archived
+            await loop.run_in_executor(None, archive_file.close)
+            await self.storage.mark_archived(archive_file.runs, archive_file.name)
+            archived += len(archive_file.runs)
+            archive_file = None
+
+        for task in list(tasks) + removed:
+            policy = self.policy_for(task)
+            if policy.archive_days is None:
+                continue
+            before = now - datetime.timedelta(days=policy.archive_days)
+            while True:
+                runs = await self.storage.get_runs_to_archive(
+                    task.name, before, ARCHIVE_BATCH_SIZE
+                )
+                # one run's logs in memory at a time
+                for run in runs:
+                    if not archive_file:
+                        archive_file = await loop.run_in_executor(
+                            None, self.archive.open
+                        )
+                    logs = await self.storage.get_logs(run.uuid)
+                    await loop.run_in_executor(None, archive_file.write, run, logs)
+                    if len(archive_file.runs) >= ARCHIVE_BATCH_SIZE:
+                        await flush()
+                if len(runs) < ARCHIVE_BATCH_SIZE:
+                    break
+                # there may be more, which can't be told apart until these are marked
+                if archive_file:
+                    await flush()
+            if policy.runs_days is not None:
+                deletions.append(
+                    (task.name, now - datetime.timedelta(days=policy.runs_days))
+                )
+
+        if archive_file:
+            await flush()
+        deleted = 0
+        for task_name, before in deletions:
+            deleted += await self.storage.delete_archived_runs(task_name, before)
+        return archived, deleted
+
+    async def get_archived_run(self, run_id):
+        """
+        full copy of an archived run, logs included, or None if it isn't archived
+        """
+        if not self.enabled:
+            return None
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.archive.get, run_id)
@@ -1,18 +1,36 @@
+import json
+import asyncio
 import datetime
-import boto3
+import hashlib
 from botocore.exceptions import ClientError
+from .. import aws
 from ..base import RunService, Status
+from ..metrics import RUNNER_SECONDS, timed
+
+FINGERPRINT_TAG = "bobsled-fingerprint"
+FINGERPRINTS_SETTING = "ecs_task_definition_fingerprints"
+
+
+def _fingerprint(definition):
+    """
+    stable hash of a task definition, used to tell if it needs to be registered again
+    """
+    serialized = json.dumps(definition, sort_keys=True).encode()
+    return hashlib.sha256(serialized).hexdigest()
 
 
 class ECSRunService(RunService):
 
     STARTING_STATUS = Status.Pending
+    DESCRIBE_TASKS_BATCH_SIZE = 100
+    INITIALIZE_CONCURRENCY = 10
 
     def __init__(
         self,
         storage,
         environment,
         callbacks=None,
+        limits=None,
         *,
         BOBSLED_ECS_CLUSTER,
         BOBSLED_SUBNET_ID,
@@ -23,30 +41,52 @@ class ECSRunService(RunService):
         self.storage = storage
         self.environment = environment
         self.callbacks = callbacks or []
+        self.limits = limits
         self.cluster_name = BOBSLED_ECS_CLUSTER
         self.subnet_id = BOBSLED_SUBNET_ID
         self.security_group_id = BOBSLED_SECURITY_GROUP_ID
         self.log_group = BOBSLED_LOG_GROUP
         self.role_arn = BOBSLED_ROLE_ARN
-        self.ecs = boto3.client("ecs")
 
-        self.cluster_arn = self.ecs.describe_clusters(clusters=[self.cluster_name])[
-            "clusters"
-        ][0]["clusterArn"]
+        # from the client's config, this doesn't call AWS
+        self.region = aws.get_client("ecs").meta.region_name
+        # looked up by initialize
+        self.cluster_arn = None
+
+    async def initialize(self, tasks):
+        """
+        make sure every task has an up to date task definition
+
+        the fingerprint of each definition registered is kept in storage, so that only
+        tasks which changed since the last sync need any ECS calls at all
+        """
+        if not self.cluster_arn:
+            resp = await aws.call(
+                "ecs", "describe_clusters", clusters=[self.cluster_name]
+            )
+            self.cluster_arn = resp["clusters"][0]["clusterArn"]
+
+        fingerprints = await self.storage.get_setting(FINGERPRINTS_SETTING) or {}
+        semaphore = asyncio.Semaphore(self.INITIALIZE_CONCURRENCY)
+
+        async def sync(task):
+            async with semaphore:
+                return await self._register_task(task, fingerprints.get(task.name))
 
-    def initialize(self, tasks):
-        for task in tasks:
-            self._register_task(task)
-            # self._make_cron_rule(task)
+        results = await asyncio.gather(*[sync(task) for task in tasks])
+        new_fingerprints = {task.name: fp for task, fp in zip(tasks, results)}
+        if new_fingerprints != fingerprints:
+            await self.storage.set_setting(FINGERPRINTS_SETTING, new_fingerprints)
+        # for task in tasks:
+        #     await self._make_cron_rule(task)
 
-    def _register_task(self, task):
-        region = self.ecs.meta.region_name
+    def _task_definition(self, task):
         log_stream_prefix = task.name.lower()
 
         env_list = []
         if task.environment:
             env = self.environment.get_environment(task.environment)
-            env_list = [{"name": k, "value": v} for k, v in env.values.items()]
+            env_list = [{"name": k, "value": v} for k, v in sorted(env.values.items())]
 
         main_container = {
             "name": task.name,
@@ -57,83 +97,61 @@ class ECSRunService(RunService):
                 "logDriver": "awslogs",
                 "options": {
                     "awslogs-group": self.log_group,
-                    "awslogs-region": region,
+                    "awslogs-region": self.region,
                     "awslogs-stream-prefix": log_stream_prefix,
                 },
             },
             "environment": env_list,
         }
+        return {
+            "family": task.name,
+            "containerDefinitions": [main_container],
+            "cpu": str(task.cpu),
+            "memory": str(task.memory),
+            "networkMode": "awsvpc",
+            "executionRoleArn": self.role_arn,
+            "requiresCompatibilities": ["FARGATE"],
+        }
 
-        # add env to main_container
-        create = False
-        existing = None
-        try:
-            resp = self.ecs.describe_task_definition(taskDefinition=task.name)
-            existing = resp["taskDefinition"]
-
-            if str(task.memory) != existing["memory"]:
-                print(
-                    "{}: changing memory: {} => {}".format(
-                        task.name, existing["memory"], task.memory
-                    )
-                )
-                create = True
-            if str(task.cpu) != existing["cpu"]:
-                print(
-                    "{}: changing cpu: {} => {}".format(
-                        task.name, existing["cpu"], task.cpu
-                    )
-                )
-                create = True
-
-            for key in (
-                "entryPoint",
-                "environment",
-                "image",
-                "name",
-                "essential",
-                "logConfiguration",
-            ):
-
-                # check if values differ for this key
-                oldval = existing["containerDefinitions"][0][key]
-                newval = main_container[key]
-                if key == "environment":
-                    s_oldval = sorted([tuple(i.items()) for i in oldval])
-                    s_newval = sorted([tuple(i.items()) for i in newval])
-                    differ = s_oldval != s_newval
-                else:
-                    differ = oldval != newval
-
-                if differ:
-                    create = True
-                    print(f"{task.name}: changing {key}: {oldval} => {newval}")
-        except ClientError:
-            create = True
+    async def _register_task(self, task, fingerprint=None):
+        """
+        register a new task definition revision if the task changed
 
-        # if force and not create:
-        #     print(f'{task.name}: forced update')
-        #     create = True
+        fingerprint is the last one known to be registered, when it matches no ECS
+        calls are made, otherwise the fingerprint tag on the current revision is
+        checked before registering, returns the task's current fingerprint
+        """
+        definition = self._task_definition(task)
+        new_fingerprint = _fingerprint(definition)
+        if new_fingerprint == fingerprint:
+            return new_fingerprint
 
-        if create:
-            response = self.ecs.register_task_definition(
-                family=task.name,
-                containerDefinitions=[main_container],
-                cpu=str(task.cpu),
-                memory=str(task.memory),
-                networkMode="awsvpc",
-                executionRoleArn=self.role_arn,
-                requiresCompatibilities=["FARGATE"],
+        try:
+            resp = await aws.call(
+                "ecs",
+                "describe_task_definition",
+                taskDefinition=task.name,
+                include=["TAGS"],
             )
-            return response
-        elif existing:
-            pass
-            # print(f'{task.name}: definition matches {task.name}:{existing["revision"]}')
-        else:
+            tags = {tag["key"]: tag["value"] for tag in resp.get("tags", [])}
+            if tags.get(FINGERPRINT_TAG) == new_fingerprint:
+                return new_fingerprint
+            print(f"{task.name}: updating task definition")
+        except ClientError:
             print(f"{task.name}: creating new task")
 
-    def start_task(self, task):
-        resp = self.ecs.run_task(
+        await aws.call(
+            "ecs",
+            "register_task_definition",
+            tags=[{"key": FINGERPRINT_TAG, "value": new_fingerprint}],
+            **definition,
+        )
+        return new_fingerprint
+
+    async def start_task(self, task):
+        resp = await aws.call(
+            "ecs",
+            "run_task",
             cluster=self.cluster_name,
             count=1,
             taskDefinition=task.name,
@@ -150,23 +168,78 @@ class ECSRunService(RunService):
         )
         return {"task_arn": resp["tasks"][0]["taskArn"]}
 
+    @timed(RUNNER_SECONDS, "update_status")
     async def update_status(self, run_id, update_logs=False):
         run = await self.storage.get_run(run_id)
 
-        if run.status.is_terminal():
+        if run.status.is_terminal() or run.queued:
             return run
 
         # note: what ECS calls a task, we call a run
         arn = run.run_info["task_arn"]
-        resp = self.ecs.describe_tasks(cluster=self.cluster_name, tasks=[arn])
+        resp = await aws.call(
+            "ecs", "describe_tasks", cluster=self.cluster_name, tasks=[arn]
+        )
+        return await self._apply_task_status(run, resp, update_logs)
+
+    @timed(RUNNER_SECONDS, "update_statuses")
+    async def update_statuses(self, run_ids, update_logs=False):
+        runs = await self.storage.get_runs_by_id(run_ids)
+        active = {
+            run.run_info["task_arn"]: run
+            for run in runs
+            if not run.status.is_terminal() and not run.queued
+        }
+        arns = list(active)
+
+        # describe_tasks accepts up to 100 ARNs per call, batches are sent concurrently
+        batches = [
+            arns[i:i + self.DESCRIBE_TASKS_BATCH_SIZE]
+            for i in range(0, len(arns), self.DESCRIBE_TASKS_BATCH_SIZE)
+        ]
+        responses = await asyncio.gather(
+            *[
+                aws.call(
+                    "ecs", "describe_tasks", cluster=self.cluster_name, tasks=batch
+                )
+                for batch in batches
+            ]
+        )
+
+        updates = []
+        for batch, resp in zip(batches, responses):
+            tasks = {t["taskArn"]: t for t in resp["tasks"]}
+            failures = {f["arn"]: f for f in resp["failures"]}
+            for arn in batch:
+                # split into single-run responses so that the same logic applies
+                single = {
+                    "tasks": [tasks[arn]] if arn in tasks else [],
+                    "failures": [failures[arn]] if arn in failures else [],
+                }
+                updates.append(
+                    self._apply_task_status(active[arn], single, update_logs)
+                )
+        # one run that can't be updated doesn't stop the rest
+        results = await asyncio.gather(*updates, return_exceptions=True)
+        for arn, result in zip([arn for batch in batches for arn in batch], results):
+            if isinstance(result, Exception):
+                print(f"failed to update status of {arn}: {result!r}")
 
-        if resp["failures"]:
-            if resp["failures"][0]["reason"] == "MISSING":
+        return runs
+
+    async def _apply_task_status(self, run, resp, update_logs):
+        """
+        update a run based on a describe_tasks response containing only its task
+        """
+        # a task ECS no longer knows about at all is missing too
+        missing = not resp["tasks"] and not resp["failures"]
+        if missing or resp["failures"]:
+            if missing or resp["failures"][0]["reason"] == "MISSING":
                 run.exit_code = -999
                 run.end = datetime.datetime.utcnow().isoformat()
                 run.status = Status.Missing
-                run.logs = self.get_logs(run)
-                await self.storage.save_run(run)
+                await self.update_logs(run, final=True)
+                await self._save_and_followup(run)
                 return run
                 # TODO: improve handling, should we call callbacks on missing?
             raise ValueError(f"unexpected status: {resp['failures']}")
@@ -174,34 +247,33 @@ class ECSRunService(RunService):
         result = resp["tasks"][0]
         if result["lastStatus"] == "STOPPED":
             run.end = datetime.datetime.utcnow().isoformat()
-            run.logs = self.get_logs(run)
+            await self.update_logs(run, final=True)
             try:
                 run.exit_code = result["containers"][0]["exitCode"]
             except KeyError:
                 run.exit_code = -400
-                run.logs = result["containers"][0].get("reason")
-                if not run.logs:
-                    run.logs = "No exit code or reason: " + repr(
-                        result["containers"][0]
-                    )
+                reason = result["containers"][0].get("reason")
+                if not reason:
+                    reason = "No exit code or reason: " + repr(result["containers"][0])
+                await self._append_log_lines(run, [reason])
             run.status = Status.Error if run.exit_code else Status.Success
             await self._save_and_followup(run)
         elif (
             run.run_info["timeout_at"]
             and datetime.datetime.utcnow().isoformat() > run.run_info["timeout_at"]
         ):
-            run.logs = self.get_logs(run)
-            self.stop(run)
+            await self.update_logs(run, final=True)
+            await self.stop(run)
             run.status = Status.TimedOut
             await self._save_and_followup(run)
 
         elif result["lastStatus"] == "RUNNING":
             if run.status != Status.Running:
                 run.status = Status.Running
-                run.logs = self.get_logs(run)
+                await self.update_logs(run)
                 await self._save_and_followup(run)
             elif update_logs:
-                run.logs = self.get_logs(run)
+                await self.update_logs(run)
                 await self.storage.save_run(run)
         elif result["lastStatus"] in ("PENDING", "PROVISIONING"):
             if run.status != Status.Pending:
@@ -210,56 +282,92 @@ class ECSRunService(RunService):
 
         return run
 
-    def stop(self, run):
-        self.ecs.stop_task(cluster=self.cluster_name, task=run.run_info["task_arn"])
-
-    def get_logs(self, run):
-        return self.environment.mask_variables(
-            "\n".join(line["message"] for line in self.iter_logs(run))
+    async def stop(self, run):
+        await aws.call(
+            "ecs",
+            "stop_task",
+            cluster=self.cluster_name,
+            task=run.run_info["task_arn"],
         )
 
-    def iter_logs(self, run):
-        logs = boto3.client("logs")
+    async def update_logs(self, run, final=False):
+        """
+        append log lines written since the last poll to the run's logs
+
+        the CloudWatch forward token and the number of lines fetched so far are kept in
+        the run's log cursor so that each poll only downloads new events
+        """
+        cursor = await self.storage.get_log_cursor(run.uuid)
+        next_cursor = dict(cursor)
+        lines = []
+        try:
+            async for event in self.iter_logs(run, next_cursor):
+                lines.append(event["message"])
+        except ClientError:
+            # stream doesn't exist (yet), keep whatever we managed to read
+            pass
+
+        if final and not lines and not cursor.get("log_lines"):
+            lines = ["no logs"]
+        await self._append_log_lines(run, lines, cursor, next_cursor)
+
+    async def _append_log_lines(self, run, lines, cursor=None, next_cursor=None):
+        if not lines:
+            return
+        if cursor is None:
+            cursor = await self.storage.get_log_cursor(run.uuid)
+            next_cursor = dict(cursor)
+        chunk = self.environment.mask_variables("\n".join(lines))
+        if cursor.get("log_lines"):
+            chunk = "\n" + chunk
+        next_cursor["log_lines"] = cursor.get("log_lines", 0) + len(lines)
+        # if another process stored these lines first, they are already in the logs
+        await self.storage.append_logs(run, chunk, cursor, next_cursor)
+
+    async def iter_logs(self, run, cursor):
+        """
+        yield events after cursor["log_token"], advancing the token as pages are read
+        """
         arn_uuid = run.run_info["task_arn"].split("/")[-1]
         log_arn = f"{run.task.lower()}/{run.task}/{arn_uuid}"
 
-        next_token = None
-
         while True:
-            extra = {"nextToken": next_token} if next_token else {}
-            try:
-                events = logs.get_log_events(
-                    logGroupName=self.log_group, logStreamName=log_arn, **extra
-                )
-            except ClientError:
-                yield {"message": "no logs"}
-                break
-            next_token = events["nextForwardToken"]
+            next_token = cursor.get("log_token")
+            if next_token:
+                extra = {"nextToken": next_token}
+            else:
+                extra = {"startFromHead": True}
+            events = await aws.call(
+                "logs",
+                "get_log_events",
+                logGroupName=self.log_group,
+                logStreamName=log_arn,
+                **extra,
+            )
+            cursor["log_token"] = events["nextForwardToken"]
 
             if not events["events"]:
                 break
 
-            yield from events["events"]
-
-            if not next_token:
-                break
+            for event in events["events"]:
+                yield event
 
     async def cleanup(self):
         n = 0
         for r in await self.storage.get_runs(status=[Status.Pending, Status.Running]):
-            self.ecs.stop_task(cluster=self.cluster_name, task=r.run_info["task_arn"])
+            if r.queued:
+                continue
+            await self.stop(r)
             n += 1
         return n
 
-    def _make_cron_rule(self, task):
+    async def _make_cron_rule(self, task):
         """
         registers a cron rule with ECS
 
         currently inactive code since ECS scheduling doesn't have a clean way to
         add a run entry in the storage.
         """
-        events = boto3.client("events")
-
         schedule = None
         for trigger in task.triggers:
             if trigger["cron"]:
@@ -270,14 +378,16 @@ class ECSRunService(RunService):
         if not schedule:
             return
 
-        resp = self.ecs.describe_task_definition(taskDefinition=task.name)
+        resp = await aws.call(
+            "ecs", "describe_task_definition", taskDefinition=task.name
+        )
         task_def_arn = resp["taskDefinition"]["taskDefinitionArn"]
 
         enabled = "ENABLED" if task.enabled else "DISABLED"
         create = False
 
         try:
-            old_rule = events.describe_rule(Name=task.name)
+            old_rule = await aws.call("events", "describe_rule", Name=task.name)
             updating = []
             if schedule != old_rule["ScheduleExpression"]:
                 updating.append("schedule")
@@ -289,13 +399,17 @@ class ECSRunService(RunService):
             create = True
 
         if create:
-            events.put_rule(
+            await aws.call(
+                "events",
+                "put_rule",
                 Name=task.name,
                 ScheduleExpression=schedule,
                 State=enabled,
                 Description=f"run {task.name} at {schedule}",
             )
-            events.put_targets(
+            await aws.call(
+                "events",
+                "put_targets",
                 Rule=task.name,
                 Targets=[
                     {
@@ -1,26 +1,38 @@
+import asyncio
+import contextlib
 import datetime
 import docker
+import requests
 from ..base import RunService, Status
+from ..metrics import DOCKER_CALL_SECONDS, RUNNER_SECONDS, timed
 
 
 class LocalRunService(RunService):
 
     STARTING_STATUS = Status.Running
 
-    def __init__(self, storage, environment, callbacks=None):
+    def __init__(self, storage, environment, callbacks=None, limits=None):
         self.client = docker.from_env()
         self.storage = storage
         self.environment = environment
         self.callbacks = callbacks or []
+        self.limits = limits
+        self.watching = False
+        self._locks = {}
 
     def _get_container(self, run):
         if run.status == Status.Running:
             try:
-                return self.client.containers.get(run.run_info["container_id"])
+                with DOCKER_CALL_SECONDS.labels("get").time():
+                    return self.client.containers.get(run.run_info["container_id"])
             except docker.errors.NotFound:
                 return None
 
-    def initialize(self, tasks):
+    def _remove(self, container, force=False):
+        with DOCKER_CALL_SECONDS.labels("remove").time():
+            container.remove(force=force)
+
+    async def initialize(self, tasks):
         pass
 
     async def cleanup(self):
@@ -28,64 +40,170 @@ class LocalRunService(RunService):
         for r in await self.storage.get_runs(status=[Status.Pending, Status.Running]):
             c = self._get_container(r)
             if c:
-                c.remove(force=True)
+                self._remove(c, force=True)
                 n += 1
         return n
 
-    def start_task(self, task):
+    async def start_task(self, task):
         env = {}
         if task.environment:
             env = self.environment.get_environment(task.environment).values
-        container = self.client.containers.run(
-            task.image,
-            task.entrypoint if task.entrypoint else None,
-            detach=True,
-            environment=env,
-        )
+        with DOCKER_CALL_SECONDS.labels("run").time():
+            container = self.client.containers.run(
+                task.image,
+                task.entrypoint if task.entrypoint else None,
+                detach=True,
+                environment=env,
+                labels={"bobsled": "true", "bobsled.task": task.name},
+            )
         return {"container_id": container.id}
 
-    def stop(self, run):
+    async def stop(self, run):
         container = self._get_container(run)
         if not container:
             print("MISSING CONTAINER")
             return
-        container.remove(force=True)
-
+        self._remove(container, force=True)
+
+    @contextlib.asynccontextmanager
+    async def _lock(self, run_id):
+        # run_id => [lock, number of holders & waiters], dropped when nobody is left
+        entry = self._locks.setdefault(run_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[run_id]
+
+    @timed(RUNNER_SECONDS, "update_status")
     async def update_status(self, run_id, update_logs=False):
+        # the event watcher, beat, and web requests can all update a run at once
+        async with self._lock(run_id):
+            return await self._update_status(run_id, update_logs)
+
+    async def stop_run(self, run_id):
+        # don't let the container's exit event mark the run Missing before it's saved
+        async with self._lock(run_id):
+            await super().stop_run(run_id)
+
+    @timed(RUNNER_SECONDS, "update_statuses")
+    async def update_statuses(self, run_ids, update_logs=False):
+        if self.watching and not update_logs:
+            # exits arrive as events, so only runs past their timeout need a check
+            now = datetime.datetime.utcnow().isoformat()
+            runs = [await self.storage.get_run(run_id) for run_id in run_ids]
+            run_ids = [
+                run.uuid
+                for run in runs
+                if run.status == Status.Running
+                and run.run_info.get("timeout_at")
+                and now > run.run_info["timeout_at"]
+            ]
+        return await super().update_statuses(run_ids, update_logs=update_logs)
+
+    async def watch(self):
+        """
+        follow the docker event stream, finishing runs as soon as their container exits
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            events = None
+            try:
+                events = self.client.events(
+                    decode=True,
+                    filters={
+                        "type": "container",
+                        "event": ["die", "oom", "kill"],
+                        "label": "bobsled=true",
+                    },
+                )
+                self.watching = True
+                # catch up on anything that exited before we subscribed
+                running = await self.storage.get_runs(status=Status.Running)
+                await super().update_statuses([run.uuid for run in running])
+                while True:
+                    # the event stream blocks, so read it from a worker thread
+                    event = await loop.run_in_executor(None, next, events, None)
+                    if event is None:
+                        break
+                    await self._handle_event(event)
+            except (docker.errors.DockerException, requests.RequestException) as e:
+                print("docker event stream error", e)
+            finally:
+                self.watching = False
+                if events:
+                    events.close()
+            await asyncio.sleep(5)
+
+    async def _handle_event(self, event):
+        run = await self.storage.find_run(
+            "container_id", event.get("id"), status=Status.Running
+        )
+        if run:
+            await self.update_status(run.uuid)
+
+    async def _update_status(self, run_id, update_logs):
         run = await self.storage.get_run(run_id)
 
-        if run.status.is_terminal():
+        if run.status.is_terminal() or run.queued:
             return run
 
         container = self._get_container(run)
         if not container:
             run.status = Status.Missing
-            await self.storage.save_run(run)
+            run.end = datetime.datetime.utcnow().isoformat()
+            await self._save_and_followup(run)
 
         elif container.status == "exited":
-            resp = container.wait()
+            with DOCKER_CALL_SECONDS.labels("wait").time():
+                resp = container.wait()
             if resp["Error"] or resp["StatusCode"]:
                 run.status = Status.Error
             else:
                 run.status = Status.Success
 
-            run.logs = self.environment.mask_variables(container.logs().decode())
+            await self.update_logs(run, container, final=True)
             run.end = datetime.datetime.utcnow().isoformat()
             run.exit_code = resp["StatusCode"]
             await self._save_and_followup(run)
-            container.remove()
+            self._remove(container)
 
         elif run.status == Status.Running:
             if (
                 run.run_info["timeout_at"]
                 and datetime.datetime.utcnow().isoformat() > run.run_info["timeout_at"]
             ):
-                run.logs = self.environment.mask_variables(container.logs().decode())
-                container.remove(force=True)
+                await self.update_logs(run, container, final=True)
+                self._remove(container, force=True)
                 run.status = Status.TimedOut
                 await self._save_and_followup(run)
 
             elif update_logs:
-                run.logs = self.environment.mask_variables(container.logs().decode())
+                await self.update_logs(run, container)
                 await self.storage.save_run(run)
         return run
+
+    async def update_logs(self, run, container, final=False):
+        """
+        append container output written since the last poll to the run's logs
+
+        the log cursor's log_offset tracks how much of the output has been stored,
+        output that might be the start of a secret is held back until the next poll
+        """
+        cursor = await self.storage.get_log_cursor(run.uuid)
+        offset = cursor.get("log_offset", 0)
+        with DOCKER_CALL_SECONDS.labels("logs").time():
+            output = container.logs().decode()[offset:]
+        if final:
+            chunk = self.environment.mask_variables(output)
+            consumed = len(output)
+        else:
+            chunk, consumed = self.environment.masker.mask_prefix(output)
+        if consumed:
+            # if another process stored this output first, it is already in the logs
+            await self.storage.append_logs(
+                run, chunk, cursor, {"log_offset": offset + consumed}
+            )
@@ -0,0 +1,181 @@
+"""
+Per-task run statistics, updated as each run finishes instead of recomputed from
+run history.
+
+Duration percentiles are estimated with the P² algorithm (Jain & Chlamtac, 1985),
+which keeps five markers per quantile no matter how many runs a task has had.
+"""
+import datetime
+import attr
+
+
+class P2Quantile:
+    """
+    streaming estimate of the p quantile of everything passed to add()
+    """
+
+    def __init__(self, p, heights=None, positions=None, desired=None):
+        self.p = p
+        # marker heights, until there are five observations just the observations
+        self.heights = heights or []
+        self.positions = positions or [0, 1, 2, 3, 4]
+        self.desired = desired or [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    @property
+    def count(self):
+        if len(self.heights) < 5:
+            return len(self.heights)
+        return self.positions[4] + 1
+
+    def add(self, x):
+        q, n = self.heights, self.positions
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+
+        # find the cell x falls in, stretching the ends if it's a new min or max
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # move the middle markers toward where they should be
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def _parabolic(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def value(self):
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            # exact, nearest rank
+            index = round(self.p * (len(self.heights) - 1))
+            return self.heights[index]
+        return self.heights[2]
+
+    def to_dict(self):
+        return {
+            "p": self.p,
+            "heights": self.heights,
+            "positions": self.positions,
+            "desired": self.desired,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["p"], data["heights"], data["positions"], data["desired"])
+
+
+def _duration(run):
+    start = datetime.datetime.fromisoformat(run.start)
+    end = datetime.datetime.fromisoformat(run.end)
+    return (end - start).total_seconds()
+
+
+@attr.s(auto_attribs=True)
+class TaskStats:
+    """
+    Counts are of finished runs.  A failure is a run that ended in Error, the
+    same as the error_threshold of a task, so failure_streak is the number of
+    Errors since the last run that ended any other way and first_failure is the
+    uuid of the first of them.  Durations are of successful runs.
+    """
+
+    task: str
+    runs: int = 0
+    successes: int = 0
+    failures: int = 0
+    last_run: str = ""
+    last_status: str = ""
+    last_success: str = ""
+    last_failure: str = ""
+    failure_streak: int = 0
+    first_failure: str = ""
+    duration_p50: P2Quantile = attr.Factory(lambda: P2Quantile(0.5))
+    duration_p95: P2Quantile = attr.Factory(lambda: P2Quantile(0.95))
+
+    def record(self, run):
+        """
+        add a finished run, returns False if it was already the last one recorded
+        """
+        if run.uuid == self.last_run:
+            return False
+        self.runs += 1
+        self.last_run = run.uuid
+        self.last_status = run.status.name
+        # by name, base imports this module
+        if run.status.name == "Success":
+            self.successes += 1
+            self.last_success = run.end or run.start
+            if run.start and run.end:
+                duration = _duration(run)
+                self.duration_p50.add(duration)
+                self.duration_p95.add(duration)
+        if run.status.name == "Error":
+            self.failures += 1
+            self.last_failure = run.end or run.start
+            if not self.failure_streak:
+                self.first_failure = run.uuid
+            self.failure_streak += 1
+        else:
+            self.failure_streak = 0
+            self.first_failure = ""
+        return True
+
+    @property
+    def success_rate(self):
+        return self.successes / self.runs if self.runs else None
+
+    def summary(self):
+        """what the API shows"""
+        return {
+            "task": self.task,
+            "runs": self.runs,
+            "successes": self.successes,
+            "failures": self.failures,
+            "success_rate": self.success_rate,
+            "duration_p50": self.duration_p50.value(),
+            "duration_p95": self.duration_p95.value(),
+            "last_status": self.last_status,
+            "last_success": self.last_success,
+            "last_failure": self.last_failure,
+            "failure_streak": self.failure_streak,
+        }
+
+    def to_dict(self):
+        data = attr.asdict(self, recurse=False)
+        data["duration_p50"] = self.duration_p50.to_dict()
+        data["duration_p95"] = self.duration_p95.to_dict()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data["duration_p50"] = P2Quantile.from_dict(data["duration_p50"])
+        data["duration_p95"] = P2Quantile.from_dict(data["duration_p95"])
+        return cls(**data)
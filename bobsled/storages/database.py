@@ -1,10 +1,22 @@
 import json
+import datetime
+import contextlib
 import attr
 import sqlalchemy
+from sqlalchemy.dialects import postgresql
 from databases import Database
 from ..base import Run, Status, Task, Trigger, User
-from ..utils import hash_password, verify_password
+from ..metrics import STORAGE_SECONDS, timed_methods
+from ..stats import TaskStats
+from ..tracing import traced_methods
+from ..utils import diff_tasks, hash_password, verify_password
+from .migrations import migrate
+from .transactions import transaction
 
+# held while queued runs are admitted, so only one process starts them at a time
+ADMISSION_LOCK_ID = 1989
+# with a hash of the task name, held while a task's stats are updated
+TASK_STATS_LOCK_ID = 1990
 
 metadata = sqlalchemy.MetaData()
 Tasks = sqlalchemy.Table(
@@ -28,14 +40,40 @@ Runs = sqlalchemy.Table(
     metadata,
     sqlalchemy.Column("uuid", sqlalchemy.String(length=50), primary_key=True),
     sqlalchemy.Column("status", sqlalchemy.String(length=50)),
-    sqlalchemy.Column(
-        "task", sqlalchemy.String(length=100), sqlalchemy.ForeignKey(Tasks.c.name)
-    ),
-    sqlalchemy.Column("start", sqlalchemy.String(length=50)),
-    sqlalchemy.Column("end", sqlalchemy.String(length=50)),
-    sqlalchemy.Column("logs", sqlalchemy.String()),
+    # not a foreign key, runs are kept after their task is removed
+    sqlalchemy.Column("task", sqlalchemy.String(length=100)),
+    sqlalchemy.Column("start", sqlalchemy.DateTime),
+    sqlalchemy.Column("end", sqlalchemy.DateTime),
     sqlalchemy.Column("exit_code", sqlalchemy.Integer),
     sqlalchemy.Column("run_info_json", sqlalchemy.JSON()),
+    # where the runner's log source has been read up to, see append_logs
+    sqlalchemy.Column("log_cursor", postgresql.JSONB()),
+)
+RunLogs = sqlalchemy.Table(
+    "bobsled_run_log",
+    metadata,
+    sqlalchemy.Column(
+        "run_uuid",
+        sqlalchemy.String(length=50),
+        sqlalchemy.ForeignKey(Runs.c.uuid),
+        primary_key=True,
+    ),
+    sqlalchemy.Column("seq", sqlalchemy.Integer, primary_key=True),
+    # position of the chunk's first character within the run's full log
+    sqlalchemy.Column("log_offset", sqlalchemy.Integer),
+    sqlalchemy.Column("chunk", sqlalchemy.String()),
+)
+Settings = sqlalchemy.Table(
+    "bobsled_setting",
+    metadata,
+    sqlalchemy.Column("key", sqlalchemy.String(length=100), primary_key=True),
+    sqlalchemy.Column("value", sqlalchemy.JSON()),
+)
+TaskStatsTable = sqlalchemy.Table(
+    "bobsled_task_stats",
+    metadata,
+    sqlalchemy.Column("task", sqlalchemy.String(length=100), primary_key=True),
+    sqlalchemy.Column("stats", sqlalchemy.JSON()),
 )
 Users = sqlalchemy.Table(
     "bobsled_user",
@@ -45,17 +83,24 @@ Users = sqlalchemy.Table(
     sqlalchemy.Column("permissions", sqlalchemy.ARRAY(sqlalchemy.String(length=100))),
 )
 
+# tasks have 12 columns, asyncpg allows 32767 bind parameters per statement
+TASK_UPSERT_BATCH_SIZE = 1000
+
+
+def _db_to_time(value):
+    return value.isoformat(timespec="microseconds") if value else ""
+
+
+def _time_to_db(value):
+    return datetime.datetime.fromisoformat(value) if value else None
+
 
 def _db_to_run(r):
-    logs = ""
-    if "logs" in r:
-        logs = r["logs"]
     return Run(
         task=r["task"],
         status=Status[r["status"]],
-        start=r["start"],
-        end=r["end"],
-        logs=logs,
+        start=_db_to_time(r["start"]),
+        end=_db_to_time(r["end"]),
         exit_code=r["exit_code"],
         run_info=json.loads(r["run_info_json"]),
         uuid=r["uuid"],
@@ -66,9 +111,22 @@ def _run_to_db(r):
     values = attr.asdict(r)
     values["status"] = values["status"].name
     values["run_info_json"] = json.dumps(values.pop("run_info"))
+    values["start"] = _time_to_db(values["start"])
+    values["end"] = _time_to_db(values["end"])
+    # logs are stored in RunLogs
+    values.pop("logs")
     return values
 
 
+def _run_info_value(key):
+    # run_info_json holds a JSON string of the encoded run_info, unwrap it to index
+    run_info = sqlalchemy.cast(
+        Runs.c.run_info_json.op("#>>")(sqlalchemy.literal_column("'{}'")),
+        postgresql.JSON,
+    )
+    return run_info[key].as_string()
+
+
 def _task_to_db(t):
     values = attr.asdict(t)
     return values
@@ -80,18 +138,35 @@ def _db_to_task(row):
     return Task(**vals)
 
 
+@timed_methods(STORAGE_SECONDS, "database")
+@traced_methods(
+    exclude=("admission_lock",), hide_args=("check_password", "set_user")
+)
 class DatabaseStorage:
     def __init__(self, BOBSLED_DATABASE_URI):
         self.database = Database(BOBSLED_DATABASE_URI)
 
     async def connect(self):
         await self.database.connect()
-        engine = sqlalchemy.create_engine(str(self.database.url))
-        metadata.create_all(engine)
+        await migrate(self.database)
+
+    @contextlib.asynccontextmanager
+    async def admission_lock(self):
+        """
+        serializes admission of queued runs across every process using the database
+        """
+        async with transaction(self.database):
+            await self.database.execute(
+                query="SELECT pg_advisory_xact_lock(:lock_id)",
+                values={"lock_id": ADMISSION_LOCK_ID},
+            )
+            yield
 
     async def add_run(self, run):
         query = Runs.insert()
         await self.database.execute(query=query, values=_run_to_db(run))
+        if run.logs:
+            await self._insert_log_chunk(run.uuid, run.logs)
 
     async def save_run(self, run):
         values = _run_to_db(run)
@@ -99,25 +174,128 @@ class DatabaseStorage:
         query = Runs.update().where(Runs.c.uuid == uuid).values(**values)
         await self.database.execute(query=query)
 
-    async def get_run(self, run_id):
+    async def get_run(self, run_id, *, logs=False):
         query = Runs.select().where(Runs.c.uuid == run_id)
         row = await self.database.fetch_one(query=query)
         if row:
-            return _db_to_run(row)
+            run = _db_to_run(row)
+            if logs:
+                run.logs = await self.get_logs(run_id)
+            return run
 
-    async def get_runs(self, *, status=None, task_name=None, latest=None):
-        query = sqlalchemy.select(
+    async def get_runs_by_id(self, run_ids):
+        """
+        the runs with these uuids in a single query, in the same order, skipping any
+        that don't exist
+        """
+        if not run_ids:
+            return []
+        query = Runs.select().where(Runs.c.uuid.in_(run_ids))
+        rows = await self.database.fetch_all(query=query)
+        runs = {row["uuid"]: _db_to_run(row) for row in rows}
+        return [runs[run_id] for run_id in run_ids if run_id in runs]
+
+    async def _insert_log_chunk(self, run_id, chunk):
+        # seq & offset are computed in the same statement as the insert
+        end = RunLogs.c.log_offset + sqlalchemy.func.length(RunLogs.c.chunk)
+        select = sqlalchemy.select(
             [
-                Runs.c.uuid,
-                Runs.c.task,
-                Runs.c.status,
-                Runs.c.start,
-                Runs.c.end,
-                Runs.c.exit_code,
-                Runs.c.run_info_json,
+                sqlalchemy.literal(run_id),
+                sqlalchemy.func.coalesce(sqlalchemy.func.max(RunLogs.c.seq) + 1, 0),
+                sqlalchemy.func.coalesce(sqlalchemy.func.max(end), 0),
+                sqlalchemy.literal(chunk),
             ]
+        ).where(RunLogs.c.run_uuid == run_id)
+        query = RunLogs.insert().from_select(
+            ["run_uuid", "seq", "log_offset", "chunk"], select
+        )
+        await self.database.execute(query=query)
+
+    async def append_logs(self, run, chunk, cursor=None, next_cursor=None):
+        """
+        append chunk to the run's logs
+
+        When next_cursor is given the chunk is only appended if the run's stored log
+        cursor is still cursor, and the cursor is moved to next_cursor in the same
+        transaction.  Returns False if another process got there first.
+        """
+        async with transaction(self.database):
+            if next_cursor is None:
+                # the row lock keeps concurrent appends from taking the same seq
+                query = (
+                    sqlalchemy.select([Runs.c.uuid])
+                    .where(Runs.c.uuid == run.uuid)
+                    .with_for_update()
+                )
+                await self.database.execute(query=query)
+            else:
+                stored = sqlalchemy.func.coalesce(
+                    Runs.c.log_cursor, sqlalchemy.cast({}, postgresql.JSONB)
+                )
+                query = (
+                    Runs.update()
+                    .where(Runs.c.uuid == run.uuid)
+                    .where(stored == sqlalchemy.cast(cursor or {}, postgresql.JSONB))
+                    .values(log_cursor=next_cursor)
+                    .returning(Runs.c.uuid)
+                )
+                if await self.database.fetch_val(query=query) is None:
+                    return False
+            if chunk:
+                await self._insert_log_chunk(run.uuid, chunk)
+        run.logs += chunk
+        return True
+
+    async def get_log_cursor(self, run_id):
+        query = sqlalchemy.select([Runs.c.log_cursor]).where(Runs.c.uuid == run_id)
+        return await self.database.fetch_val(query=query) or {}
+
+    async def get_log_size(self, run_id):
+        end = RunLogs.c.log_offset + sqlalchemy.func.length(RunLogs.c.chunk)
+        query = sqlalchemy.select([sqlalchemy.func.max(end)]).where(
+            RunLogs.c.run_uuid == run_id
+        )
+        return await self.database.fetch_val(query=query) or 0
+
+    async def get_logs(self, run_id, offset=0, limit=None):
+        """
+        get logs for a run, or the range [offset, offset + limit) of them
+        """
+        end = RunLogs.c.log_offset + sqlalchemy.func.length(RunLogs.c.chunk)
+        query = (
+            sqlalchemy.select([RunLogs.c.log_offset, RunLogs.c.chunk])
+            .where(RunLogs.c.run_uuid == run_id)
+            .where(end > offset)
+            .order_by(RunLogs.c.seq)
+        )
+        if limit is not None:
+            query = query.where(RunLogs.c.log_offset < offset + limit)
+        rows = await self.database.fetch_all(query=query)
+
+        if not rows:
+            return ""
+
+        logs = "".join(r["chunk"] for r in rows)
+        start = offset - rows[0]["log_offset"]
+        if limit is None:
+            return logs[start:]
+        return logs[start:start + limit]
+
+    async def get_logs_tail(self, run_id, size):
+        total = await self.get_log_size(run_id)
+        return await self.get_logs(run_id, offset=max(total - size, 0))
+
+    async def get_runs(self, *, status=None, task_name=None, latest=None, before=None):
+        """
+        runs ordered by start, then uuid, 'latest' limits it to that many of the newest
+
+        'before' is a (start, uuid) cursor, only runs ordered before it are returned,
+        so paging back with the oldest run of each page costs one index range scan
+        no matter how far back it goes.
+        """
+        query = Runs.select().order_by(
+            Runs.c.start.desc().nullslast(), Runs.c.uuid.desc()
         )
-        query = query.order_by(Runs.c.start.desc())
         if isinstance(status, Status):
             query = query.where(Runs.c.status == status.name)
         elif isinstance(status, list):
@@ -126,12 +304,144 @@ class DatabaseStorage:
             raise ValueError("status must be Status or list")
         if task_name:
             query = query.where(Runs.c.task == task_name)
+
+        # runs without a start come after all the others, but a row comparison
+        # never matches NULL so they're fetched separately when a page runs into them
+        null_query = None
+        if before:
+            start, uuid = before
+            if start:
+                null_query = query.where(Runs.c.start.is_(None))
+                query = query.where(
+                    sqlalchemy.tuple_(Runs.c.start, Runs.c.uuid)
+                    < sqlalchemy.tuple_(_time_to_db(start), uuid)
+                )
+            else:
+                query = query.where(Runs.c.start.is_(None)).where(Runs.c.uuid < uuid)
         if latest:
             query = query.limit(latest)
         rows = await self.database.fetch_all(query=query)
+        if null_query is not None and (not latest or len(rows) < latest):
+            if latest:
+                null_query = null_query.limit(latest - len(rows))
+            rows += await self.database.fetch_all(query=null_query)
 
         return [_db_to_run(r) for r in reversed(rows)]
 
+    async def find_run(self, key, value, *, status=None):
+        """
+        a run whose run_info[key] is value, optionally limited to those with status
+        """
+        query = Runs.select().where(_run_info_value(key) == value).limit(1)
+        if status:
+            query = query.where(Runs.c.status == status.name)
+        row = await self.database.fetch_one(query=query)
+        return _db_to_run(row) if row else None
+
+    async def get_latest_runs_per_task(self, n, task_names=None):
+        """
+        the n most recent runs of each task (or just task_names), newest first
+
+        returns a dict mapping task names to runs, tasks without runs are left out
+        """
+        # ordered like the (task, start, uuid) index, so ties on start always rank
+        # the same way
+        row_number = (
+            sqlalchemy.func.row_number()
+            .over(
+                partition_by=Runs.c.task,
+                order_by=[Runs.c.start.desc().nullslast(), Runs.c.uuid.desc()],
+            )
+            .label("row_number")
+        )
+        ranked = sqlalchemy.select([Runs, row_number])
+        # filtered before ranking, so only these tasks' runs are numbered
+        if task_names is not None:
+            ranked = ranked.where(Runs.c.task.in_(task_names))
+        ranked = ranked.alias("ranked")
+        query = (
+            sqlalchemy.select([ranked])
+            .where(ranked.c.row_number <= n)
+            .order_by(ranked.c.task, ranked.c.row_number)
+        )
+        rows = await self.database.fetch_all(query=query)
+
+        latest = {}
+        for row in rows:
+            latest.setdefault(row["task"], []).append(_db_to_run(row))
+        return latest
+
+    async def get_runs_to_archive(self, task_name, before, limit):
+        """
+        finished runs of a task that started before 'before' and haven't been
+        archived yet, oldest first and without their logs
+        """
+        query = (
+            Runs.select()
+            .where(Runs.c.task == task_name)
+            .where(Runs.c.start < before)
+            .where(Runs.c.status.in_(s.name for s in Status if s.is_terminal()))
+            .where(_run_info_value("archived").is_(None))
+            .order_by(Runs.c.start)
+            .limit(limit)
+        )
+        rows = await self.database.fetch_all(query=query)
+        return [_db_to_run(r) for r in rows]
+
+    async def get_run_task_names(self):
+        """
+        names of every task with runs in storage, including tasks since removed
+        """
+        # skips from one task to the next along the (task, start) index, rather than
+        # reading every run like DISTINCT would
+        query = """
+            WITH RECURSIVE names AS (
+                (SELECT task FROM bobsled_run ORDER BY task LIMIT 1)
+                UNION ALL
+                SELECT (
+                    SELECT task FROM bobsled_run WHERE task > names.task
+                    ORDER BY task LIMIT 1
+                )
+                FROM names WHERE names.task IS NOT NULL
+            )
+            SELECT task FROM names WHERE task IS NOT NULL
+        """
+        return [row["task"] for row in await self.database.fetch_all(query=query)]
+
+    async def mark_archived(self, runs, archive_name):
+        """
+        record that runs were written to archive_name and drop their logs
+        """
+        async with transaction(self.database):
+            query = RunLogs.delete().where(
+                RunLogs.c.run_uuid.in_([run.uuid for run in runs])
+            )
+            await self.database.execute(query)
+            for run in runs:
+                run.run_info = dict(run.run_info, archived=archive_name)
+                run.logs = ""
+                await self.save_run(run)
+
+    async def delete_archived_runs(self, task_name, before):
+        """
+        delete archived runs of a task that started before 'before', returns how many
+        """
+        expired = (
+            sqlalchemy.select([Runs.c.uuid])
+            .where(Runs.c.task == task_name)
+            .where(Runs.c.start < before)
+            .where(_run_info_value("archived").isnot(None))
+        )
+        async with transaction(self.database):
+            # logs were already dropped when archived, unless added since
+            await self.database.execute(
+                RunLogs.delete().where(RunLogs.c.run_uuid.in_(expired))
+            )
+            rows = await self.database.fetch_all(
+                Runs.delete().where(Runs.c.uuid.in_(expired)).returning(Runs.c.uuid)
+            )
+        return len(rows)
+
     async def get_tasks(self):
         query = Tasks.select().order_by(Tasks.c.name.asc())
         rows = await self.database.fetch_all(query=query)
@@ -144,22 +454,88 @@ class DatabaseStorage:
             return _db_to_task(row)
 
     async def set_tasks(self, tasks):
-        seen = set()
-        for task in tasks:
-            seen.add(task.name)
-            dbtask = _task_to_db(task)
-
-            query = Tasks.select().where(Tasks.c.name == task.name)
-            res = await self.database.fetch_all(query=query)
-            if res:
-                query = Tasks.update().where(Tasks.c.name == task.name).values(**dbtask)
-                res = await self.database.execute(query=query)
-            else:
-                query = Tasks.insert()
-                await self.database.execute(query=query, values=dbtask)
+        """
+        replace all tasks, only writing the rows that changed
+
+        returns the names of the tasks that were added, updated, and removed
+        """
+        changes = diff_tasks(await self.get_tasks(), tasks)
+        by_name = {task.name: task for task in tasks}
+        upserts = [
+            _task_to_db(by_name[name]) for name in changes["added"] + changes["updated"]
+        ]
+
+        async with transaction(self.database):
+            # one multi-row statement per batch, staying under the bind param limit
+            for i in range(0, len(upserts), TASK_UPSERT_BATCH_SIZE):
+                query = postgresql.insert(Tasks).values(
+                    upserts[i:i + TASK_UPSERT_BATCH_SIZE]
+                )
+                query = query.on_conflict_do_update(
+                    index_elements=[Tasks.c.name],
+                    set_={
+                        column.name: query.excluded[column.name]
+                        for column in Tasks.columns
+                        if column.name != "name"
+                    },
+                )
+                await self.database.execute(query)
+            if changes["removed"]:
+                query = Tasks.delete().where(Tasks.c.name.in_(changes["removed"]))
+                await self.database.execute(query)
+
+        return changes
+
+    async def get_task_stats(self, task_names=None):
+        """
+        TaskStats for each task (or just task_names) that has any, by task name
+        """
+        query = TaskStatsTable.select()
+        if task_names is not None:
+            query = query.where(TaskStatsTable.c.task.in_(task_names))
+        rows = await self.database.fetch_all(query=query)
+        return {row["task"]: TaskStats.from_dict(row["stats"]) for row in rows}
 
-        # delete the other tasks
-        query = Tasks.delete().where(~Tasks.c.name.in_(seen))
+    async def update_task_stats(self, task_name, update):
+        """
+        replace a task's stats with await update(stats), holding a lock on them
+
+        update is passed None if the task has no stats yet, and returns None to leave
+        them as they were.  Returns whether they were replaced.
+        """
+        async with transaction(self.database):
+            # a row lock can't cover stats that haven't been inserted yet
+            await self.database.execute(
+                query="SELECT pg_advisory_xact_lock(:lock_id, hashtext(:task))",
+                values={"lock_id": TASK_STATS_LOCK_ID, "task": task_name},
+            )
+            stats = (await self.get_task_stats([task_name])).get(task_name)
+            stats = await update(stats)
+            if stats is None:
+                return False
+            await self.set_task_stats(stats)
+        return True
+
+    async def set_task_stats(self, stats):
+        query = postgresql.insert(TaskStatsTable).values(
+            task=stats.task, stats=stats.to_dict()
+        )
+        query = query.on_conflict_do_update(
+            index_elements=[TaskStatsTable.c.task],
+            set_={"stats": query.excluded.stats},
+        )
+        await self.database.execute(query)
+
+    async def get_setting(self, key, default=None):
+        query = Settings.select().where(Settings.c.key == key)
+        row = await self.database.fetch_one(query=query)
+        return row["value"] if row else default
+
+    async def set_setting(self, key, value):
+        query = postgresql.insert(Settings).values(key=key, value=value)
+        query = query.on_conflict_do_update(
+            index_elements=[Settings.c.key], set_={"value": query.excluded.value}
+        )
         await self.database.execute(query)
 
     async def set_user(self, username, password, permissions):
@@ -1,43 +1,240 @@
+import asyncio
+import bisect
+import collections
+import contextlib
+import datetime
+import heapq
+import itertools
 from ..base import Status, User
-from ..utils import hash_password, verify_password
+from ..metrics import STORAGE_SECONDS, timed_methods
+from ..tracing import traced_methods
+from ..utils import diff_tasks, hash_password, verify_password
 
 
+def _insert_entry(entries, entry):
+    entries.insert(bisect.bisect(entries, entry[:2]), entry)
+
+
+def _remove_entry(entries, entry):
+    del entries[bisect.bisect_left(entries, entry[:2])]
+
+
+def _walk_back(entries, cursor):
+    """entries from just before cursor back to the oldest"""
+    end = len(entries) if cursor is None else bisect.bisect_left(entries, cursor)
+    return (entries[i] for i in range(end - 1, -1, -1))
+
+
+@timed_methods(STORAGE_SECONDS, "memory")
+@traced_methods(
+    exclude=("admission_lock",), hide_args=("check_password", "set_user")
+)
 class InMemoryStorage:
     def __init__(self):
         self.runs = []
         self.tasks = {}
         self.users = {}
+        self.settings = {}
+        self.task_stats = {}
+        self.log_cursors = {}
+        self._admission_lock = None
+        self._task_stats_lock = None
+
+    @property
+    def runs(self):
+        return list(self._runs)
+
+    @runs.setter
+    def runs(self, runs):
+        # runs are indexed by uuid and task, both kept in insertion order
+        self._runs = collections.deque()
+        self._runs_by_uuid = {}
+        self._runs_by_task = collections.defaultdict(collections.deque)
+        self._indexed_status = {}
+        self._run_order = {}
+        self._counter = itertools.count()
+        # and sorted by (start, insertion order) for get_runs, overall, per task and
+        # per status, as (start, order, run) entries so that a cursor can be bisected to
+        self._by_start = []
+        self._by_task_start = collections.defaultdict(list)
+        self._by_status_start = collections.defaultdict(list)
+        self._start_entries = {}
+        for run in runs:
+            self._index_run(run)
+
+    def _index_run(self, run):
+        self._runs.append(run)
+        self._runs_by_uuid[run.uuid] = run
+        self._runs_by_task[run.task].append(run)
+        self._indexed_status[run.uuid] = run.status
+        self._run_order[run.uuid] = next(self._counter)
+        self._index_start(run)
+
+    def _start_indexes(self, run):
+        return (
+            self._by_start,
+            self._by_task_start[run.task],
+            self._by_status_start[self._indexed_status[run.uuid]],
+        )
+
+    def _index_start(self, run):
+        entry = (run.start or "", self._run_order[run.uuid], run)
+        self._start_entries[run.uuid] = entry
+        # runs are mostly added in start order, so this is usually an append
+        for entries in self._start_indexes(run):
+            _insert_entry(entries, entry)
+
+    def _unindex_start(self, run):
+        entry = self._start_entries.pop(run.uuid)
+        for entries in self._start_indexes(run):
+            _remove_entry(entries, entry)
 
     async def connect(self):
         pass
 
+    @contextlib.asynccontextmanager
+    async def admission_lock(self):
+        # created here so it belongs to the running loop
+        if self._admission_lock is None:
+            self._admission_lock = asyncio.Lock()
+        async with self._admission_lock:
+            yield
+
     async def add_run(self, run):
-        self.runs.append(run)
+        self._index_run(run)
 
     async def save_run(self, run):
-        # run is modified in place
-        pass
+        # run is modified in place, only the status & start indexes need to change
+        old_status = self._indexed_status.get(run.uuid)
+        if old_status is None:
+            return
+        entry = self._start_entries[run.uuid]
+        if entry[0] != (run.start or ""):
+            # a queued run's start moves to when it was admitted
+            self._unindex_start(run)
+            self._indexed_status[run.uuid] = run.status
+            self._index_start(run)
+        elif old_status != run.status:
+            _remove_entry(self._by_status_start[old_status], entry)
+            self._indexed_status[run.uuid] = run.status
+            _insert_entry(self._by_status_start[run.status], entry)
+
+    async def get_run(self, run_id, *, logs=False):
+        # runs are kept with their logs, so there's nothing extra to load
+        return self._runs_by_uuid.get(run_id)
+
+    async def get_runs_by_id(self, run_ids):
+        runs = (self._runs_by_uuid.get(run_id) for run_id in run_ids)
+        return [run for run in runs if run]
+
+    async def append_logs(self, run, chunk, cursor=None, next_cursor=None):
+        if next_cursor is not None:
+            if self.log_cursors.get(run.uuid, {}) != (cursor or {}):
+                return False
+            self.log_cursors[run.uuid] = next_cursor
+        run.logs += chunk
+        return True
 
-    async def get_run(self, run_id):
-        run = [r for r in self.runs if r.uuid == run_id]
-        if run:
-            return run[0]
+    async def get_log_cursor(self, run_id):
+        return self.log_cursors.get(run_id, {})
 
-    async def get_runs(self, *, status=None, task_name=None, latest=None):
-        runs = [r for r in self.runs]
+    async def get_log_size(self, run_id):
+        run = await self.get_run(run_id)
+        return len(run.logs)
+
+    async def get_logs(self, run_id, offset=0, limit=None):
+        run = await self.get_run(run_id)
+        if limit is None:
+            return run.logs[offset:]
+        return run.logs[offset:offset + limit]
+
+    async def get_logs_tail(self, run_id, size):
+        run = await self.get_run(run_id)
+        return run.logs[-size:] if size else ""
+
+    async def get_runs(self, *, status=None, task_name=None, latest=None, before=None):
         if isinstance(status, Status):
-            runs = [r for r in runs if r.status == status]
+            statuses = {status}
         elif isinstance(status, list):
-            runs = [r for r in runs if r.status in status]
+            statuses = set(status)
         elif status:
             raise ValueError("status must be Status or list")
+        else:
+            statuses = None
+
+        # walk back from the cursor in start order, so latest only visits as many
+        # runs as it takes to find that many matches
         if task_name:
-            runs = [r for r in runs if r.task == task_name]
-        if latest:
-            # runs are in order, so just grab the tail
-            runs = runs[-latest:]
+            indexes = [self._by_task_start.get(task_name, [])]
+        elif statuses is not None:
+            indexes = [self._by_status_start.get(s, []) for s in statuses]
+        else:
+            indexes = [self._by_start]
+
+        cursor = None
+        if before:
+            cursor = (before[0] or "", self._run_order.get(before[1], -1))
+        walks = [_walk_back(entries, cursor) for entries in indexes]
+        if len(walks) == 1:
+            entries = walks[0]
+        else:
+            entries = heapq.merge(*walks, reverse=True)
+        matches = (entry[2] for entry in entries)
+        if task_name and statuses is not None:
+            matches = (r for r in matches if r.status in statuses)
+        runs = list(itertools.islice(matches, latest or None))
+        runs.reverse()
         return runs
 
+    async def find_run(self, key, value, *, status=None):
+        runs = await self.get_runs(status=status) if status else self._runs
+        for run in runs:
+            if run.run_info.get(key) == value:
+                return run
+
+    async def get_latest_runs_per_task(self, n, task_names=None):
+        if task_names is None:
+            task_names = self._runs_by_task.keys()
+        latest = {}
+        for task_name in task_names:
+            runs = self._runs_by_task.get(task_name)
+            if runs:
+                latest[task_name] = list(itertools.islice(reversed(runs), n))
+        return latest
+
+    def _started_before(self, task_name, before):
+        for run in self._runs_by_task.get(task_name, ()):
+            if run.start and datetime.datetime.fromisoformat(run.start) < before:
+                yield run
+
+    async def get_runs_to_archive(self, task_name, before, limit):
+        runs = [
+            run
+            for run in self._started_before(task_name, before)
+            if run.status.is_terminal() and not run.run_info.get("archived")
+        ]
+        runs.sort(key=lambda run: run.start)
+        return runs[:limit]
+
+    async def get_run_task_names(self):
+        return sorted(name for name, runs in self._runs_by_task.items() if runs)
+
+    async def mark_archived(self, runs, archive_name):
+        for run in runs:
+            run = self._runs_by_uuid[run.uuid]
+            run.run_info = dict(run.run_info, archived=archive_name)
+            run.logs = ""
+
+    async def delete_archived_runs(self, task_name, before):
+        expired = {
+            run.uuid
+            for run in self._started_before(task_name, before)
+            if run.run_info.get("archived")
+        }
+        if expired:
+            self.runs = [run for run in self._runs if run.uuid not in expired]
+        return len(expired)
+
     async def get_tasks(self):
         return list(self.tasks.values())
 
@@ -45,7 +242,36 @@ class InMemoryStorage:
         return self.tasks[name]
 
     async def set_tasks(self, tasks):
+        changes = diff_tasks(self.tasks.values(), tasks)
         self.tasks = {task.name: task for task in tasks}
+        return changes
+
+    async def get_task_stats(self, task_names=None):
+        if task_names is None:
+            return dict(self.task_stats)
+        return {
+            name: self.task_stats[name] for name in task_names if name in self.task_stats
+        }
+
+    async def update_task_stats(self, task_name, update):
+        # update can await, which would let another update read the same stats
+        if self._task_stats_lock is None:
+            self._task_stats_lock = asyncio.Lock()
+        async with self._task_stats_lock:
+            stats = await update(self.task_stats.get(task_name))
+            if stats is None:
+                return False
+            self.task_stats[task_name] = stats
+        return True
+
+    async def set_task_stats(self, stats):
+        self.task_stats[stats.task] = stats
+
+    async def get_setting(self, key, default=None):
+        return self.settings.get(key, default)
+
+    async def set_setting(self, key, value):
+        self.settings[key] = value
 
     async def get_users(self):
         return list(self.users.values())
@@ -0,0 +1,192 @@
+"""
+Versioned schema migrations for DatabaseStorage.
+
+Each migration is a version number, a description, and a list of SQL statements.
+The highest applied version is recorded in bobsled_schema_version, so a database
+that is already up to date costs a single query at startup.
+
+Migrations are only ever appended to, never edited once released.
+"""
+from .transactions import transaction
+
+# arbitrary key for pg_advisory_xact_lock, keeps web & beat from migrating at once
+MIGRATION_LOCK_ID = 1988
+
+MIGRATIONS = [
+    (
+        1,
+        "initial schema",
+        [
+            """CREATE TABLE IF NOT EXISTS bobsled_task (
+                name VARCHAR(100) PRIMARY KEY,
+                image VARCHAR(100),
+                tags JSON,
+                entrypoint VARCHAR(1000)[],
+                environment VARCHAR(100),
+                memory INTEGER,
+                cpu INTEGER,
+                enabled BOOLEAN,
+                timeout_minutes INTEGER,
+                error_threshold INTEGER,
+                triggers JSON,
+                next_tasks VARCHAR(100)[]
+            )""",
+            """CREATE TABLE IF NOT EXISTS bobsled_run (
+                uuid VARCHAR(50) PRIMARY KEY,
+                status VARCHAR(50),
+                task VARCHAR(100) REFERENCES bobsled_task (name),
+                start VARCHAR(50),
+                "end" VARCHAR(50),
+                logs VARCHAR,
+                exit_code INTEGER,
+                run_info_json JSON
+            )""",
+            """CREATE TABLE IF NOT EXISTS bobsled_user (
+                username VARCHAR(100),
+                password VARCHAR(100),
+                permissions VARCHAR(100)[]
+            )""",
+        ],
+    ),
+    (
+        2,
+        "chunked run logs",
+        [
+            """CREATE TABLE IF NOT EXISTS bobsled_run_log (
+                run_uuid VARCHAR(50) REFERENCES bobsled_run (uuid),
+                seq INTEGER,
+                log_offset INTEGER,
+                chunk VARCHAR,
+                PRIMARY KEY (run_uuid, seq)
+            )""",
+        ],
+    ),
+    (
+        3,
+        "move bobsled_run.logs into bobsled_run_log",
+        [
+            # make room at the front for runs that already have chunks
+            """UPDATE bobsled_run_log AS l
+                SET seq = l.seq + 1000000, log_offset = l.log_offset + length(r.logs)
+                FROM bobsled_run AS r
+                WHERE l.run_uuid = r.uuid AND r.logs <> ''""",
+            """INSERT INTO bobsled_run_log (run_uuid, seq, log_offset, chunk)
+                SELECT uuid, 0, 0, logs FROM bobsled_run WHERE logs <> ''""",
+            """ALTER TABLE bobsled_run DROP COLUMN logs""",
+        ],
+    ),
+    (
+        4,
+        "timestamp columns for bobsled_run start & end",
+        [
+            """ALTER TABLE bobsled_run
+                ALTER COLUMN start TYPE TIMESTAMP USING NULLIF(start, '')::timestamp,
+                ALTER COLUMN "end" TYPE TIMESTAMP USING NULLIF("end", '')::timestamp
+            """,
+        ],
+    ),
+    (
+        5,
+        "bobsled_run indexes",
+        [
+            """CREATE INDEX IF NOT EXISTS bobsled_run_task_start_uuid
+                ON bobsled_run (task, start DESC NULLS LAST, uuid DESC)""",
+            """CREATE INDEX IF NOT EXISTS bobsled_run_status ON bobsled_run (status)""",
+        ],
+    ),
+    (
+        6,
+        "bobsled_setting key/value table",
+        [
+            """CREATE TABLE IF NOT EXISTS bobsled_setting (
+                key VARCHAR(100) PRIMARY KEY,
+                value JSON
+            )""",
+        ],
+    ),
+    (
+        7,
+        "bobsled_run (start, uuid) index for keyset pagination",
+        [
+            """CREATE INDEX IF NOT EXISTS bobsled_run_start_uuid
+                ON bobsled_run (start DESC NULLS LAST, uuid DESC)""",
+        ],
+    ),
+    (
+        8,
+        "bobsled_task_stats",
+        [
+            """CREATE TABLE IF NOT EXISTS bobsled_task_stats (
+                task VARCHAR(100) PRIMARY KEY,
+                stats JSON
+            )""",
+        ],
+    ),
+    (
+        9,
+        "bobsled_run.log_cursor, moved out of run_info for unfinished runs",
+        [
+            """ALTER TABLE bobsled_run ADD COLUMN IF NOT EXISTS log_cursor JSONB""",
+            """UPDATE bobsled_run SET log_cursor = jsonb_strip_nulls(
+                    jsonb_build_object(
+                        'log_offset', (run_info_json #>> '{}')::jsonb -> 'log_offset',
+                        'log_token', (run_info_json #>> '{}')::jsonb -> 'log_token',
+                        'log_lines', (run_info_json #>> '{}')::jsonb -> 'log_lines'
+                    )
+                )
+                WHERE status IN ('Pending', 'Running')""",
+        ],
+    ),
+    (
+        10,
+        "runs outlive their task, so a task with runs can be removed from the config",
+        [
+            # set_tasks deletes tasks that left the config, which the foreign key
+            # refused while they had runs, and retention goes on archiving the runs
+            # of removed tasks by name, so bobsled_run.task can't reference the task
+            """ALTER TABLE bobsled_run
+                DROP CONSTRAINT IF EXISTS bobsled_run_task_fkey""",
+        ],
+    ),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def get_version(database):
+    await database.execute(
+        "CREATE TABLE IF NOT EXISTS bobsled_schema_version (version INTEGER NOT NULL)"
+    )
+    version = await database.fetch_val(
+        "SELECT max(version) FROM bobsled_schema_version"
+    )
+    return version or 0
+
+
+async def migrate(database):
+    """
+    bring the schema up to date, returns the list of versions that were applied
+    """
+    if await get_version(database) == LATEST_VERSION:
+        return []
+
+    applied = []
+    async with transaction(database):
+        await database.execute(
+            query="SELECT pg_advisory_xact_lock(:lock_id)",
+            values={"lock_id": MIGRATION_LOCK_ID},
+        )
+        # another process may have migrated while we waited for the lock
+        version = await get_version(database)
+        for number, description, statements in MIGRATIONS:
+            if number <= version:
+                continue
+            print(f"applying migration {number}: {description}")
+            for statement in statements:
+                await database.execute(statement)
+            await database.execute(
+                query="INSERT INTO bobsled_schema_version (version) VALUES (:version)",
+                values={"version": number},
+            )
+            applied.append(number)
+    return applied
@@ -0,0 +1,33 @@
+import contextlib
+import contextvars
+from databases.core import Connection
+
+# the database this task is in a transaction on, if any
+_in_transaction = contextvars.ContextVar("bobsled_in_transaction", default=None)
+
+
+@contextlib.asynccontextmanager
+async def transaction(database):
+    """
+    a transaction that every query this task makes on database runs in
+
+    databases 0.5 opens database.transaction() on a new connection but keeps running
+    queries on the task's existing one, which tasks gathered from the same parent
+    share as well.  So the transaction gets a connection of its own, and the task's
+    queries are pointed at it until the transaction ends.  Nested transactions are
+    savepoints on that connection.
+    """
+    if _in_transaction.get() is database:
+        async with database.connection().transaction():
+            yield
+        return
+
+    connection = Connection(database._backend)
+    connection_token = database._connection_context.set(connection)
+    token = _in_transaction.set(database)
+    try:
+        async with connection.transaction():
+            yield
+    finally:
+        _in_transaction.reset(token)
+        database._connection_context.reset(connection_token)
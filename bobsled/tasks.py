@@ -1,5 +1,6 @@
+import asyncio
 from .base import Task, Trigger
-from .utils import load_github_or_local_yaml
+from .utils import YamlLoader
 
 
 class TaskProvider:
@@ -19,21 +20,41 @@ class TaskProvider:
         self.github_user = BOBSLED_CONFIG_GITHUB_USER
         self.github_repo = BOBSLED_CONFIG_GITHUB_REPO
         self.github_api_key = BOBSLED_GITHUB_API_KEY
+        self._loader = None
 
         if not self.filename and not self.dirname:
             raise EnvironmentError(
                 "must provide either BOBSLED_TASKS_FILENAME or BOBSLED_TASKS_DIRNAME"
             )
 
-    async def update_tasks(self):
-        data = load_github_or_local_yaml(
+    @property
+    def loader(self):
+        # rebuilt if the source is changed after creation
+        if not self._loader or (self._loader.filename, self._loader.dirname) != (
             self.filename,
             self.dirname,
-            self.github_user,
-            self.github_repo,
-            self.github_api_key,
-        )
+        ):
+            self._loader = YamlLoader(
+                self.filename,
+                self.dirname,
+                self.github_user,
+                self.github_repo,
+                self.github_api_key,
+            )
+        return self._loader
+
+    async def update_tasks(self):
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, self.loader.load)
+        if data is None:
+            print("tasks unchanged")
+            return {"added": [], "updated": [], "removed": []}
         tasks = [Task(name=name, **taskdef) for name, taskdef in data.items()]
         for task in tasks:
             task.triggers = [Trigger(**t) for t in task.triggers]
-        await self.storage.set_tasks(tasks)
+        changes = await self.storage.set_tasks(tasks)
+        print(
+            f"updated tasks: {len(changes['added'])} added, "
+            f"{len(changes['updated'])} updated, {len(changes['removed'])} removed"
+        )
+        return changes
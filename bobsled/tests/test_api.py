@@ -1,5 +1,6 @@
+import pytest
 from starlette.testclient import TestClient
-from ..web import app, bobsled
+from ..web import app, bobsled, _poll_run
 from ..utils import hash_password
 from ..base import User, Run, Status
 
@@ -64,6 +65,23 @@ def test_overview():
     assert response.json()["runs"][0]["duration"] == "25:02:03"
 
 
+def test_latest_runs_pages():
+    bobsled.storage.runs = [
+        Run("hello-world", Status.Success, f"2020-01-{day:02d}T00:00:00")
+        for day in range(1, 11)
+    ]
+    with TestClient(app) as client:
+        client.post("/login", {"username": "sample", "password": "password"})
+        starts = []
+        cursor = ""
+        while cursor is not None:
+            response = client.get(f"/api/latest_runs?limit=4&before={cursor}")
+            starts.extend(r["start"][:10] for r in response.json()["runs"])
+            cursor = response.json()["next"]
+        assert client.get("/api/latest_runs?limit=0").status_code == 400
+    assert starts == [f"2020-01-{day:02d}" for day in range(10, 0, -1)]
+
+
 def test_run_perms():
     # test these together because there's weirdness in running twice
     with TestClient(app) as client:
@@ -89,9 +107,53 @@ def test_websocket():
     uuid = response.json()["uuid"]
     with client.websocket_connect(f"/ws/logs/{uuid}") as websocket:
         data = websocket.receive_json()
+        assert data["type"] == "snapshot"
+        assert data["seq"] == 0
         assert data["logs"] == "'hello alpine'\n"
 
 
+@pytest.mark.asyncio
+async def test_poll_run_deltas(monkeypatch):
+    run = Run("hello-world", Status.Running, logs="hello\n")
+    bobsled.storage.runs = [run]
+
+    async def update_status(run_id, update_logs=False):
+        return run
+
+    monkeypatch.setattr(bobsled.run, "update_status", update_status)
+    state = {}
+
+    snapshot, done = await _poll_run(run.uuid, state)
+    assert not done
+    assert snapshot["type"] == "snapshot"
+    assert snapshot["seq"] == 0
+    assert snapshot["run"]["status"] == "Running"
+    assert "logs" not in snapshot["run"]
+    assert snapshot["logs"] == "hello\n"
+    assert (snapshot["log_start"], snapshot["log_end"]) == (0, 6)
+
+    # nothing changed, nothing to send
+    assert await _poll_run(run.uuid, state) == (None, False)
+
+    await bobsled.storage.append_logs(run, "world\n")
+    delta, done = await _poll_run(run.uuid, state)
+    assert delta == {
+        "type": "delta",
+        "seq": 1,
+        "changes": {},
+        "logs": "world\n",
+        "log_start": 6,
+        "log_end": 12,
+    }
+
+    run.status = Status.Success
+    delta, done = await _poll_run(run.uuid, state)
+    assert done
+    assert delta["seq"] == 2
+    assert delta["changes"] == {"status": "Success"}
+    assert delta["logs"] == ""
+
+
 def test_update_tasks():
     with TestClient(app) as client:
         client.post("/login", {"username": "admin", "password": "password"})
@@ -106,3 +168,79 @@ def test_update_tasks():
         resp = client.post("/api/update_config")
         assert resp.status_code == 200
         assert {"hello-world2"} == {t["name"] for t in resp.json()["tasks"]}
+
+
+def test_run_logs():
+    run = Run("hello-world", Status.Success, logs="hello\nworld\nagain\n")
+    bobsled.storage.runs = [run]
+    with TestClient(app) as client:
+        client.post("/login", {"username": "sample", "password": "password"})
+        response = client.get(f"/api/run/{run.uuid}/logs")
+        assert response.text == "hello\nworld\nagain\n"
+        assert response.headers["content-type"].startswith("text/plain")
+        assert response.headers["x-next-offset"] == "18"
+
+        response = client.get(f"/api/run/{run.uuid}/logs?offset=3&limit=5")
+        assert response.text == "lo\nwo"
+        assert response.headers["x-log-offset"] == "3"
+        assert response.headers["x-next-offset"] == "8"
+
+        response = client.get(f"/api/run/{run.uuid}/logs?tail=6")
+        assert response.text == "again\n"
+        assert response.headers["x-log-offset"] == "12"
+
+        # nothing new past the end
+        response = client.get(f"/api/run/{run.uuid}/logs?offset=18")
+        assert response.text == ""
+        assert response.headers["x-next-offset"] == "18"
+
+        assert client.get(f"/api/run/{run.uuid}/logs?offset=-1").status_code == 400
+        assert client.get("/api/run/nope/logs").status_code == 404
+
+
+def test_run_logs_archived(monkeypatch):
+    pruned = Run(
+        "hello-world", Status.Success, run_info={"archived": "runs-1.jsonl.gz"}
+    )
+    deleted = Run("hello-world", Status.Error, logs="deleted\n")
+    bobsled.storage.runs = [pruned]
+    archive = {
+        pruned.uuid: Run(
+            "hello-world", Status.Success, logs="hello\nworld\n", uuid=pruned.uuid
+        ),
+        deleted.uuid: deleted,
+    }
+
+    async def get_archived_run(run_id):
+        return archive.get(run_id)
+
+    monkeypatch.setattr(bobsled.retention, "get_archived_run", get_archived_run)
+    with TestClient(app) as client:
+        client.post("/login", {"username": "sample", "password": "password"})
+        response = client.get(f"/api/run/{pruned.uuid}/logs?offset=6")
+        assert response.text == "world\n"
+        assert response.headers["x-log-offset"] == "6"
+        assert response.headers["x-next-offset"] == "12"
+
+        response = client.get(f"/api/run/{deleted.uuid}/logs?tail=3")
+        assert response.text == "ed\n"
+        assert response.headers["x-next-offset"] == "8"
+
+
+def test_metrics_auth(monkeypatch):
+    monkeypatch.setitem(bobsled.settings, "metrics_token", "scrape")
+    with TestClient(app) as client:
+        assert client.get("/metrics").status_code == 403
+        bad = {"Authorization": "Bearer wrong"}
+        assert client.get("/metrics", headers=bad).status_code == 403
+
+        # the token is good for /metrics and nothing else
+        scraper = {"Authorization": "Bearer scrape"}
+        response = client.get("/metrics", headers=scraper)
+        assert response.status_code == 200
+        assert "bobsled_runs_started_total" in response.text
+        response = client.get("/api/index", headers=scraper, allow_redirects=False)
+        assert response.headers["location"].endswith("/login")
+
+        client.post("/login", {"username": "sample", "password": "password"})
+        assert client.get("/metrics").status_code == 200
@@ -1,4 +1,9 @@
-from ..base import Task
+import pytest
+from ..base import Run, RunService, Status, Task
+from ..exceptions import AlreadyRunning
+from ..limits import ConcurrencyLimits
+from ..metrics import RUNS_FINISHED
+from ..storages import InMemoryStorage
 
 
 def test_task_entrypoint():
@@ -9,3 +14,216 @@ def test_task_entrypoint():
         "right",
         "way",
     ]
+
+
+class FakeRunService(RunService):
+    STARTING_STATUS = Status.Running
+
+    def __init__(self, limits):
+        self.storage = InMemoryStorage()
+        self.callbacks = []
+        self.limits = limits
+        self.started = []
+
+    async def start_task(self, task):
+        if task.image == "broken":
+            raise ValueError("no such image")
+        self.started.append(task.name)
+        return {}
+
+    async def stop(self, run):
+        pass
+
+    async def finish(self, run):
+        run.status = Status.Success
+        await self._save_and_followup(run)
+
+
+def test_limits_allows():
+    limits = ConcurrencyLimits(
+        BOBSLED_MAX_RUNS="3",
+        BOBSLED_TAG_LIMITS="scraper=2, heavy=1",
+        BOBSLED_CPU_BUDGET="1024",
+    )
+    scraper = Task("s", "image", tags=["scraper"])
+    heavy = Task("h", "image", tags=["heavy"], cpu=1024)
+    plain = Task("p", "image")
+
+    assert limits.allows(scraper, [scraper])
+    assert not limits.allows(scraper, [scraper, scraper])
+    assert not limits.allows(plain, [plain, plain, plain])
+    assert not limits.allows(plain, [heavy])
+    # bigger than the whole budget, but allowed on its own
+    assert limits.allows(Task("huge", "image", cpu=4096), [])
+    assert not ConcurrencyLimits().enabled
+
+
+@pytest.mark.asyncio
+async def test_concurrency_queue():
+    rs = FakeRunService(ConcurrencyLimits(BOBSLED_MAX_RUNS="2"))
+    tasks = [Task(name, "image") for name in "abcd"]
+    await rs.storage.set_tasks(tasks)
+
+    runs = [await rs.run_task(task) for task in tasks]
+    assert [run.status for run in runs] == [Status.Running] * 2 + [Status.Pending] * 2
+    assert [run.queued for run in runs] == [False, False, True, True]
+    assert rs.started == ["a", "b"]
+    assert (await rs.get_queue_stats())["depth"] == 2
+    with pytest.raises(AlreadyRunning):
+        await rs.run_task(tasks[2])
+
+    # finishing a run admits the oldest queued run
+    await rs.finish(runs[0])
+    assert rs.started == ["a", "b", "c"]
+    assert runs[2].status == Status.Running
+    assert runs[2].run_info["wait_seconds"] >= 0
+
+    # stopping a queued run just removes it from the queue
+    await rs.stop_run(runs[3].uuid)
+    assert runs[3].status == Status.UserKilled
+    await rs.finish(runs[1])
+    assert rs.started == ["a", "b", "c"]
+    assert await rs.get_queued_runs() == []
+
+
+@pytest.mark.asyncio
+async def test_concurrency_queue_skips_runs_that_dont_fit():
+    rs = FakeRunService(ConcurrencyLimits(BOBSLED_MEMORY_BUDGET="1024"))
+    big = Task("big", "image", memory=1024)
+    small = Task("small", "image", memory=256)
+    small2 = Task("small2", "image", memory=256)
+    await rs.storage.set_tasks([big, small, small2])
+
+    first = await rs.run_task(small)
+    queued_big = await rs.run_task(big)
+    # big is first in line but doesn't fit, small2 can go around it
+    await rs.run_task(small2)
+    assert rs.started == ["small", "small2"]
+    assert queued_big.queued
+
+    await rs.finish(first)
+    assert rs.started == ["small", "small2"]
+    await rs.finish((await rs.get_runs(task_name="small2"))[0])
+    assert rs.started == ["small", "small2", "big"]
+
+
+@pytest.mark.asyncio
+async def test_concurrency_queue_waits_for_starved_run():
+    rs = FakeRunService(
+        ConcurrencyLimits(BOBSLED_MEMORY_BUDGET="1024", BOBSLED_QUEUE_SKIP_SECONDS="0")
+    )
+    big = Task("big", "image", memory=1024)
+    small = Task("small", "image", memory=256)
+    small2 = Task("small2", "image", memory=256)
+    await rs.storage.set_tasks([big, small, small2])
+
+    first = await rs.run_task(small)
+    await rs.run_task(big)
+    # big has already waited long enough, so small2 can't go around it
+    await rs.run_task(small2)
+    assert rs.started == ["small"]
+
+    await rs.finish(first)
+    assert rs.started == ["small", "big"]
+    await rs.finish((await rs.get_runs(task_name="big"))[0])
+    assert rs.started == ["small", "big", "small2"]
+
+
+class RecordingCallback:
+    def __init__(self):
+        self.errors = []
+
+    async def on_success(self, run, storage):
+        pass
+
+    async def on_error(self, run, storage):
+        self.errors.append(run)
+
+
+@pytest.mark.asyncio
+async def test_concurrency_queue_start_failure():
+    rs = FakeRunService(ConcurrencyLimits(BOBSLED_MAX_RUNS="1"))
+    callback = RecordingCallback()
+    rs.callbacks = [callback]
+    first = Task("first", "image")
+    broken = Task("broken", "broken")
+    after = Task("after", "image")
+    await rs.storage.set_tasks([first, broken, after])
+
+    run = await rs.run_task(first)
+    queued_broken = await rs.run_task(broken)
+    await rs.run_task(after)
+
+    # the broken run errors out and the run behind it takes the slot
+    await rs.finish(run)
+    assert rs.started == ["first", "after"]
+    queued_broken = await rs.storage.get_run(queued_broken.uuid, logs=True)
+    assert queued_broken.status == Status.Error
+    assert "no such image" in queued_broken.logs
+    assert [r.uuid for r in callback.errors] == [queued_broken.uuid]
+
+
+@pytest.mark.asyncio
+async def test_task_stats_recorded():
+    rs = FakeRunService(ConcurrencyLimits())
+    task = Task("a", "image")
+    await rs.storage.set_tasks([task])
+
+    run = await rs.run_task(task)
+    assert await rs.get_task_stats() == {}
+    await rs.finish(run)
+    # saving the finished run again doesn't count it twice
+    await rs._save_and_followup(run)
+    stats = (await rs.get_task_stats(["a"]))["a"]
+    assert stats.runs == stats.successes == 1
+    assert stats.last_run == run.uuid
+
+
+@pytest.mark.asyncio
+async def test_task_stats_every_terminal_status():
+    rs = FakeRunService(ConcurrencyLimits(BOBSLED_MAX_RUNS="1"))
+    first = Task("first", "image")
+    gone = Task("gone", "image")
+    await rs.storage.set_tasks([first, gone])
+
+    run = await rs.run_task(first)
+    await rs.run_task(gone)
+    # stopped by a user, and removed from the config while queued
+    await rs.storage.set_tasks([first])
+    await rs.stop_run(run.uuid)
+    stats = await rs.get_task_stats()
+    assert stats["first"].last_status == "UserKilled"
+    assert stats["gone"].last_status == "Missing"
+
+
+@pytest.mark.asyncio
+async def test_task_stats_started_from_history():
+    rs = FakeRunService(ConcurrencyLimits())
+    task = Task("a", "image")
+    await rs.storage.set_tasks([task])
+    # runs from before stats were kept
+    for day, status in enumerate([Status.Success, Status.Error, Status.Error], 1):
+        await rs.storage.add_run(Run("a", status, start=f"2020-01-0{day}T00:00:00"))
+
+    run = await rs.run_task(task)
+    run.status = Status.Error
+    await rs._save_and_followup(run)
+    stats = (await rs.get_task_stats(["a"]))["a"]
+    assert stats.runs == 4
+    assert stats.failure_streak == 3
+
+
+@pytest.mark.asyncio
+async def test_runs_finished_metric():
+    rs = FakeRunService(ConcurrencyLimits(BOBSLED_MAX_RUNS="1"))
+    tasks = [Task(name, "image") for name in ("a", "b")]
+    await rs.storage.set_tasks(tasks)
+    killed = RUNS_FINISHED.labels("UserKilled").value
+    missing = RUNS_FINISHED.labels("Missing").value
+
+    run = await rs.run_task(tasks[0])
+    await rs.run_task(tasks[1])
+    await rs.storage.set_tasks(tasks[:1])
+    await rs.stop_run(run.uuid)
+    assert RUNS_FINISHED.labels("UserKilled").value == killed + 1
+    assert RUNS_FINISHED.labels("Missing").value == missing + 1
@@ -1,5 +1,9 @@
+import asyncio
 import datetime
-from ..beat import next_cron
+import pytest
+from ..base import Task, Trigger
+from ..beat import next_cron, next_run_for_task, Scheduler
+from ..utils import run_forever
 
 midnight = datetime.datetime(2020, 1, 1, 0, 0)
 noon = datetime.datetime(2020, 1, 1, 12, 0)
@@ -96,3 +100,93 @@ def test_dow():
     assert next_cron("0 4 * * 1,5", wed).weekday() == 5  # saturday
     wed = datetime.datetime(2021, 2, 28)  # a sunday
     assert next_cron("0 4 * * 1,5", wed).weekday() == 1  # tuesday
+
+
+def _task(name, *crons, enabled=True):
+    return Task(
+        name, "image", enabled=enabled, triggers=[Trigger(cron) for cron in crons]
+    )
+
+
+def test_next_run_for_task_multiple_triggers():
+    task = _task("two", "0 4 * * ?", "0 16 * * ?")
+    assert next_run_for_task(task, noon) == datetime.datetime(2020, 1, 1, 16, 0)
+    assert next_run_for_task(task, ninepm) == datetime.datetime(2020, 1, 2, 4, 0)
+    assert next_run_for_task(_task("none"), noon) is None
+
+
+def test_scheduler_pop_due():
+    scheduler = Scheduler()
+    scheduler.set_tasks(
+        [
+            _task("four", "0 4 * * ?"),
+            _task("hourly", "0 * * * ?"),
+            _task("disabled", "* * * * ?", enabled=False),
+            _task("manual"),
+        ],
+        now=midnight,
+    )
+    assert scheduler.next_deadline() == datetime.datetime(2020, 1, 1, 1, 0)
+    assert scheduler.pop_due(midnight) == []
+
+    assert scheduler.pop_due(datetime.datetime(2020, 1, 1, 1, 0)) == ["hourly"]
+    assert scheduler.next_runs["hourly"] == datetime.datetime(2020, 1, 1, 2, 0)
+
+    # a late wakeup runs each due task once & reschedules from now
+    late = datetime.datetime(2020, 1, 1, 4, 30)
+    assert sorted(scheduler.pop_due(late)) == ["four", "hourly"]
+    assert scheduler.next_runs == {
+        "four": datetime.datetime(2020, 1, 2, 4, 0),
+        "hourly": datetime.datetime(2020, 1, 1, 5, 0),
+    }
+
+
+def test_scheduler_set_tasks_keeps_due():
+    scheduler = Scheduler()
+    scheduler.set_tasks([_task("four", "0 4 * * ?")], now=midnight)
+    four = datetime.datetime(2020, 1, 1, 4, 0)
+    # refreshed after the deadline passed but before it was popped
+    scheduler.set_tasks(
+        [_task("four", "0 4 * * ?"), _task("new", "0 4 * * ?")],
+        now=four + datetime.timedelta(seconds=1),
+    )
+    assert scheduler.pop_due(four + datetime.timedelta(seconds=2)) == ["four"]
+
+
+@pytest.mark.asyncio
+async def test_scheduler_wait_wakes_on_change():
+    scheduler = Scheduler()
+    waiter = asyncio.ensure_future(scheduler.wait())
+    await asyncio.sleep(0)
+    assert not waiter.done()
+    scheduler.set_tasks([_task("hourly", "0 * * * ?")])
+    await asyncio.wait_for(waiter, 1)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_wait_until_deadline():
+    scheduler = Scheduler()
+    scheduler.set_tasks([_task("hourly", "0 * * * ?")])
+    # pretend the next run is just about due
+    deadline = datetime.datetime.utcnow() + datetime.timedelta(milliseconds=50)
+    scheduler.heap = [(deadline, "hourly")]
+    await asyncio.wait_for(scheduler.wait(), 1)
+    assert datetime.datetime.utcnow() >= deadline
+
+
+@pytest.mark.asyncio
+async def test_run_forever_restarts_failed_loop():
+    attempts = []
+    messages = []
+
+    async def loop():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ValueError("boom")
+        return "finished"
+
+    assert await run_forever("loop", loop, messages.append, 0) == "finished"
+    assert len(attempts) == 3
+    assert len(messages) == 2
+    assert messages[0].startswith("loop failed, restarting in 0s")
+    assert "ValueError: boom" in messages[0]
@@ -0,0 +1,102 @@
+import datetime
+import pytest
+from ..cron import parse_cron, parse_field
+
+dt = datetime.datetime
+
+
+def test_parse_field():
+    assert parse_field("*", 0, 6) == 0b1111111
+    assert parse_field("1,3", 0, 6) == 0b1010
+    assert parse_field("1-3", 0, 6) == 0b1110
+    assert parse_field("*/2", 0, 6) == 0b1010101
+    assert parse_field("1-5/2", 0, 6) == 0b101010
+    assert parse_field("4/1", 0, 6) == 0b1110000
+    assert parse_field("1,4-5", 0, 6) == 0b110010
+
+
+@pytest.mark.parametrize(
+    "cronstr",
+    ["0 4 * *", "60 * * * *", "0 24 * * ?", "0 0 0 * *", "0 0 * 13 *", "*/0 * * * *"],
+)
+def test_invalid(cronstr):
+    with pytest.raises(ValueError):
+        parse_cron(cronstr)
+
+
+def test_never_fires():
+    with pytest.raises(ValueError):
+        parse_cron("0 0 31 2 *")
+    # fine as long as some month has the day
+    assert parse_cron("0 0 31 2,3 *").next_fire(dt(2020, 1, 1)) == dt(2020, 3, 31)
+
+
+def test_minute_step():
+    # steps are over the field's own range, not 24
+    cron = parse_cron("*/15 * * * *")
+    assert cron.next_fire(dt(2020, 1, 1, 0, 0)) == dt(2020, 1, 1, 0, 15)
+    assert cron.next_fire(dt(2020, 1, 1, 0, 46)) == dt(2020, 1, 1, 1, 0)
+
+
+def test_month_field():
+    cron = parse_cron("0 0 1 3 *")
+    # year rollover from a month other than december
+    assert cron.next_fire(dt(2020, 4, 1)) == dt(2021, 3, 1)
+    assert parse_cron("0 0 1 JAN,JUL *").next_fire(dt(2020, 2, 1)) == dt(2020, 7, 1)
+
+
+def test_leap_day():
+    assert parse_cron("0 0 29 2 *").next_fire(dt(2020, 3, 1)) == dt(2024, 2, 29)
+
+
+def test_dow_names():
+    wed = dt(2021, 2, 24)
+    assert parse_cron("0 4 * * MON").next_fire(wed) == dt(2021, 3, 1, 4)
+    assert parse_cron("0 4 * * sat-sun").next_fire(wed) == dt(2021, 2, 27, 4)
+
+
+def test_dom_and_dow():
+    # the 13th, but only if it is a friday
+    cron = parse_cron("0 0 13 * FRI")
+    assert cron.next_fire(dt(2020, 1, 1)) == dt(2020, 3, 13)
+    assert cron.next_fire(dt(2020, 3, 13)) == dt(2020, 11, 13)
+
+
+def test_aliases():
+    assert parse_cron("@daily").next_fire(dt(2020, 1, 1, 12)) == dt(2020, 1, 2)
+    assert parse_cron("@hourly").next_fire(dt(2020, 1, 1, 12, 1)) == dt(2020, 1, 1, 13)
+    assert parse_cron("@weekly").next_fire(dt(2020, 1, 1)).weekday() == 6
+
+
+def test_seconds_ignored():
+    cron = parse_cron("* * * * *")
+    assert cron.next_fire(dt(2020, 1, 1, 0, 0, 59, 1)) == dt(2020, 1, 1, 0, 1)
+
+
+def test_fire_times():
+    cron = parse_cron("0 */6 * * ?")
+    assert list(cron.fire_times(dt(2020, 1, 1), dt(2020, 1, 2))) == [
+        dt(2020, 1, 1, 6),
+        dt(2020, 1, 1, 12),
+        dt(2020, 1, 1, 18),
+        dt(2020, 1, 2, 0),
+    ]
+
+
+def test_matches_brute_force():
+    start = dt(2020, 2, 20)
+    for cronstr in ["7,37 */5 * * ?", "0 12 1-7 * 0", "30 2 28-31 1-3 *"]:
+        cron = parse_cron(cronstr)
+        expected = []
+        t = start
+        while len(expected) < 10:
+            t += datetime.timedelta(minutes=1)
+            if (
+                cron.minutes & (1 << t.minute)
+                and cron.hours & (1 << t.hour)
+                and cron.days & (1 << t.day)
+                and cron.months & (1 << t.month)
+                and cron.days_of_week & (1 << t.weekday())
+            ):
+                expected.append(t)
+        assert list(cron.fire_times(start, expected[-1])) == expected
@@ -1,7 +1,10 @@
 import os
+import boto3
 import pytest
 from unittest import mock
-from ..environment import EnvironmentProvider
+from moto import mock_ssm
+from .. import aws
+from ..environment import EnvironmentProvider, SecretMasker
 from ..base import Environment
 
 
@@ -34,14 +37,96 @@ async def test_mask_variables(simpleenv):
     )
 
 
+def test_secret_masker_longest_first():
+    masker = SecretMasker({"abc": "**A**", "abcdef": "**B**"})
+    assert masker.mask("abcdef abc abcde") == "**B** **A** **A**de"
+
+
+@pytest.mark.asyncio
+async def test_mask_stream(simpleenv):
+    await simpleenv.update_environments()
+    stream = simpleenv.mask_stream()
+    # secret is split across chunks
+    output = stream.feed("a secret: 1") + stream.feed("23, and 12") + stream.flush()
+    assert output == "a secret: **ONE/NUMBER**, and 12"
+
+
 @pytest.mark.asyncio
 async def test_get_environment_paramstore():
     filename = os.path.join(os.path.dirname(__file__), "paramstore_env.yml")
     psenv = EnvironmentProvider(filename)
-    # patch paramstore loader so we don't have to do a bunch of moto stuff that
-    # doesn't really work well with async
-    with mock.patch("bobsled.environment.paramstore_loader", new=lambda x: "ps-" + x):
+    with mock_ssm():
+        ssm = boto3.client("ssm")
+        ssm.put_parameter(Name="/bobsledtest/number", Value="42", Type="SecureString")
+        ssm.put_parameter(Name="/bobsledtest/word", Value="hi", Type="String")
         await psenv.update_environments()
     assert psenv.get_environment("one") == Environment(
-        "one", {"number": "ps-/bobsledtest/number", "word": "ps-/bobsledtest/word"}, []
+        "one", {"number": "42", "word": "hi"}, []
+    )
+
+
+@pytest.mark.asyncio
+async def test_paramstore_batched_and_cached(tmp_path):
+    filename = tmp_path / "env.yml"
+    filename.write_text(
+        "".join(
+            f"env{e}:\n"
+            + "".join(
+                f"  - variable: var{v}\n    paramstore: /bobsledtest/{e}/{v}\n"
+                for v in range(5)
+            )
+            for e in range(5)
+        )
+    )
+    psenv = EnvironmentProvider(str(filename))
+    calls = []
+
+    async def counting_call(service, method, **kwargs):
+        calls.append(len(kwargs["Names"]))
+        return await real_call(service, method, **kwargs)
+
+    real_call = aws.call
+    with mock_ssm(), mock.patch("bobsled.aws.call", new=counting_call):
+        ssm = boto3.client("ssm")
+        for e in range(5):
+            for v in range(5):
+                ssm.put_parameter(
+                    Name=f"/bobsledtest/{e}/{v}", Value=f"{e}-{v}", Type="String"
+                )
+        await psenv.update_environments()
+        # 25 parameters in 3 calls, instead of 25
+        assert sorted(calls) == [5, 10, 10]
+        assert psenv.get_environment("env3").values["var4"] == "3-4"
+
+        # everything is cached, so a refresh doesn't call paramstore
+        await psenv.update_environments()
+        assert len(calls) == 3
+
+        # only expired values are fetched again
+        psenv.paramstore_cache["/bobsledtest/1/1"] = ("old", 0)
+        await psenv.update_environments()
+        assert calls[3:] == [1]
+
+
+@pytest.mark.asyncio
+async def test_removed_environment(tmp_path):
+    filename = tmp_path / "env.yml"
+    filename.write_text(
+        "keep:\n  - variable: a\n    string: kept-secret\n"
+        "gone:\n  - variable: b\n    paramstore: /bobsledtest/gone\n"
     )
+    psenv = EnvironmentProvider(str(filename))
+    with mock_ssm():
+        boto3.client("ssm").put_parameter(
+            Name="/bobsledtest/gone", Value="gone-secret", Type="String"
+        )
+        await psenv.update_environments()
+        assert psenv.mask_variables("gone-secret") == "**GONE/B**"
+
+        filename.write_text("keep:\n  - variable: a\n    string: kept-secret\n")
+        await psenv.update_environments()
+    assert psenv.get_environment_names() == ["keep"]
+    assert psenv.paramstore_cache == {}
+    assert psenv.mask_variables("gone-secret kept-secret") == "gone-secret **KEEP/A**"
+    with pytest.raises(KeyError):
+        psenv.get_environment("gone")
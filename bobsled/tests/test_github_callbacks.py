@@ -2,6 +2,7 @@ import pytest
 from ..base import Run, Status, Task
 from ..storages import InMemoryStorage
 from ..callbacks.github import GithubIssueCallback
+from ..stats import TaskStats
 
 
 @pytest.mark.asyncio
@@ -18,16 +19,23 @@ async def test_github_on_error(mocker):
     b = Run("hello-world", Status.Error)
     c = Run("hello-world", Status.Error)
     d = Run("hello-world", Status.Error)
+    stats = TaskStats("hello-world")
+
+    async def add_run(run):
+        await storage.add_run(run)
+        stats.record(run)
+        await storage.set_task_stats(stats)
 
     # 2 failures, no GH call
-    await storage.add_run(a)
-    await storage.add_run(b)
+    await add_run(Run("hello-world", Status.Success))
+    await add_run(a)
+    await add_run(b)
     await gh.on_error(b, storage)
     gh.make_issue.assert_not_called()
 
     # 4 failures, GH call
-    await storage.add_run(c)
-    await storage.add_run(d)
+    await add_run(c)
+    await add_run(d)
 
     # error threshold off, no error
     storage.tasks["hello-world"].error_threshold = 0
@@ -37,7 +45,7 @@ async def test_github_on_error(mocker):
     # back on, now this triggers an error
     storage.tasks["hello-world"].error_threshold = 3
     await gh.on_error(d, storage)
-    gh.make_issue.assert_called_once_with(d, 4, d)
+    gh.make_issue.assert_called_once_with(d, 4, a)
 
 
 @pytest.mark.asyncio
@@ -0,0 +1,113 @@
+import asyncio
+import pytest
+from .. import metrics
+from ..metrics import Registry, serve, timed, timed_methods, STORAGE_SECONDS
+from ..storages import InMemoryStorage
+
+
+def test_counter_and_gauge():
+    r = Registry()
+    c = r.counter("calls_total", "Calls.", ["method"])
+    g = r.gauge("depth", "Queue depth.")
+    c.labels("get").inc()
+    c.labels("get").inc(2)
+    c.labels('say "hi"').inc()
+    g.set(5)
+    g.dec()
+    assert r.render() == (
+        "# HELP calls_total Calls.\n"
+        "# TYPE calls_total counter\n"
+        'calls_total{method="get"} 3\n'
+        'calls_total{method="say \\"hi\\""} 1\n'
+        "# HELP depth Queue depth.\n"
+        "# TYPE depth gauge\n"
+        "depth 4\n"
+    )
+    with pytest.raises(ValueError):
+        c.labels("get", "extra")
+    with pytest.raises(ValueError):
+        r.counter("calls_total", "Again.")
+
+
+def test_histogram():
+    r = Registry()
+    h = r.histogram("latency_seconds", "Latency.", buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        h.observe(value)
+    lines = r.render().splitlines()
+    assert lines[2:] == [
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 3.65",
+        "latency_seconds_count 4",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_timed():
+    r = Registry()
+    h = r.histogram("op_seconds", "Ops.", ["op"])
+
+    @timed(h, "sleep")
+    async def sleep():
+        await asyncio.sleep(0)
+        return "done"
+
+    assert await sleep() == "done"
+    assert h.labels("sleep").counts[0] == 1
+
+    # the method name is added as the last label
+    before = sum(STORAGE_SECONDS.labels("memory", "get_tasks").counts)
+    await InMemoryStorage().get_tasks()
+    assert sum(STORAGE_SECONDS.labels("memory", "get_tasks").counts) == before + 1
+
+    @timed_methods(h)
+    class Thing:
+        async def public(self):
+            pass
+
+        async def _private(self):
+            pass
+
+    await Thing().public()
+    await Thing()._private()
+    assert set(h._children) == {("sleep",), ("public",)}
+
+
+@pytest.mark.asyncio
+async def test_serve():
+    server = await serve(0, host="127.0.0.1")
+    port = server.sockets[0].getsockname()[1]
+
+    async def get(path):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        response = await reader.read()
+        writer.close()
+        return response
+
+    try:
+        response = await get("/metrics")
+        assert response.startswith(b"HTTP/1.0 200 OK")
+        assert b"# TYPE bobsled_storage_seconds histogram" in response
+        assert (await get("/")).startswith(b"HTTP/1.0 404")
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_serve_slow_client(monkeypatch):
+    monkeypatch.setattr(metrics, "SCRAPE_READ_TIMEOUT", 0.05)
+    server = await serve(0, host="127.0.0.1")
+    port = server.sockets[0].getsockname()[1]
+    try:
+        # never finishes its request, so is disconnected without a response
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\n")
+        assert await asyncio.wait_for(reader.read(), 1) == b""
+        writer.close()
+    finally:
+        server.close()
+        await server.wait_closed()
@@ -0,0 +1,123 @@
+import asyncio
+import pytest
+from ..pubsub import PollingPublisher, Topic
+
+
+@pytest.mark.asyncio
+async def test_topic_fan_out():
+    topic = Topic()
+    one = topic.subscribe()
+    two = topic.subscribe()
+    topic.publish("a")
+    topic.close()
+    assert [m async for m in one] == ["a"]
+    assert [m async for m in two] == ["a"]
+
+
+@pytest.mark.asyncio
+async def test_topic_drops_oldest():
+    topic = Topic(maxsize=3)
+    sub = topic.subscribe()
+    for n in range(5):
+        topic.publish(n)
+    assert sub.dropped == 2
+    topic.close()
+    # closing makes room for itself too
+    assert [m async for m in sub] == [3, 4]
+
+
+@pytest.mark.asyncio
+async def test_topic_late_subscriber():
+    topic = Topic()
+    topic.publish("a")
+    topic.publish("b")
+    sub = topic.subscribe()
+    topic.close()
+    assert [m async for m in sub] == ["b"]
+
+
+@pytest.mark.asyncio
+async def test_topic_history():
+    topic = Topic(history=3)
+    for n in range(5):
+        topic.publish(n)
+    sub = topic.subscribe()
+    topic.publish(5)
+    topic.unsubscribe(sub)
+    topic.publish(6)
+    topic.close()
+    # the last 3 messages, then only what was published while subscribed
+    assert [await sub.get() for _ in range(4)] == [2, 3, 4, 5]
+    late = topic.subscribe()
+    assert [m async for m in late] == [4, 5, 6]
+
+
+@pytest.mark.asyncio
+async def test_polling_publisher_shares_poller():
+    polls = []
+
+    async def poll(key, state):
+        polls.append(key)
+        return len(polls), len(polls) == 3
+
+    publisher = PollingPublisher(poll, interval=0.01)
+    async with publisher.subscribe("run") as one:
+        async with publisher.subscribe("run") as two:
+            assert [m async for m in one] == [1, 2, 3]
+            assert [m async for m in two] == [1, 2, 3]
+    # one poller for both subscribers, gone after the final message
+    assert polls == ["run", "run", "run"]
+    assert publisher.topics == {}
+    assert publisher.pollers == {}
+
+
+@pytest.mark.asyncio
+async def test_polling_publisher_stops_without_subscribers():
+    polls = []
+
+    async def poll(key, state):
+        polls.append(key)
+        return key, False
+
+    publisher = PollingPublisher(poll, interval=0.01)
+    async with publisher.subscribe("run") as sub:
+        assert await sub.get() == "run"
+        poller = publisher.pollers["run"]
+    await asyncio.sleep(0)
+    assert poller.cancelled()
+    assert publisher.topics == {}
+    n = len(polls)
+    await asyncio.sleep(0.05)
+    assert len(polls) == n
+
+
+@pytest.mark.asyncio
+async def test_polling_publisher_retries_failed_poll(capsys):
+    polls = []
+
+    async def poll(key, state):
+        polls.append(key)
+        if len(polls) == 1:
+            raise ValueError("db went away")
+        return "ok", True
+
+    publisher = PollingPublisher(poll, interval=0.01)
+    async with publisher.subscribe("run") as sub:
+        assert [m async for m in sub] == ["ok"]
+    assert "poll of run failed" in capsys.readouterr().out
+
+
+@pytest.mark.asyncio
+async def test_polling_publisher_state():
+    async def poll(key, state):
+        # only publish every other poll, each message numbered by the state
+        state["polls"] = state.get("polls", 0) + 1
+        if state["polls"] % 2:
+            return None, False
+        return state["polls"], state["polls"] == 6
+
+    publisher = PollingPublisher(poll, interval=0.01, history=0)
+    async with publisher.subscribe("run") as sub:
+        assert [m async for m in sub] == [2, 4, 6]
+        assert sub.state == {"polls": 6}
+    assert publisher.states == {}
@@ -0,0 +1,124 @@
+import datetime
+import gzip
+import json
+import os
+import pytest
+from .. import retention
+from ..base import Run, Status, Task
+from ..retention import RetentionPolicy, RunRetention
+from ..storages import InMemoryStorage
+
+NOW = datetime.datetime(2020, 6, 1)
+
+
+def days_ago(days):
+    return (NOW - datetime.timedelta(days=days)).isoformat()
+
+
+def test_parse_policy():
+    assert RetentionPolicy.parse("30:365") == RetentionPolicy(30, 365)
+    assert RetentionPolicy.parse("30:") == RetentionPolicy(30, None)
+    assert RetentionPolicy.parse(":90") == RetentionPolicy(None, 90)
+    assert RetentionPolicy.parse("") == RetentionPolicy(None, None)
+    assert RetentionPolicy(30, 7).archive_days == 7
+    assert RetentionPolicy(None, None).archive_days is None
+
+
+def test_policy_precedence():
+    r = RunRetention(
+        None,
+        BOBSLED_RETENTION="30:365",
+        BOBSLED_TAG_RETENTION="scraper=7:90,nightly=14:",
+        BOBSLED_TASK_RETENTION="special=1:2",
+    )
+    assert r.policy_for(Task("plain", "image")) == RetentionPolicy(30, 365)
+    assert r.policy_for(Task("special", "image", tags=["scraper"])) == (
+        RetentionPolicy(1, 2)
+    )
+    assert r.policy_for(Task("s", "image", tags=["scraper"])) == RetentionPolicy(7, 90)
+    # longest of each when several tags match
+    assert r.policy_for(Task("s", "image", tags=["scraper", "nightly"])) == (
+        RetentionPolicy(14, None)
+    )
+    assert not r.enabled
+
+
+async def make_retention(tmp_path, **kwargs):
+    storage = InMemoryStorage()
+    return RunRetention(storage, BOBSLED_ARCHIVE_DIR=str(tmp_path), **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_archive_expired(tmp_path):
+    r = await make_retention(
+        tmp_path, BOBSLED_RETENTION="30:365", BOBSLED_TASK_RETENTION="keep=:"
+    )
+    tasks = [Task("task", "image"), Task("keep", "image")]
+    fresh = Run("task", Status.Success, days_ago(1), logs="fresh\n")
+    stale = Run("task", Status.Success, days_ago(60), logs="stale\n")
+    ancient = Run("task", Status.Error, days_ago(400), logs="ancient\n")
+    running = Run("task", Status.Running, days_ago(90), logs="still going\n")
+    kept = Run("keep", Status.Success, days_ago(400), logs="kept\n")
+    r.storage.runs = [fresh, stale, ancient, running, kept]
+
+    assert await r.archive_expired(tasks, now=NOW) == (2, 1)
+    # logs pruned from storage, ancient run gone entirely
+    assert (await r.storage.get_run(stale.uuid)).logs == ""
+    assert await r.storage.get_run(ancient.uuid) is None
+    assert [run.uuid for run in r.storage.runs] == [
+        fresh.uuid,
+        stale.uuid,
+        running.uuid,
+        kept.uuid,
+    ]
+
+    # both can still be read back in full
+    archived = await r.get_archived_run(ancient.uuid)
+    assert archived.logs == "ancient\n"
+    assert archived.status == Status.Error
+    assert (await r.get_archived_run(stale.uuid)).logs == "stale\n"
+    assert await r.get_archived_run(fresh.uuid) is None
+
+    # nothing left to do
+    assert await r.archive_expired(tasks, now=NOW) == (0, 0)
+
+
+@pytest.mark.asyncio
+async def test_archive_expired_removed_task(tmp_path):
+    r = await make_retention(
+        tmp_path, BOBSLED_RETENTION="30:", BOBSLED_TASK_RETENTION="old-keep=:"
+    )
+    gone = Run("old", Status.Success, days_ago(60), logs="gone\n")
+    kept = Run("old-keep", Status.Success, days_ago(60), logs="kept\n")
+    r.storage.runs = [gone, kept]
+
+    # neither task is in the config anymore, the default & by-name policies apply
+    assert await r.archive_expired([Task("task", "image")], now=NOW) == (1, 0)
+    assert (await r.get_archived_run(gone.uuid)).logs == "gone\n"
+    assert await r.get_archived_run(kept.uuid) is None
+
+
+@pytest.mark.asyncio
+async def test_archive_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(retention, "ARCHIVE_BATCH_SIZE", 2)
+    r = await make_retention(tmp_path, BOBSLED_RETENTION="1:")
+    tasks = [Task("one", "image"), Task("two", "image")]
+    r.storage.runs = [
+        Run(name, Status.Success, days_ago(n + 2), logs=f"{name} {n}\n")
+        for name in ("one", "two")
+        for n in range(3)
+    ]
+
+    assert await r.archive_expired(tasks, now=NOW) == (6, 0)
+    files = [f for f in os.listdir(tmp_path) if f.endswith(".gz")]
+    lines = []
+    for filename in files:
+        with gzip.open(tmp_path / filename, "rt") as f:
+            batch = [json.loads(line) for line in f]
+        assert 1 <= len(batch) <= 2
+        lines.extend(batch)
+    assert len(lines) == 6
+    with open(tmp_path / retention.INDEX_FILENAME) as f:
+        assert len(f.readlines()) == 6
+    for run in r.storage.runs:
+        assert (await r.get_archived_run(run.uuid)).logs.startswith(run.task)
@@ -1,10 +1,12 @@
 import os
 import time
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 import asyncio
 import pytest
 import boto3
-from ..base import Task, Status
+from moto import mock_ecs, mock_logs
+from .. import aws
+from ..base import Run, Task, Status
 from ..storages import InMemoryStorage
 from ..runners import LocalRunService, ECSRunService
 from ..tasks import TaskProvider
@@ -38,6 +40,20 @@ def ecs_run_service():
         )
 
 
+def mock_ecs_run_service():
+    # for use within moto's mock_ecs, which is enough to exercise log handling
+    boto3.client("ecs").create_cluster(clusterName="bobsled")
+    return ECSRunService(
+        InMemoryStorage(),
+        env_provider(),
+        BOBSLED_ECS_CLUSTER="bobsled",
+        BOBSLED_SUBNET_ID="subnet-123",
+        BOBSLED_SECURITY_GROUP_ID="sg-123",
+        BOBSLED_LOG_GROUP="bobsled",
+        BOBSLED_ROLE_ARN="arn:aws:iam::123456789012:role/bobsled",
+    )
+
+
 # workaround until pytest.skip works w/ async (coming in 0.11)
 if os.environ.get("TEST_CLUSTER"):
     runners = [local_run_service, ecs_run_service]
@@ -85,7 +101,7 @@ async def test_run_environment(Cls):
         pytest.skip("ECS not configured")
     await rs.environment.update_environments()
     task = Task("env-test", image="alpine", entrypoint="env", environment="two")
-    rs.initialize([task])
+    await rs.initialize([task])
     run = await rs.run_task(task)
 
     assert run.status == Status.Running
@@ -179,6 +195,31 @@ async def test_next_tasks(Cls):
     assert len(runs) == 2
 
 
+@pytest.mark.asyncio
+async def test_local_watch():
+    storage = InMemoryStorage()
+    task = Task("hello-world", image="hello-world", next_tasks=["next"])
+    task2 = Task("next", image="alpine", entrypoint=["echo", "2"])
+    await storage.set_tasks([task, task2])
+    rs = LocalRunService(storage, env_provider(), [])
+    watcher = asyncio.ensure_future(rs.watch())
+    try:
+        while not rs.watching:
+            await asyncio.sleep(0.1)
+        await rs.run_task(task)
+
+        # no polling, both runs should finish from container events alone
+        for _ in range(100):
+            if len(await rs.get_runs(status=Status.Success)) == 2:
+                break
+            await asyncio.sleep(0.1)
+        runs = await rs.get_runs(status=Status.Success)
+        assert {run.task for run in runs} == {"hello-world", "next"}
+    finally:
+        watcher.cancel()
+    assert await rs.cleanup() == 0
+
+
 @pytest.mark.asyncio
 async def test_callback_on_success():
     class Callback:
@@ -225,3 +266,186 @@ def test_ecs_initialize():
     events = boto3.client("events")
     rule = events.describe_rule(Name="full-example")
     assert rule["ScheduleExpression"] == "cron(0 4 * * ? *)"
+
+
+@pytest.mark.asyncio
+async def test_ecs_initialize_fingerprints():
+    tasks = [
+        Task("one", image="alpine"),
+        Task("two", image="alpine", environment="two"),
+    ]
+    env = env_provider()
+    await env.update_environments()
+    real_call = aws.call
+    calls = []
+
+    async def counting_call(service, method, **kwargs):
+        calls.append(method)
+        return await real_call(service, method, **kwargs)
+
+    with mock_ecs(), patch("bobsled.aws.call", new=counting_call):
+        rs = mock_ecs_run_service()
+        rs.environment = env
+        await rs.initialize(tasks)
+        assert calls.count("register_task_definition") == 2
+        # the cluster is only looked up once
+        assert calls.count("describe_clusters") == 1
+
+        # nothing changed, no ECS calls
+        calls.clear()
+        await rs.initialize(tasks)
+        assert calls == []
+
+        # only the changed task is described & registered
+        tasks[0].image = "alpine:3"
+        await rs.initialize(tasks)
+        assert calls == ["describe_task_definition", "register_task_definition"]
+
+        # fresh storage, definitions are checked via their tag but not registered
+        calls.clear()
+        rs.storage = InMemoryStorage()
+        await rs.initialize(tasks)
+        assert calls == ["describe_task_definition"] * 2
+        fingerprints = await rs.storage.get_setting("ecs_task_definition_fingerprints")
+        assert set(fingerprints) == {"one", "two"}
+
+
+@pytest.mark.asyncio
+async def test_ecs_incremental_logs():
+    with mock_ecs(), mock_logs():
+        logs = boto3.client("logs")
+        logs.create_log_group(logGroupName="bobsled")
+        stream = "hello-world/hello-world/abc123"
+        logs.create_log_stream(logGroupName="bobsled", logStreamName=stream)
+
+        def put(*messages):
+            now = int(time.time() * 1000)
+            logs.put_log_events(
+                logGroupName="bobsled",
+                logStreamName=stream,
+                logEvents=[{"timestamp": now, "message": m} for m in messages],
+            )
+
+        ers = mock_ecs_run_service()
+        run = Run(
+            "hello-world",
+            Status.Running,
+            run_info={"task_arn": "arn:aws:ecs:us-east-1:123456789012:task/abc123"},
+        )
+
+        put("one", "two")
+        await ers.update_logs(run)
+        assert run.logs == "one\ntwo"
+        assert (await ers.storage.get_log_cursor(run.uuid))["log_lines"] == 2
+
+        # nothing new, nothing changes
+        await ers.update_logs(run)
+        assert run.logs == "one\ntwo"
+
+        # only the new line is fetched and appended
+        put("three")
+        await ers.update_logs(run)
+        assert run.logs == "one\ntwo\nthree"
+        assert (await ers.storage.get_log_cursor(run.uuid))["log_lines"] == 3
+
+
+@pytest.mark.asyncio
+async def test_ecs_logs_missing_stream():
+    with mock_ecs(), mock_logs():
+        boto3.client("logs").create_log_group(logGroupName="bobsled")
+        ers = mock_ecs_run_service()
+        run = Run(
+            "hello-world",
+            Status.Running,
+            run_info={"task_arn": "arn:aws:ecs:us-east-1:123456789012:task/abc123"},
+        )
+        await ers.update_logs(run)
+        assert run.logs == ""
+        # placeholder is only added once the run is over
+        await ers.update_logs(run, final=True)
+        assert run.logs == "no logs"
+
+
+@pytest.mark.asyncio
+async def test_ecs_update_statuses_batched():
+    with mock_ecs(), mock_logs():
+        ers = mock_ecs_run_service()
+        runs = []
+        for n in range(250):
+            run = Run(
+                "hello-world",
+                Status.Pending,
+                run_info={"task_arn": f"arn:task/{n}", "timeout_at": ""},
+            )
+            await ers.storage.add_run(run)
+            runs.append(run)
+
+        batches = []
+        aws_call = aws.call
+
+        async def fake_call(service, method, **kwargs):
+            if method != "describe_tasks":
+                return await aws_call(service, method, **kwargs)
+            # first run has stopped successfully, the rest are running
+            batches.append(kwargs["tasks"])
+            return {
+                "tasks": [
+                    {
+                        "taskArn": arn,
+                        "lastStatus": "STOPPED" if arn == "arn:task/0" else "RUNNING",
+                        "containers": [{"exitCode": 0}],
+                    }
+                    for arn in kwargs["tasks"]
+                ],
+                "failures": [],
+            }
+
+        with patch("bobsled.aws.call", new=fake_call):
+            await ers.update_statuses([r.uuid for r in runs])
+
+        assert [len(b) for b in batches] == [100, 100, 50]
+        assert len(await ers.get_runs(status=Status.Success)) == 1
+        assert len(await ers.get_runs(status=Status.Running)) == 249
+
+
+@pytest.mark.asyncio
+async def test_ecs_update_statuses_unknown_task():
+    with mock_ecs(), mock_logs():
+        ers = mock_ecs_run_service()
+        runs = []
+        for n in range(3):
+            run = Run(
+                "hello-world",
+                Status.Running,
+                run_info={"task_arn": f"arn:task/{n}", "timeout_at": ""},
+            )
+            await ers.storage.add_run(run)
+            runs.append(run)
+
+        aws_call = aws.call
+
+        async def fake_call(service, method, **kwargs):
+            if method != "describe_tasks":
+                return await aws_call(service, method, **kwargs)
+            # ECS returns nothing at all for the second task
+            return {
+                "tasks": [
+                    {
+                        "taskArn": arn,
+                        "lastStatus": "STOPPED",
+                        "containers": [{"exitCode": 0}],
+                    }
+                    for arn in kwargs["tasks"]
+                    if arn != "arn:task/1"
+                ],
+                "failures": [],
+            }
+
+        with patch("bobsled.aws.call", new=fake_call):
+            await ers.update_statuses([r.uuid for r in runs])
+
+        assert [r.status for r in runs] == [
+            Status.Success,
+            Status.Missing,
+            Status.Success,
+        ]
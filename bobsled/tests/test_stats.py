@@ -0,0 +1,77 @@
+import random
+from ..base import Run, Status
+from ..stats import P2Quantile, TaskStats
+
+
+def test_p2_quantile_small():
+    q = P2Quantile(0.5)
+    assert q.value() is None
+    for x in (3, 1, 2):
+        q.add(x)
+    assert q.count == 3
+    assert q.value() == 2
+
+
+def test_p2_quantile_accuracy():
+    rng = random.Random(1)
+    data = [rng.expovariate(1 / 300) for _ in range(5000)]
+    p50, p95 = P2Quantile(0.5), P2Quantile(0.95)
+    for x in data:
+        p50.add(x)
+        p95.add(x)
+    data.sort()
+    assert p50.count == 5000
+    assert abs(p50.value() - data[2500]) / data[2500] < 0.05
+    assert abs(p95.value() - data[4750]) / data[4750] < 0.05
+
+    # survives a round trip mid-stream
+    restored = P2Quantile.from_dict(p95.to_dict())
+    restored.add(1000)
+    p95.add(1000)
+    assert restored.to_dict() == p95.to_dict()
+
+
+def finished(status, seconds=60):
+    return Run(
+        "task",
+        status,
+        start="2020-01-01T00:00:00",
+        end=f"2020-01-01T00:{seconds // 60:02d}:{seconds % 60:02d}",
+    )
+
+
+def test_task_stats_record():
+    stats = TaskStats("task")
+    assert stats.success_rate is None
+    first = finished(Status.Success, 60)
+    assert stats.record(first)
+    # the same run isn't counted twice
+    assert not stats.record(first)
+    stats.record(finished(Status.Success, 120))
+    e1 = finished(Status.Error)
+    stats.record(e1)
+    stats.record(finished(Status.Error))
+    assert stats.runs == 4
+    assert stats.successes == 2
+    assert stats.failures == 2
+    assert stats.success_rate == 0.5
+    assert stats.failure_streak == 2
+    assert stats.first_failure == e1.uuid
+    assert stats.last_status == "Error"
+    assert stats.duration_p50.value() in (60, 120)
+
+    # a non-error ends the streak
+    stats.record(finished(Status.UserKilled))
+    assert stats.failure_streak == 0
+    assert stats.first_failure == ""
+    assert stats.summary()["runs"] == 5
+
+
+def test_task_stats_serialization():
+    stats = TaskStats("task")
+    for seconds in range(10, 100, 10):
+        stats.record(finished(Status.Success, seconds))
+    stats.record(finished(Status.Error))
+    restored = TaskStats.from_dict(stats.to_dict())
+    assert restored.to_dict() == stats.to_dict()
+    assert restored.summary() == stats.summary()
@@ -1,7 +1,10 @@
 import os
+from unittest import mock
 import pytest
+import yaml
 from ..storages import InMemoryStorage
 from ..tasks import TaskProvider
+from ..utils import YamlLoader
 
 ENV_FILE = os.path.join(os.path.dirname(__file__), "tasks/tasks.yml")
 GH_API_KEY = os.environ.get("GITHUB_API_KEY")
@@ -48,3 +51,103 @@ async def test_load_github_dir():
     await tp.update_tasks()
     tasks = await storage.get_tasks()
     assert len(tasks) == 4
+
+
+@pytest.mark.asyncio
+async def test_local_dir_tasks(tmp_path):
+    (tmp_path / "a.yml").write_text("one:\n  image: one\n")
+    (tmp_path / "b.yml").write_text("two:\n  image: two\n")
+    storage = InMemoryStorage()
+    tp = TaskProvider(storage=storage, BOBSLED_TASKS_DIRNAME=str(tmp_path))
+    changes = await tp.update_tasks()
+    assert changes["added"] == ["one", "two"]
+
+    # unchanged files aren't parsed again
+    with mock.patch("yaml.safe_load") as safe_load:
+        changes = await tp.update_tasks()
+    assert not safe_load.called
+    assert changes == {"added": [], "updated": [], "removed": []}
+
+    (tmp_path / "b.yml").write_text("two:\n  image: new-two\n")
+    with mock.patch("yaml.safe_load", wraps=yaml.safe_load) as safe_load:
+        changes = await tp.update_tasks()
+    assert safe_load.call_count == 1
+    assert changes == {"added": [], "updated": ["two"], "removed": []}
+    assert (await storage.get_task("two")).image == "new-two"
+
+
+class Contents:
+    def __init__(self, path, sha, decoded=None):
+        self.path = path
+        self.sha = sha
+        self.decoded = decoded
+
+
+def test_yaml_loader_github():
+    files = {
+        "tasks/a.yml": ("sha-a", b"one:\n  image: one\n"),
+        "tasks/b.yml": ("sha-b", b"two:\n  image: two\n"),
+    }
+    downloads = []
+    repo = mock.Mock()
+    repo.directory_contents.side_effect = lambda dirname: [
+        (path.split("/")[-1], Contents(path, sha)) for path, (sha, _) in files.items()
+    ]
+
+    def file_contents(path):
+        downloads.append(path)
+        return Contents(path, *files[path])
+
+    repo.file_contents.side_effect = file_contents
+
+    loader = YamlLoader(None, "tasks", "user", "repo")
+    loader._repo = repo
+    assert set(loader.load()) == {"one", "two"}
+    assert sorted(downloads) == ["tasks/a.yml", "tasks/b.yml"]
+
+    # nothing changed, nothing downloaded
+    assert loader.load() is None
+    assert len(downloads) == 2
+
+    files["tasks/b.yml"] = ("sha-b2", b"two:\n  image: new-two\n")
+    data = loader.load()
+    assert downloads[2:] == ["tasks/b.yml"]
+    assert data["two"]["image"] == "new-two"
+    assert data["one"]["image"] == "one"
+
+
+def test_yaml_loader_github_file():
+    files = {
+        "other.yml": ("sha-other", b""),
+        "config/tasks.yml": ("sha-1", b"one:\n  image: one\n"),
+    }
+    downloads = []
+    repo = mock.Mock()
+    repo.directory_contents.side_effect = lambda dirname: [
+        (path.split("/")[-1], Contents(path, sha))
+        for path, (sha, _) in files.items()
+        if path.startswith(dirname)
+    ]
+
+    def file_contents(path):
+        downloads.append(path)
+        return Contents(path, *files[path])
+
+    repo.file_contents.side_effect = file_contents
+
+    loader = YamlLoader("config/tasks.yml", None, "user", "repo")
+    loader._repo = repo
+    assert loader.load() == {"one": {"image": "one"}}
+    repo.directory_contents.assert_called_with("config")
+
+    # the sha is checked without downloading the file again
+    assert loader.load() is None
+    assert downloads == ["config/tasks.yml"]
+
+    files["config/tasks.yml"] = ("sha-2", b"one:\n  image: new-one\n")
+    assert loader.load() == {"one": {"image": "new-one"}}
+    assert len(downloads) == 2
+
+    del files["config/tasks.yml"]
+    with pytest.raises(FileNotFoundError):
+        loader.load()
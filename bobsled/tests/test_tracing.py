@@ -0,0 +1,106 @@
+import json
+import os
+import pstats
+import pytest
+from .. import tracing
+from ..storages import InMemoryStorage
+from ..tracing import JSONLinesSink, NoopSink, ProfileSink, traced_methods
+
+
+@traced_methods(exclude=("untraced",), hide_args=("login",))
+class Service:
+    async def outer(self, n):
+        with tracing.span("block"):
+            return self.inner(n) + 1
+
+    def inner(self, n):
+        return n * 2
+
+    def untraced(self):
+        return tracing._current_span.get()
+
+    async def fail(self):
+        raise ValueError("oops")
+
+    async def login(self, password):
+        pass
+
+
+@pytest.fixture
+def tracer():
+    yield tracing.configure
+    tracing.configure()
+
+
+@pytest.mark.asyncio
+async def test_off():
+    assert tracing._tracer is None
+    assert await Service().outer(2) == 5
+    assert Service().untraced() is None
+
+
+@pytest.mark.asyncio
+async def test_jsonl_sink(tracer, tmp_path):
+    filename = tmp_path / "trace.jsonl"
+    tracer(JSONLinesSink(filename))
+    assert await Service().outer(2) == 5
+    with pytest.raises(ValueError):
+        await Service().fail()
+    await InMemoryStorage().get_tasks()
+
+    with open(filename) as f:
+        spans = [json.loads(line) for line in f]
+    # written as they finish, innermost first
+    names = [span["name"] for span in spans]
+    assert names == [
+        "Service.inner",
+        "block",
+        "Service.outer",
+        "Service.fail",
+        "InMemoryStorage.get_tasks",
+    ]
+    inner, block, outer, fail, _ = spans
+    assert inner["parent"] == block["id"]
+    assert block["parent"] == outer["id"]
+    assert outer["parent"] is None
+    assert fail["error"] == "ValueError"
+    assert outer["duration"] >= inner["duration"]
+
+
+@pytest.mark.asyncio
+async def test_slow_calls(tracer, capsys):
+    tracer(slow_ms=0)
+    assert isinstance(tracing._tracer.sink, NoopSink)
+    Service().inner("x" * 500)
+    await Service().login("hunter2")
+    out = capsys.readouterr().out
+    assert "slow call: Service.inner took" in out
+    assert "'" + "x" * 199 + "..." in out
+    assert "hunter2" not in out
+    assert "Service.login took" in out
+
+
+@pytest.mark.asyncio
+async def test_profile_sink(tracer, tmp_path):
+    tracer(ProfileSink(tmp_path, rate=1))
+    await Service().outer(2)
+    # only the top-level span is profiled
+    files = os.listdir(tmp_path)
+    assert len(files) == 1
+    assert files[0].startswith("Service.outer-")
+    stats = pstats.Stats(str(tmp_path / files[0]))
+    assert any(func[2] == "inner" for func in stats.stats)
+
+    tracer(ProfileSink(tmp_path / "none", rate=0))
+    await Service().outer(2)
+    assert os.listdir(tmp_path / "none") == []
+
+
+def test_configure_from_env(tracer, tmp_path):
+    assert tracing.configure_from_env() is None
+    t = tracing.configure_from_env(f"profile:{tmp_path}:0.5", "250")
+    assert t.sink.rate == 0.5
+    assert t.slow_ms == 250
+    assert isinstance(tracing.configure_from_env("noop").sink, NoopSink)
+    with pytest.raises(ValueError):
+        tracing.configure_from_env("stdout")
@@ -0,0 +1,253 @@
+"""
+Spans around RunService, storage and environment calls, for finding where a slow
+request spent its time.
+
+Tracing is set up per process from the environment:
+
+    BOBSLED_TRACE: where finished spans go, one of
+        noop                    nowhere (only useful with BOBSLED_TRACE_SLOW_MS)
+        jsonl:<filename>        appended to a JSON lines file
+        profile:<dirname>[:<rate>]
+                                cProfile a sample (default 1%) of top-level spans,
+                                writing a .prof file per profiled span
+    BOBSLED_TRACE_SLOW_MS: calls slower than this are printed with their arguments
+
+When neither is set the wrapped methods do nothing besides checking that tracing is
+off.
+"""
+import os
+import time
+import json
+import random
+import cProfile
+import inspect
+import functools
+import itertools
+import contextlib
+import contextvars
+
+# longest repr of a single argument printed for a slow call
+MAX_ARG_LENGTH = 200
+
+_current_span = contextvars.ContextVar("bobsled_span", default=None)
+_span_ids = itertools.count(1)
+_tracer = None
+
+
+class Span:
+    __slots__ = ("id", "parent", "name", "start", "duration", "error", "profile")
+
+    def __init__(self, name, parent):
+        self.id = next(_span_ids)
+        self.parent = parent
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+        self.profile = None
+
+    def to_dict(self):
+        return {
+            "pid": os.getpid(),
+            "id": self.id,
+            "parent": self.parent.id if self.parent else None,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+        }
+
+
+class NoopSink:
+    def start(self, span):
+        pass
+
+    def finish(self, span):
+        pass
+
+
+class JSONLinesSink(NoopSink):
+    def __init__(self, filename):
+        # line buffered, so each span is a single append
+        self.file = open(filename, "a", buffering=1)
+
+    def finish(self, span):
+        self.file.write(json.dumps(span.to_dict()) + "\n")
+
+
+class ProfileSink(NoopSink):
+    """
+    profiles a sample of top-level spans
+
+    A profile covers everything that ran while the span was open, for a coroutine
+    that includes whatever else the event loop was doing while it waited.
+    """
+
+    def __init__(self, dirname, rate=0.01):
+        os.makedirs(dirname, exist_ok=True)
+        self.dirname = dirname
+        self.rate = rate
+        self.active = False
+
+    def start(self, span):
+        if span.parent or self.active or random.random() >= self.rate:
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is already running
+            return
+        span.profile = profile
+        self.active = True
+
+    def finish(self, span):
+        if not span.profile:
+            return
+        span.profile.disable()
+        self.active = False
+        filename = f"{span.name}-{os.getpid()}-{span.id}.prof"
+        span.profile.dump_stats(os.path.join(self.dirname, filename))
+
+
+def _format_args(args, kwargs):
+    parts = [repr(arg) for arg in args]
+    parts += [f"{key}={value!r}" for key, value in kwargs.items()]
+    return ", ".join(
+        part if len(part) <= MAX_ARG_LENGTH else part[:MAX_ARG_LENGTH] + "..."
+        for part in parts
+    )
+
+
+class _SpanContext:
+    def __init__(self, tracer, name, args, kwargs, hide_args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.hide_args = hide_args
+
+    def __enter__(self):
+        self.span = Span(self.name, _current_span.get())
+        self.token = _current_span.set(self.span)
+        self.tracer.sink.start(self.span)
+        self.perf_start = time.perf_counter()
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        span = self.span
+        span.duration = time.perf_counter() - self.perf_start
+        if exc_type:
+            span.error = exc_type.__name__
+        _current_span.reset(self.token)
+        self.tracer.sink.finish(span)
+        slow_ms = self.tracer.slow_ms
+        if slow_ms is not None and span.duration * 1000 >= slow_ms:
+            if self.hide_args:
+                args = "arguments hidden"
+            else:
+                args = _format_args(self.args, self.kwargs)
+            print(f"slow call: {span.name} took {span.duration * 1000:.0f}ms ({args})")
+
+
+class Tracer:
+    def __init__(self, sink, slow_ms=None):
+        self.sink = sink
+        self.slow_ms = slow_ms
+
+    def span(self, name, args=(), kwargs=None, hide_args=False):
+        return _SpanContext(self, name, args, kwargs or {}, hide_args)
+
+
+def configure(sink=None, slow_ms=None):
+    """
+    turn tracing on for this process, or off if neither sink nor slow_ms is given
+    """
+    global _tracer
+    if sink is None and slow_ms is None:
+        _tracer = None
+    else:
+        _tracer = Tracer(sink or NoopSink(), slow_ms)
+    return _tracer
+
+
+def configure_from_env(BOBSLED_TRACE=None, BOBSLED_TRACE_SLOW_MS=None):
+    sink = None
+    if BOBSLED_TRACE:
+        kind, _, target = BOBSLED_TRACE.partition(":")
+        if kind == "noop":
+            sink = NoopSink()
+        elif kind == "jsonl":
+            sink = JSONLinesSink(target)
+        elif kind == "profile":
+            dirname, _, rate = target.partition(":")
+            sink = ProfileSink(dirname, float(rate) if rate else 0.01)
+        else:
+            raise ValueError(f"unknown BOBSLED_TRACE sink: {kind}")
+    slow_ms = float(BOBSLED_TRACE_SLOW_MS) if BOBSLED_TRACE_SLOW_MS else None
+    return configure(sink, slow_ms)
+
+
+def span(name):
+    """
+    context manager for tracing a block of code that isn't a method call
+    """
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.span(name)
+
+
+def _trace(func, name, hide_args):
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return await func(*args, **kwargs)
+            # args[0] is self
+            with tracer.span(name, args[1:], kwargs, hide_args):
+                return await func(*args, **kwargs)
+
+    else:
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return func(*args, **kwargs)
+            with tracer.span(name, args[1:], kwargs, hide_args):
+                return func(*args, **kwargs)
+
+    return wrapper
+
+
+def traced_methods(exclude=(), hide_args=()):
+    """
+    class decorator that traces every public method defined on the class
+
+    exclude: names of methods not to trace
+    hide_args: names of methods whose arguments are never printed, or True for all
+    """
+
+    def decorator(cls):
+        for name, func in list(vars(cls).items()):
+            if (
+                name.startswith("_")
+                or name in exclude
+                or not inspect.isfunction(func)
+                # the time between items isn't a call
+                or inspect.isgeneratorfunction(func)
+                or inspect.isasyncgenfunction(func)
+            ):
+                continue
+            hide = hide_args is True or name in hide_args
+            setattr(cls, name, _trace(func, f"{cls.__name__}.{name}", hide))
+        return cls
+
+    return decorator
+
+
+configure_from_env(
+    os.environ.get("BOBSLED_TRACE"), os.environ.get("BOBSLED_TRACE_SLOW_MS")
+)
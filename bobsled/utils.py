@@ -1,6 +1,10 @@
 import os
+import posixpath
+import asyncio
 import inspect
 import glob
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 import github3
 from passlib.hash import argon2
@@ -34,6 +38,24 @@ def load_args(Cls):
     return args
 
 
+def diff_tasks(old_tasks, new_tasks):
+    """
+    Compare two lists of tasks by name.
+
+    Returns a dict with sorted lists of the task names that were added, updated, and
+    removed going from old_tasks to new_tasks.
+    """
+    old = {task.name: task for task in old_tasks}
+    new = {task.name: task for task in new_tasks}
+    return {
+        "added": sorted(name for name in new if name not in old),
+        "updated": sorted(
+            name for name, task in new.items() if name in old and old[name] != task
+        ),
+        "removed": sorted(name for name in old if name not in new),
+    }
+
+
 def get_env_config(key, default, module):
     """
     Get class configuration from the environment.
@@ -48,35 +70,113 @@ def get_env_config(key, default, module):
     return Cls, args
 
 
-def load_github_or_local_yaml(
-    filename, dirname, github_user=None, github_repo=None, github_api_key=None
-):
+class YamlLoader:
     """
-    load_yaml from a local or remote source
+    Load YAML from a local or remote source, only re-reading files that changed.
 
-    if github credentials are supplied, they'll be used and we'll read from the directory or
-    file within the repo
+    If github credentials are supplied, they'll be used and we'll read from the
+    directory or file within the repo, otherwise the local file or directory is used.
 
-    otherwise, the local file will be used
+    The version of each file (its blob SHA on GitHub, mtime & size locally) is
+    recorded on each load, files that still have the same version aren't downloaded
+    or parsed again.
     """
-    if github_user and github_repo:
-        gh = github3.GitHub(token=github_api_key)
-        repo = gh.repository(github_user, github_repo)
-        if dirname:
-            data = {}
-            for fname, contents in repo.directory_contents(dirname):
-                contents.refresh()
-                data.update(yaml.safe_load(contents.decoded))
-        elif filename:
-            contents = repo.file_contents(filename).decoded
-            data = yaml.safe_load(contents)
-    elif dirname:
+
+    # how many changed files are downloaded at once
+    MAX_DOWNLOADS = 8
+
+    def __init__(
+        self, filename, dirname, github_user=None, github_repo=None, github_api_key=None
+    ):
+        self.filename = filename
+        self.dirname = dirname
+        self.github_user = github_user
+        self.github_repo = github_repo
+        self.github_api_key = github_api_key
+        self._repo = None
+        # path => (version, parsed yaml)
+        self.files = {}
+
+    @property
+    def repo(self):
+        if self._repo is None:
+            gh = github3.GitHub(token=self.github_api_key)
+            self._repo = gh.repository(self.github_user, self.github_repo)
+        return self._repo
+
+    def _list_versions(self):
+        """
+        returns {path: version} for the files to load, without downloading them
+        """
+        if self.github_user and self.github_repo:
+            if self.dirname:
+                listing = self.repo.directory_contents(self.dirname)
+                return {c.path: c.sha for _, c in listing}
+            # a single file's sha comes from listing its directory, which leaves out
+            # the contents that fetching the file itself would include
+            listing = self.repo.directory_contents(posixpath.dirname(self.filename))
+            for _, c in listing:
+                if c.path == self.filename:
+                    return {c.path: c.sha}
+            raise FileNotFoundError(self.filename)
+        if self.dirname:
+            paths = sorted(glob.glob(self.dirname + "/*"))
+        else:
+            paths = [self.filename]
+        versions = {}
+        for path in paths:
+            stat = os.stat(path)
+            versions[path] = (stat.st_mtime_ns, stat.st_size)
+        return versions
+
+    def _read(self, path):
+        if self.github_user and self.github_repo:
+            return self.repo.file_contents(path).decoded
+        with open(path) as f:
+            return f.read()
+
+    def load(self):
+        """
+        returns the merged YAML data, or None if nothing changed since the last load
+        """
+        versions = self._list_versions()
+        previous = {path: version for path, (version, _) in self.files.items()}
+        if versions == previous:
+            return None
+
+        changed = [
+            path for path, version in versions.items() if previous.get(path) != version
+        ]
+        if len(changed) > 1:
+            with ThreadPoolExecutor(max_workers=self.MAX_DOWNLOADS) as pool:
+                downloaded = dict(zip(changed, pool.map(self._read, changed)))
+        else:
+            downloaded = {path: self._read(path) for path in changed}
+
+        files = {}
+        for path, version in versions.items():
+            if path in downloaded:
+                files[path] = (version, yaml.safe_load(downloaded[path]))
+            else:
+                files[path] = self.files[path]
+        self.files = files
+
         data = {}
-        for filename in glob.glob(dirname + "/*"):
-            with open(filename) as f:
-                data.append(yaml.safe_load(f))
-    else:
-        with open(filename) as f:
-            data = yaml.safe_load(f)
-
-    return data
+        for path in sorted(files):
+            data.update(files[path][1] or {})
+        return data
+
+
+async def run_forever(name, loop, log=print, restart_seconds=5):
+    """
+    await loop() until it returns, logging and restarting it whenever it fails
+    """
+    while True:
+        try:
+            return await loop()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            error = traceback.format_exc()
+            log(f"{name} failed, restarting in {restart_seconds}s\n{error}")
+            await asyncio.sleep(restart_seconds)
@@ -1,5 +1,6 @@
 import os
 import datetime
+import hmac
 import asyncio
 import attr
 import zmq
@@ -13,7 +14,12 @@ from starlette.authentication import (
 )
 from starlette.middleware import Middleware
 from starlette.middleware.authentication import AuthenticationMiddleware
-from starlette.responses import JSONResponse, RedirectResponse
+from starlette.responses import (
+    JSONResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 from starlette.routing import Route, WebSocketRoute, Mount
 from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
@@ -23,10 +29,21 @@ import jwt
 from .base import Status
 from .exceptions import AlreadyRunning
 from .core import bobsled
+from .metrics import CONTENT_TYPE, REGISTRY
+from .pubsub import PollingPublisher, Topic
+from .utils import run_forever
 
 
 class JWTSessionAuthBackend(AuthenticationBackend):
     async def authenticate(self, request):
+        metrics_token = bobsled.settings["metrics_token"]
+        authorization = request.headers.get("authorization", "")
+        if metrics_token and hmac.compare_digest(
+            authorization, f"Bearer {metrics_token}"
+        ):
+            # Prometheus can't log in, the token lets it scrape /metrics and no more
+            return AuthCredentials(["metrics"]), SimpleUser("metrics")
+
         jwt_token = request.cookies.get("jwt_token")
 
         if not jwt_token:
@@ -39,7 +56,9 @@ class JWTSessionAuthBackend(AuthenticationBackend):
             return
 
         return (
-            AuthCredentials(["authenticated"] + (data["permissions"] or [])),
+            AuthCredentials(
+                ["authenticated", "metrics"] + (data["permissions"] or [])
+            ),
             SimpleUser(data["username"]),
         )
 
@@ -147,10 +166,12 @@ def _run2dict(run):
 @requires(["authenticated"], redirect="login")
 async def api_index(request):
     tasks = [attr.asdict(t) for t in await bobsled.storage.get_tasks()]
-    results = await asyncio.gather(
-        *[bobsled.run.get_runs(task_name=t["name"], latest=4) for t in tasks]
-    )
-    for task, latest_runs in zip(tasks, results):
+    latest = await bobsled.run.get_latest_runs_per_task(4)
+    stats = await bobsled.run.get_task_stats()
+    for task in tasks:
+        task_stats = stats.get(task["name"])
+        task["stats"] = task_stats.summary() if task_stats else None
+        latest_runs = latest.get(task["name"], [])
         if latest_runs:
             task["latest_run"] = _run2dict(latest_runs[0])
             task["recent_statuses"] = [r.status.name for r in latest_runs]
@@ -163,26 +184,89 @@ async def api_index(request):
             "runs": [
                 _run2dict(r) for r in await bobsled.run.get_runs(status=Status.Running)
             ],
+            "queue": await bobsled.run.get_queue_stats(),
         }
     )
 
 
 @requires(["authenticated"], redirect="login")
-async def latest_runs(request):
+async def task_stats(request):
+    """
+    stats for every task, or just those named in ?task= (which can be repeated)
+    """
+    task_names = request.query_params.getlist("task") or None
+    stats = await bobsled.run.get_task_stats(task_names)
     return JSONResponse(
-        {"runs": [_run2dict(r) for r in await bobsled.run.get_runs(latest=100)]}
+        {"stats": [stats[name].summary() for name in sorted(stats)]}
     )
 
 
+@requires(["metrics"])
+async def metrics(request):
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+@requires(["authenticated"], redirect="login")
+async def queue(request):
+    stats = await bobsled.run.get_queue_stats()
+    stats["runs"] = [_run2dict(r) for r in await bobsled.run.get_queued_runs()]
+    return JSONResponse(stats)
+
+
+MAX_PAGE_SIZE = 500
+
+
+def _run_cursor(run):
+    return f"{run.start},{run.uuid}"
+
+
+async def _get_runs_page(request, default_limit, **kwargs):
+    """
+    a page of runs, newest first, and the cursor for the next page (or None)
+
+    ?before= takes the cursor returned with the previous page, ?limit= the page size
+    """
+    limit = int(request.query_params.get("limit") or default_limit)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    limit = min(limit, MAX_PAGE_SIZE)
+    before = request.query_params.get("before")
+    if before:
+        start, uuid = before.split(",")
+        before = (start or None, uuid)
+    # one extra to tell whether there is another page
+    runs = await bobsled.run.get_runs(latest=limit + 1, before=before, **kwargs)
+    if len(runs) > limit:
+        runs = runs[:limit]
+        return runs, _run_cursor(runs[-1])
+    return runs, None
+
+
+@requires(["authenticated"], redirect="login")
+async def latest_runs(request):
+    try:
+        runs, next_cursor = await _get_runs_page(request, 100)
+    except ValueError:
+        return JSONResponse({"error": "invalid limit or cursor"}, status_code=400)
+    return JSONResponse({"runs": [_run2dict(r) for r in runs], "next": next_cursor})
+
+
 @requires(["authenticated"], redirect="login")
 async def task_overview(request):
     task_name = request.path_params["task_name"]
     task = await bobsled.storage.get_task(task_name)
-    runs = await bobsled.run.get_runs(
-        task_name=task_name, update_status=True, latest=40
-    )
+    try:
+        runs, next_cursor = await _get_runs_page(
+            request, 40, task_name=task_name, update_status=True
+        )
+    except ValueError:
+        return JSONResponse({"error": "invalid limit or cursor"}, status_code=400)
     return JSONResponse(
-        {"task": attr.asdict(task), "runs": [_run2dict(r) for r in runs]}
+        {
+            "task": attr.asdict(task),
+            "runs": [_run2dict(r) for r in runs],
+            "next": next_cursor,
+        }
     )
 
 
@@ -199,14 +283,103 @@ async def run_task(request):
     return JSONResponse(_run2dict(run))
 
 
+async def _get_archived_run(run_id):
+    """
+    the archived copy of a run that was deleted or had its logs pruned, or None
+    """
+    run = await bobsled.storage.get_run(run_id)
+    if run is None or run.run_info.get("archived"):
+        return await bobsled.retention.get_archived_run(run_id)
+    return None
+
+
 @requires(["authenticated"], redirect="login")
 async def run_detail(request):
     run_id = request.path_params["run_id"]
+    archived = await _get_archived_run(run_id)
+    if archived:
+        return JSONResponse(_run2dict(archived))
     run = await bobsled.run.update_status(run_id, update_logs=True)
+    # ?logs=0 leaves them out, for clients that fetch them from /logs instead
+    if request.query_params.get("logs") == "0":
+        run.logs = ""
+    else:
+        run.logs = await bobsled.storage.get_logs(run_id)
     rundata = _run2dict(run)
     return JSONResponse(rundata)
 
 
+# logs are streamed a page at a time so a big log is never held in memory at once
+LOG_PAGE_SIZE = 64 * 1024
+
+
+def _optional_query_int(request, name):
+    value = request.query_params.get(name)
+    if value is None or value == "":
+        return None
+    value = int(value)
+    if value < 0:
+        raise ValueError(f"{name} must not be negative")
+    return value
+
+
+@requires(["authenticated"], redirect="login")
+async def run_logs(request):
+    """
+    plain text logs for a run
+
+    ?offset=&limit= select a range of the logs, ?tail=N the last N characters.
+    X-Log-Offset is where the returned text starts & X-Next-Offset where it ends,
+    so polling with offset=X-Next-Offset picks up just the new output.
+    """
+    run_id = request.path_params["run_id"]
+    run = await bobsled.storage.get_run(run_id)
+    archived = None
+    if run is None or run.run_info.get("archived"):
+        # storage no longer has the logs, they're read from the archive instead
+        archived = await bobsled.retention.get_archived_run(run_id)
+    if run is None and archived is None:
+        return JSONResponse({"error": "Run not found"}, status_code=404)
+    try:
+        offset = _optional_query_int(request, "offset") or 0
+        limit = _optional_query_int(request, "limit")
+        tail = _optional_query_int(request, "tail")
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    # the range is fixed up front so the headers match the body even if the run
+    # is still writing logs while they stream
+    if archived:
+        size = len(archived.logs)
+    else:
+        size = await bobsled.storage.get_log_size(run_id)
+    if tail is not None:
+        offset = max(size - tail, 0)
+    start = min(offset, size)
+    end = size if limit is None else min(size, start + limit)
+
+    async def pages():
+        position = start
+        while position < end:
+            page = min(LOG_PAGE_SIZE, end - position)
+            if archived:
+                chunk = archived.logs[position:position + page]
+            else:
+                chunk = await bobsled.storage.get_logs(
+                    run_id, offset=position, limit=page
+                )
+            if not chunk:
+                break
+            position += len(chunk)
+            yield chunk
+
+    return StreamingResponse(
+        pages(),
+        media_type="text/plain",
+        headers={"X-Log-Offset": str(start), "X-Next-Offset": str(end)},
+    )
+
+
 @requires(["authenticated"], redirect="login")
 async def stop_run(request):
     run_id = request.path_params["run_id"]
@@ -220,33 +393,153 @@ async def update_config(request):
     return JSONResponse({"tasks": tasks})
 
 
-@requires(["authenticated"], redirect="login")
-async def beat_websocket(websocket):
+# messages from beat are shared by all /ws/beat sockets, new ones see recent history
+BEAT_HISTORY = 50
+beat_messages = Topic(maxsize=100, history=BEAT_HISTORY)
+_beat_listener = None
+
+
+async def _listen_to_beat():
     hostname = os.environ.get("BOBSLED_BEAT_HOSTNAME", "beat")
     port = os.environ.get("BOBSLED_BEAT_PORT", "1988")
     context = zmq.asyncio.Context.instance()
     socket = context.socket(zmq.SUB)
     socket.connect(f"tcp://{hostname}:{port}")
     socket.subscribe(b"")
+    try:
+        while True:
+            beat_messages.publish(await socket.recv_string())
+    finally:
+        socket.close()
+
+
+async def start_beat_listener():
+    global _beat_listener
+    _beat_listener = asyncio.ensure_future(
+        run_forever("beat listener", _listen_to_beat)
+    )
+
 
+async def stop_beat_listener():
+    if _beat_listener:
+        _beat_listener.cancel()
+
+
+@requires(["authenticated"], redirect="login")
+async def beat_websocket(websocket):
     await websocket.accept()
-    while True:
-        msg = await socket.recv_string()
-        await websocket.send_json({"msg": msg})
-    await websocket.close()
+    subscription = beat_messages.subscribe()
+
+    async def forward():
+        async for msg in subscription:
+            await websocket.send_json({"msg": msg})
+
+    forwarder = asyncio.ensure_future(forward())
+    try:
+        # clients don't send anything, so this just waits for a disconnect
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    finally:
+        forwarder.cancel()
+        beat_messages.unsubscribe(subscription)
+
+
+# how much of the log a snapshot includes, anything earlier is fetched from /logs
+SNAPSHOT_LOG_TAIL = 100000
+
+
+async def _run_snapshot(run_id, state):
+    seq, run, log_end = state["seq"], state["run"], state["log_end"]
+    log_start = max(log_end - SNAPSHOT_LOG_TAIL, 0)
+    logs = await bobsled.storage.get_logs(
+        run_id, offset=log_start, limit=log_end - log_start
+    )
+    return {
+        "type": "snapshot",
+        "seq": seq,
+        "run": run,
+        "logs": logs,
+        "log_start": log_start,
+        "log_end": log_end,
+    }
+
+
+async def _poll_run(run_id, state):
+    """
+    the first poll of a run publishes a snapshot, later polls publish a delta with
+    the fields that changed & any new log output, or nothing if neither did
+    """
+    run = await bobsled.run.update_status(run_id, update_logs=True)
+    done = run.status not in (Status.Running, Status.Pending)
+    rundict = _run2dict(run)
+    del rundict["logs"]
+    log_end = await bobsled.storage.get_log_size(run_id)
+
+    if "seq" not in state:
+        state.update(seq=0, run=rundict, log_end=log_end)
+        return await _run_snapshot(run_id, state), done
+
+    changes = {k: v for k, v in rundict.items() if state["run"].get(k) != v}
+    log_start = state["log_end"]
+    if not changes and log_end == log_start:
+        return None, done
+    logs = ""
+    if log_end > log_start:
+        logs = await bobsled.storage.get_logs(
+            run_id, offset=log_start, limit=log_end - log_start
+        )
+    state.update(seq=state["seq"] + 1, run=rundict, log_end=log_end)
+    return (
+        {
+            "type": "delta",
+            "seq": state["seq"],
+            "changes": changes,
+            "logs": logs,
+            "log_start": log_start,
+            "log_end": log_end,
+        },
+        done,
+    )
+
+
+# every socket watching a run shares a single once-a-second poll of it, new sockets
+# get a snapshot of their own instead of replayed history
+run_updates = PollingPublisher(_poll_run, interval=1, history=0)
 
 
 @requires(["authenticated"], redirect="login")
 async def websocket_endpoint(websocket):
+    """
+    sends a snapshot of the run followed by deltas, each with the next seq number
+
+    A client that sees a gap in seq (e.g. messages dropped because it fell behind)
+    should reconnect to get a fresh snapshot.
+    """
     await websocket.accept()
     run_id = websocket.path_params["run_id"]
-    while True:
-        run = await bobsled.run.update_status(run_id, update_logs=True)
-        rundict = _run2dict(run)
-        await websocket.send_json(rundict)
-        if run.status not in (Status.Running, Status.Pending):
-            break
-        await asyncio.sleep(1)
+    archived = await _get_archived_run(run_id)
+    if archived:
+        # archived runs are finished, so the snapshot is all there is
+        rundict = _run2dict(archived)
+        logs = rundict.pop("logs")
+        await websocket.send_json(
+            {
+                "type": "snapshot",
+                "seq": 0,
+                "run": rundict,
+                "logs": logs,
+                "log_start": 0,
+                "log_end": len(logs),
+            }
+        )
+        await websocket.close()
+        return
+    async with run_updates.subscribe(run_id) as updates:
+        # until the first poll finishes its snapshot is on the way to everyone
+        if "seq" in updates.state:
+            await websocket.send_json(await _run_snapshot(run_id, updates.state))
+        async for message in updates:
+            await websocket.send_json(message)
     await websocket.close()
 
 
@@ -257,6 +550,7 @@ app = Starlette(
         Route("/logout", logout),
         Route("/login", login, methods=["GET", "POST"]),
         Route("/admin", admin_view, methods=["GET", "POST"]),
+        Route("/metrics", metrics),
         # React
         Route("/", index),
         Route("/latest_runs", index),
@@ -265,9 +559,12 @@ app = Starlette(
         # API
         Route("/api/index", api_index),
         Route("/api/latest_runs", latest_runs),
+        Route("/api/queue", queue),
+        Route("/api/stats", task_stats),
         Route("/api/task/{task_name}", task_overview),
         Route("/api/task/{task_name}/run", run_task, methods=["POST"]),
         Route("/api/run/{run_id}", run_detail),
+        Route("/api/run/{run_id}/logs", run_logs),
         Route("/api/run/{run_id}/stop", stop_run, methods=["POST"]),
         Route("/api/update_config", update_config, methods=["POST"]),
         # websockets
@@ -283,7 +580,8 @@ app = Starlette(
         ),
     ],
     middleware=[Middleware(AuthenticationMiddleware, backend=JWTSessionAuthBackend())],
-    on_startup=[bobsled.initialize],
+    on_startup=[bobsled.initialize, start_beat_listener],
+    on_shutdown=[stop_beat_listener],
 )
 
 
@@ -7,7 +7,9 @@ class LatestRuns extends React.Component {
     super(props);
     this.state = {
       runs: [],
+      next: null,
     };
+    this.loadOlder = this.loadOlder.bind(this);
   }
 
   componentDidMount() {
@@ -16,11 +18,29 @@ class LatestRuns extends React.Component {
       .then(data => this.setState(data));
   }
 
+  loadOlder() {
+    fetch("/api/latest_runs?before=" + encodeURIComponent(this.state.next))
+      .then(response => response.json())
+      .then(data =>
+        this.setState(state => ({
+          runs: state.runs.concat(data.runs),
+          next: data.next,
+        }))
+      );
+  }
+
   render() {
     return (
       <section className="section">
         <div className="container">
           <RunList title="Latest Runs" runs={this.state.runs} />
+          {this.state.next ? (
+            <a className="button is-centered" onClick={this.loadOlder}>
+              Older Runs
+            </a>
+          ) : (
+            ""
+          )}
         </div>
       </section>
     );
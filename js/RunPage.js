@@ -2,13 +2,79 @@ import React from "react";
 import { Link } from "react-router-dom";
 import { local_websocket } from "./utils.js";
 
+// how much earlier output to load at a time, snapshots only have the end of the log
+const LOG_TAIL_SIZE = 100000;
+
 class RunPage extends React.Component {
   constructor(props) {
     super(props);
     this.state = {
-      ws: local_websocket("/ws/logs/" + this.props.match.params.run_id),
+      logs: "",
+      logStart: 0,
+      logEnd: 0,
     };
+    this.seq = null;
     this.stopRun = this.stopRun.bind(this);
+    this.fetchEarlierLogs = this.fetchEarlierLogs.bind(this);
+    this.onMessage = this.onMessage.bind(this);
+  }
+
+  connect() {
+    this.seq = null;
+    this.ws = local_websocket("/ws/logs/" + this.props.match.params.run_id);
+    this.ws.onmessage = this.onMessage;
+  }
+
+  resync() {
+    // missed a message, start over from a fresh snapshot
+    this.ws.onmessage = null;
+    this.ws.close();
+    this.connect();
+  }
+
+  onMessage(evt) {
+    const message = JSON.parse(evt.data);
+    if (message.type == "snapshot") {
+      this.seq = message.seq;
+      this.setState({
+        ...message.run,
+        logs: message.logs,
+        logStart: message.log_start,
+        logEnd: message.log_end,
+      });
+    } else if (
+      this.seq === null ||
+      message.seq != this.seq + 1 ||
+      message.log_start != this.state.logEnd
+    ) {
+      this.resync();
+    } else {
+      this.seq = message.seq;
+      this.setState((state) => ({
+        ...message.changes,
+        logs: state.logs + message.logs,
+        logEnd: message.log_end,
+      }));
+    }
+  }
+
+  fetchEarlierLogs() {
+    const start = Math.max(this.state.logStart - LOG_TAIL_SIZE, 0);
+    fetch(
+      "/api/run/" +
+        this.props.match.params.run_id +
+        "/logs?offset=" +
+        start +
+        "&limit=" +
+        (this.state.logStart - start)
+    )
+      .then((response) => response.text())
+      .then((text) =>
+        this.setState((state) => ({
+          logs: text + state.logs,
+          logStart: start,
+        }))
+      );
   }
 
   stopRun() {
@@ -21,14 +87,12 @@ class RunPage extends React.Component {
   }
 
   componentDidMount() {
-    this.state.ws.onmessage = (evt) => {
-      const message = JSON.parse(evt.data);
-      this.setState(message);
-    };
+    this.connect();
+  }
 
-    fetch("/api/run/" + this.props.match.params.run_id)
-      .then((response) => response.json())
-      .then((data) => this.setState(data));
+  componentWillUnmount() {
+    this.ws.onmessage = null;
+    this.ws.close();
   }
 
   render() {
@@ -69,6 +133,14 @@ class RunPage extends React.Component {
             </tbody>
           </table>
 
+          {this.state.logStart > 0 ? (
+            <a className="button is-centered" onClick={this.fetchEarlierLogs}>
+              Load Earlier Output
+            </a>
+          ) : (
+            ""
+          )}
+
           <pre>{this.state.logs}</pre>
           <a name="bottom"></a>
         </div>
@@ -10,8 +10,10 @@ class TaskPage extends React.Component {
       task_name: this.props.match.params.task_name,
       task: {},
       runs: [],
+      next: null,
     };
     this.startRun = this.startRun.bind(this);
+    this.loadOlder = this.loadOlder.bind(this);
   }
 
   componentDidMount() {
@@ -20,6 +22,22 @@ class TaskPage extends React.Component {
       .then((data) => this.setState(data));
   }
 
+  loadOlder() {
+    fetch(
+      "/api/task/" +
+        this.state.task_name +
+        "?before=" +
+        encodeURIComponent(this.state.next)
+    )
+      .then((response) => response.json())
+      .then((data) =>
+        this.setState((state) => ({
+          runs: state.runs.concat(data.runs),
+          next: data.next,
+        }))
+      );
+  }
+
   startRun() {
     const outerThis = this;
     fetch("/api/task/" + this.state.task_name + "/run", { method: "POST" })
@@ -114,11 +132,20 @@ class TaskPage extends React.Component {
               </table>
             </div>
 
-            <RunList
-              title="Recent Runs"
-              runs={this.state.runs}
-              hideTask="true"
-            />
+            <div className="column">
+              <RunList
+                title="Recent Runs"
+                runs={this.state.runs}
+                hideTask="true"
+              />
+              {this.state.next ? (
+                <a className="button is-centered" onClick={this.loadOlder}>
+                  Older Runs
+                </a>
+              ) : (
+                ""
+              )}
+            </div>
           </div>
         </div>
       </section>
@@ -1,25 +1,18 @@
 import asyncio
 import attr
 import pprint
-import dateutil.parser
-from datetime import timedelta
 from bobsled.core import bobsled
-from bobsled.base import Status
 
 
-def recommend_frequency_for_task(runs):
-    total_duration = timedelta(seconds=0)
-    longest_duration = timedelta(seconds=0)
-    for run in runs:
-        start = dateutil.parser.parse(run.start)
-        end = dateutil.parser.parse(run.end)
-        duration = end - start
-        total_duration += duration
-        if duration > longest_duration:
-            longest_duration = duration
-    if longest_duration.seconds <= 60 * 10:
+def recommend_frequency_for_task(stats):
+    # nearly all runs finish within the p95 duration
+    longest_duration = stats.duration_p95.value()
+    if longest_duration is None:
+        # successes without a start & end to time them by
+        return 'n/a - no run durations'
+    if longest_duration <= 60 * 10:
         return '0 */2 * * ?'
-    elif longest_duration.seconds <= 60 * 60:
+    elif longest_duration <= 60 * 60:
         return '0 */6 * * ?'
     else:
         return 'daily'
@@ -28,18 +21,17 @@ def recommend_frequency_for_task(runs):
 async def analyze_frequency():
     await bobsled.initialize()
     tasks = [attr.asdict(t) for t in await bobsled.storage.get_tasks()]
-    results = await asyncio.gather(
-        *[bobsled.run.get_runs(task_name=t["name"], latest=4) for t in tasks]
-    )
+    all_stats = await bobsled.run.get_task_stats()
     recommendations = []
-    for task, latest_runs in zip(tasks, results):
-        # make recommendations for scrape tasks that have runs
-        if latest_runs and '-scrape' in task['name']:
-            if all(run.status is Status.Success for run in latest_runs):
-                recommendation = recommend_frequency_for_task(latest_runs)
+    for task in tasks:
+        stats = all_stats.get(task['name'])
+        # make recommendations for scrape tasks that have successful runs
+        if stats and stats.successes and '-scrape' in task['name']:
+            if stats.last_status == 'Success':
+                recommendation = recommend_frequency_for_task(stats)
             else:
-                # a recent run failed, made a note of that
-                recommendation = 'n/a - at least one recent task failed'
+                # the latest run failed, made a note of that
+                recommendation = 'n/a - the most recent run failed'
             if len(task['triggers']) > 0:
                 current_schedule = task['triggers'][0]['cron']
             else: